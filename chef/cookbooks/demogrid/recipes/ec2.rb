@@ -1,13 +1,4 @@
-package "libshadow-ruby1.8"
-package "nis"
-package "portmap"
-package "nfs-common"
-package "autofs"
-package "xinetd"
-package "gcc"
-package "libssl0.9.8"
-package "libssl-dev"
-package "expect"
+include_recipe "demogrid::ec2_base"
 
 include_recipe "demogrid::globus"
 include_recipe "demogrid::condor"
@@ -0,0 +1,36 @@
+# -------------------------------------------------------------------------- #
+# Copyright 2010, University of Chicago                                      #
+#                                                                            #
+# Licensed under the Apache License, Version 2.0 (the "License"); you may    #
+# not use this file except in compliance with the License. You may obtain    #
+# a copy of the License at                                                   #
+#                                                                            #
+# http://www.apache.org/licenses/LICENSE-2.0                                 #
+#                                                                            #
+# Unless required by applicable law or agreed to in writing, software        #
+# distributed under the License is distributed on an "AS IS" BASIS,          #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.   #
+# See the License for the specific language governing permissions and        #
+# limitations under the License.                                             #
+# -------------------------------------------------------------------------- #
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# RECIPE: EC2 base image
+#
+# This recipe installs the packages that every DemoGrid node needs. It is
+# used when baking AMIs, on its own or (in role-specific AMIs) along with
+# the recipes that install the software a particular role needs.
+#
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+package "libshadow-ruby1.8"
+package "nis"
+package "portmap"
+package "nfs-common"
+package "autofs"
+package "xinetd"
+package "gcc"
+package "libssl0.9.8"
+package "libssl-dev"
+package "expect"
@@ -5,14 +5,55 @@ NEWIMG=$2
 IP=$3
 HOSTNAME=$4
 HOSTSFILE=$5
+FLATTEN=$6
+NBD=${7:-/dev/nbd0}
 
-cp $MASTER $NEWIMG
+NBD_SYS=/sys/block/`basename $NBD`
 
-MNTDIR=`mktemp -d`
+# Waits (up to 30 seconds) for a condition to be true
+wait_for() {
+    for i in `seq 300`; do
+        if eval "$1"; then
+            return 0
+        fi
+        sleep 0.1
+    done
+    echo "Timed out waiting for $NBD ($1)" >&2
+    return 1
+}
+
+disconnect() {
+    if [ -e $NBD_SYS/pid ]; then
+        qemu-nbd -d $NBD > /dev/null
+        # Don't give the device back until it's really free
+        wait_for "[ ! -e $NBD_SYS/pid ]"
+    fi
+}
+
+cleanup() {
+    if [ -n "$MNTDIR" ]; then
+        umount $MNTDIR 2> /dev/null
+        rmdir $MNTDIR
+    fi
+    disconnect
+    rm -f $TMP_FILE
+}
+
+set -e
+trap cleanup EXIT
+
+# The new image is a copy-on-write overlay on top of the master image,
+# so only the blocks that are changed for this host are stored in it.
+# The backing file has to be an absolute path, since the overlay is
+# not in the same directory as the master image.
+qemu-img create -f qcow2 -o backing_fmt=qcow2 -b `readlink -f $MASTER` $NEWIMG > /dev/null
 
-qemu-nbd -c /dev/nbd0 $NEWIMG
-sleep 2
-mount /dev/nbd0p1 $MNTDIR
+qemu-nbd -c $NBD $NEWIMG
+# The device is ready once it has a size and its partitions show up
+wait_for "[ -e $NBD_SYS/pid ] && [ \`cat $NBD_SYS/size\` != 0 ] && [ -b ${NBD}p1 ]"
+
+MNTDIR=`mktemp -d`
+mount ${NBD}p1 $MNTDIR
 
 cp $HOSTSFILE $MNTDIR/etc/hosts
 echo $HOSTNAME > $MNTDIR/etc/hostname
@@ -21,7 +62,12 @@ cp $MNTDIR/etc/network/interfaces $TMP_FILE
 sed s/192.168.0.2$/$IP/g $TMP_FILE > $MNTDIR/etc/network/interfaces
 
 umount $MNTDIR
-nbd-client -d /dev/nbd0 > /dev/null
-
-rm $TMP_FILE
 rmdir $MNTDIR
+MNTDIR=
+disconnect
+
+if [ "$FLATTEN" = "flatten" ]; then
+    # Merge the master image into the overlay, so the new
+    # image doesn't depend on the master image anymore.
+    qemu-img rebase -b "" $NEWIMG
+fi
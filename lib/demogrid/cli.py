@@ -6,7 +6,6 @@ Created on Nov 1, 2010
 
 #!/usr/bin/python
 
-from demogrid.prepare import Preparator
 import demogrid.common.defaults as defaults
 from demogrid.common.config import DemoGridConfig
 import os
@@ -14,17 +13,18 @@ from optparse import OptionParser
 import getpass
 import subprocess
 from cPickle import load
-from demogrid.ec2.images import EC2ChefVolumeCreator, EC2AMICreator
-from demogrid.ec2.launch import EC2Launcher
+
+# Each command only imports the modules it needs (when it runs), so
+# commands don't pay for the dependencies of other commands (boto,
+# paramiko, OpenSSL, Mako, etc.). Commands are run many times from
+# provisioning scripts, so startup time matters.
 
 class Command(object):
     
     def __init__(self, argv, root = False):
         
         if root:
-            if getpass.getuser() != "root":
-                print "Must run as root"
-                exit(1)         
+            self._check_root()
                  
         if not os.environ.has_key("DEMOGRID_LOCATION"):
             print "DEMOGRID_LOCATION not set"
@@ -39,6 +39,11 @@ class Command(object):
         self.opt = None
         self.args = None
 
+    def _check_root(self):
+        if getpass.getuser() != "root":
+            print "Must run as root"
+            exit(1)         
+
     def parse_options(self):
         opt, args = self.optparser.parse_args(self.argv)
         self.opt = opt
@@ -90,6 +95,7 @@ class demogrid_prepare(Command):
         
         config = DemoGridConfig(self.opt.conf)
 
+        from demogrid.prepare import Preparator
         p = Preparator(self.dg_location, config, self.opt.dir, self.opt.force_certificates, self.opt.force_chef)
         p.prepare()        
         
@@ -99,44 +105,75 @@ class demogrid_clone_image(Command):
     name = "demogrid-clone-image"
     
     def __init__(self, argv):
-        Command.__init__(self, argv, root = True)
+        Command.__init__(self, argv)
         
         self.optparser.add_option("-n", "--host", 
                                   action="store", type="string", dest="host", 
                                   help = "Host to clone an image for.")
 
+        self.optparser.add_option("-a", "--all", 
+                                  action="store_true", dest="all", 
+                                  help = "Clone an image for every host.")
+
+        self.optparser.add_option("-r", "--role", 
+                                  action="store", type="string", dest="role", 
+                                  help = "Clone an image for every host with this role.")
+
+        self.optparser.add_option("-o", "--org", 
+                                  action="store", type="string", dest="org", 
+                                  help = "Clone an image for every host in this organization.")
+
         self.optparser.add_option("-g", "--generated-dir", 
                                   action="store", type="string", dest="dir", 
                                   default = defaults.GENERATED_LOCATION,
                                   help = "Directory with generated files.")
+
+        self.optparser.add_option("-f", "--flatten", 
+                                  action="store_true", dest="flatten", 
+                                  help = "Create a standalone image. By default, the image is a copy-on-write "
+                                         "overlay on top of the master image (which must then not be modified "
+                                         "or removed while the image is in use).")
+
+        self.optparser.add_option("-p", "--concurrency", 
+                                  action="store", type="int", dest="concurrency", 
+                                  help = "Maximum number of images to create at the same time "
+                                         "(by default, one per free nbd device).")
+
+        self.optparser.add_option("-s", "--seed", 
+                                  action="store_true", dest="seed", 
+                                  help = "Instead of customizing the image (which requires root and "
+                                         "an nbd device), create a seed image with the host's files, "
+                                         "which is applied when the VM boots.")
         
     def run(self):    
         self.parse_options()
         
+        if not self.opt.seed:
+            # Mounting the images requires root
+            self._check_root()
+        
         f = open ("%s/topology.dat" % self.opt.dir, "r")
         topology = load(f)
         f.close()        
 
-        host = topology.get_node_by_id(self.opt.host)
-        if host == None:
-            print "Host %s is not defined" % self.opt.host
-            exit(1)
-
-        args_newvm = ["%s/ubuntu-vm-builder/master_img.qcow2" % self.opt.dir, 
-                      "/var/vm/%s.qcow2" % host.demogrid_host_id, 
-                      host.ip, 
-                      host.demogrid_host_id,
-                      "%s/hosts" % self.opt.dir
-                      ]
-        cmd_newvm = ["%s/lib/create_from_master_img.sh" % self.dg_location] + args_newvm
-        
-        print "Creating VM for %s" % host.demogrid_host_id
-        retcode = subprocess.call(cmd_newvm)
-        if retcode != 0:
-            print "Error when running %s" % " ".join(cmd_newvm)
+        if self.opt.host != None:
+            host = topology.get_node_by_id(self.opt.host)
+            if host == None:
+                print "Host %s is not defined" % self.opt.host
+                exit(1)
+            nodes = [host]
+        elif self.opt.all or self.opt.role != None or self.opt.org != None:
+            nodes = topology.get_nodes_by(role = self.opt.role, org_name = self.opt.org)
+            if len(nodes) == 0:
+                print "There are no hosts that match the given role/organization"
+                exit(1)
+        else:
+            print "You must specify a host (--host), or a set of hosts (--all, --role, --org)"
             exit(1)
 
-        print "Created VM for host %s" % host.demogrid_host_id
+        from demogrid.local.clone import ImageCloner
+        c = ImageCloner(self.dg_location, self.opt.dir, nodes, self.opt.flatten, self.opt.concurrency, self.opt.seed)
+        c.run()
         
 
 class demogrid_register_host_chef(Command):
@@ -148,12 +185,38 @@ class demogrid_register_host_chef(Command):
         
         self.optparser.add_option("-n", "--host", 
                                   action="store", type="string", dest="host", 
-                                  help = "Host to clone an image for.")
+                                  help = "Host to register.")
+
+        self.optparser.add_option("-a", "--all", 
+                                  action="store_true", dest="all", 
+                                  help = "Register every host.")
+
+        self.optparser.add_option("-r", "--role", 
+                                  action="store", type="string", dest="role", 
+                                  help = "Register every host with this role.")
+
+        self.optparser.add_option("-o", "--org", 
+                                  action="store", type="string", dest="org", 
+                                  help = "Register every host in this organization.")
 
         self.optparser.add_option("-g", "--generated-dir", 
                                   action="store", type="string", dest="dir", 
                                   default = defaults.GENERATED_LOCATION,
                                   help = "Directory with generated files.")
+
+        self.optparser.add_option("-k", "--knife-config", 
+                                  action="store", type="string", dest="knife", 
+                                  default = os.path.expanduser("~/.chef/knife.rb"),
+                                  help = "knife configuration file (with the Chef server URL and the client to use).")
+
+        self.optparser.add_option("-f", "--force", 
+                                  action="store_true", dest="force", 
+                                  help = "Register the hosts again, even if they are already registered.")
+
+        self.optparser.add_option("-p", "--concurrency", 
+                                  action="store", type="int", dest="concurrency", 
+                                  default = 4,
+                                  help = "Maximum number of concurrent requests to the Chef server.")
         
     def run(self):    
         self.parse_options()
@@ -162,23 +225,26 @@ class demogrid_register_host_chef(Command):
         topology = load(f)
         f.close()        
 
-        host = topology.get_node_by_id(self.opt.host)
-        if host == None:
-            print "Host %s is not defined" % self.opt.host
+        if self.opt.host != None:
+            host = topology.get_node_by_id(self.opt.host)
+            if host == None:
+                print "Host %s is not defined" % self.opt.host
+                exit(1)
+            nodes = [host]
+        elif self.opt.all or self.opt.role != None or self.opt.org != None:
+            nodes = topology.get_nodes_by(role = self.opt.role, org_name = self.opt.org)
+            if len(nodes) == 0:
+                print "There are no hosts that match the given role/organization"
+                exit(1)
+        else:
+            print "You must specify a host (--host), or a set of hosts (--all, --role, --org)"
             exit(1)
 
-        retcode = self._run("knife node show %s" % host.hostname, exit_on_error = False)
-        node_exists = (retcode == 0)
-        retcode = self._run("knife client show %s" % host.hostname, exit_on_error = False)
-        client_exists = (retcode == 0)
-
-        if node_exists:
-            self._run("knife node delete %s -y" % host.hostname)
-        if client_exists:
-            self._run("knife client delete %s -y" % host.hostname)
-        self._run("knife node create %s -n" % host.hostname)
-        self._run("knife node run_list add %s role[%s]" % (host.hostname, host.role))            
-        print "Registered host %s in the Chef server" % host.demogrid_host_id        
+        from demogrid.local.chef import ChefClient, ChefRegistrar, read_knife_config
+        server_url, client_name, client_key = read_knife_config(self.opt.knife)
+        client = ChefClient(server_url, client_name, client_key, self.opt.concurrency)
+        r = ChefRegistrar(client, nodes, self.opt.force, self.opt.concurrency)
+        r.run()
         
 
 class demogrid_register_host_libvirt(Command):
@@ -190,7 +256,19 @@ class demogrid_register_host_libvirt(Command):
         
         self.optparser.add_option("-n", "--host", 
                                   action="store", type="string", dest="host", 
-                                  help = "Host to clone an image for.")
+                                  help = "Host to register.")
+
+        self.optparser.add_option("-a", "--all", 
+                                  action="store_true", dest="all", 
+                                  help = "Register every host.")
+
+        self.optparser.add_option("-r", "--role", 
+                                  action="store", type="string", dest="role", 
+                                  help = "Register every host with this role.")
+
+        self.optparser.add_option("-o", "--org", 
+                                  action="store", type="string", dest="org", 
+                                  help = "Register every host in this organization.")
 
         self.optparser.add_option("-g", "--generated-dir", 
                                   action="store", type="string", dest="dir", 
@@ -199,8 +277,31 @@ class demogrid_register_host_libvirt(Command):
 
         self.optparser.add_option("-m", "--memory", 
                                   action="store", type="int", dest="memory", 
-                                  default = 512,
-                                  help = "Memory")        
+                                  help = "Memory (MB) for every host (by default, it depends on the host's role).")        
+
+        self.optparser.add_option("-f", "--profile", 
+                                  action="append", type="string", dest="profiles", default = [],
+                                  help = "Memory (MB) and vCPUs for a role, as ROLE=MEMORY[:VCPUS]. Can be used several times.")        
+
+        self.optparser.add_option("-c", "--connect", 
+                                  action="store", type="string", dest="uri", 
+                                  default = "qemu:///system",
+                                  help = "libvirt URI.")        
+
+        self.optparser.add_option("-w", "--network", 
+                                  action="store", type="string", dest="network", 
+                                  default = "default",
+                                  help = "libvirt network to connect the hosts to.")        
+
+        self.optparser.add_option("-s", "--no-waves", 
+                                  action="store_false", dest="waves", default = True,
+                                  help = "Start all the hosts at once (instead of starting each host only once "
+                                         "the hosts it depends on are up).")        
+
+        self.optparser.add_option("-t", "--wave-timeout", 
+                                  action="store", type="int", dest="wave_timeout", 
+                                  default = 300,
+                                  help = "Seconds to wait for the hosts in a wave to come up.")        
         
     def run(self):    
         self.parse_options()
@@ -209,16 +310,162 @@ class demogrid_register_host_libvirt(Command):
         topology = load(f)
         f.close()        
 
-        host = topology.get_node_by_id(self.opt.host)
-        if host == None:
-            print "Host %s is not defined" % self.opt.host
+        if self.opt.host != None:
+            host = topology.get_node_by_id(self.opt.host)
+            if host == None:
+                print "Host %s is not defined" % self.opt.host
+                exit(1)
+            nodes = [host]
+        elif self.opt.all or self.opt.role != None or self.opt.org != None:
+            nodes = topology.get_nodes_by(role = self.opt.role, org_name = self.opt.org)
+            if len(nodes) == 0:
+                print "There are no hosts that match the given role/organization"
+                exit(1)
+        else:
+            print "You must specify a host (--host), or a set of hosts (--all, --role, --org)"
             exit(1)
 
-        self._run("virt-install -n %s -r %i --disk path=/var/vm/%s.qcow2,format=qcow2,size=2 --accelerate --vnc --noautoconsole --import --connect=qemu:///system" % (host.demogrid_host_id, self.opt.memory, host.demogrid_host_id) )
+        profiles = {}
+        if self.opt.memory != None:
+            for n in nodes:
+                profiles[n.role] = (self.opt.memory, 1)
+        for profile in self.opt.profiles:
+            role, size = profile.split("=")
+            if ":" in size:
+                memory, vcpus = size.split(":")
+            else:
+                memory, vcpus = size, 1
+            profiles[role] = (int(memory), int(vcpus))
 
-        print "Registered host %s in libvirt" % host.demogrid_host_id        
+        from demogrid.local.virt import LibvirtRegistrar
+        r = LibvirtRegistrar(nodes, self.opt.uri, self.opt.network, profiles, self.opt.waves, self.opt.wave_timeout)
+        r.run()
         
         
+class demogrid_local_launch(Command):
+    
+    name = "demogrid-local-launch"
+    
+    def __init__(self, argv):
+        Command.__init__(self, argv, root=True)
+        
+        self.optparser.add_option("-c", "--conf", 
+                                  action="store", type="string", dest="conf", 
+                                  default = defaults.CONFIG_FILE,
+                                  help = "Configuration file.")
+        
+        self.optparser.add_option("-g", "--generated-dir", 
+                                  action="store", type="string", dest="dir", 
+                                  default = defaults.GENERATED_LOCATION,
+                                  help = "Directory with generated files.")
+
+        self.optparser.add_option("-f", "--rootfs", 
+                                  action="store", type="string", dest="rootfs", 
+                                  help = "Base root filesystem, shared (read-only) by all the containers. It must have Chef installed.")
+
+        self.optparser.add_option("-k", "--containers-dir", 
+                                  action="store", type="string", dest="containers_dir", 
+                                  help = "Directory to keep the containers in (default: the containers directory in the generated directory).")
+
+        self.optparser.add_option("-i", "--init", 
+                                  action="store", type="string", dest="init", 
+                                  default = "/sbin/init",
+                                  help = "Command to run as the init of each container.")
+
+        self.optparser.add_option("-v", "--verbose", 
+                                  action="store_true", dest="verbose", 
+                                  help = "Produce verbose output.")
+
+        self.optparser.add_option("-d", "--debug", 
+                                  action="store_true", dest="debug", 
+                                  help = "Write debugging information. Implies -v.")
+
+        self.optparser.add_option("-n", "--no-cleanup", 
+                                  action="store_true", dest="no_cleanup", 
+                                  help = "Don't stop the containers on failure.")
+
+        self.optparser.add_option("-p", "--configure-concurrency", 
+                                  action="store", type="int", dest="configure_concurrency", 
+                                  help = "Maximum number of containers to configure concurrently (default: no limit).")
+
+        self.optparser.add_option("-t", "--trace", 
+                                  action="store", type="string", dest="trace", metavar="FILE",
+                                  help = "Save a trace of the launch to FILE (in Chrome trace format), and print a summary of the slowest nodes and phases.")
+                
+    def run(self):    
+        self.parse_options()
+
+        if self.opt.rootfs == None:
+            print "You must specify a base root filesystem (--rootfs)"
+            exit(1)
+        if not os.path.isdir(self.opt.rootfs):
+            print "%s is not a directory" % self.opt.rootfs
+            exit(1)
+
+        config = DemoGridConfig(self.opt.conf)
+        
+        if self.opt.debug:
+            loglevel = 2
+        elif self.opt.verbose:
+            loglevel = 1
+        else:
+            loglevel = 0
+        
+        from demogrid.local.containers import ContainerLauncher
+        c = ContainerLauncher(self.dg_location, config, self.opt.dir, loglevel, self.opt.no_cleanup,
+                              os.path.abspath(self.opt.rootfs), self.opt.containers_dir, self.opt.init,
+                              self.opt.configure_concurrency, self.opt.trace)
+        c.run()          
+
+class demogrid_local_teardown(Command):
+    
+    name = "demogrid-local-teardown"
+    
+    def __init__(self, argv):
+        Command.__init__(self, argv, root=True)
+        
+        self.optparser.add_option("-c", "--conf", 
+                                  action="store", type="string", dest="conf", 
+                                  default = defaults.CONFIG_FILE,
+                                  help = "Configuration file.")
+        
+        self.optparser.add_option("-g", "--generated-dir", 
+                                  action="store", type="string", dest="dir", 
+                                  default = defaults.GENERATED_LOCATION,
+                                  help = "Directory with generated files.")
+
+        self.optparser.add_option("-k", "--containers-dir", 
+                                  action="store", type="string", dest="containers_dir", 
+                                  help = "Directory the containers are kept in (default: the containers directory in the generated directory).")
+
+        self.optparser.add_option("-e", "--keep", 
+                                  action="store_true", dest="keep", 
+                                  help = "Keep the containers' directories (with the changes made to each node).")
+                
+    def run(self):    
+        self.parse_options()
+
+        f = open ("%s/topology.dat" % self.opt.dir, "r")
+        topology = load(f)
+        f.close()        
+
+        containers_dir = self.opt.containers_dir
+        if containers_dir == None:
+            containers_dir = "%s/containers" % self.opt.dir
+
+        from demogrid.local.containers import ContainerManager
+        config = DemoGridConfig(self.opt.conf)
+        m = ContainerManager(containers_dir, None, config.get_subnet())
+        containers = m.get_containers(topology)
+        if len(containers) == 0:
+            print "There are no containers in %s" % containers_dir
+            exit(1)
+        for c in containers:
+            m.stop(c, self.opt.keep)
+            print "Stopped %s" % c.id
+        if m.teardown_network():
+            print "Removed bridge %s" % m.BRIDGE
+        
 class demogrid_ec2_launch(Command):
     
     name = "demogrid-ec2-launch"
@@ -247,10 +494,111 @@ class demogrid_ec2_launch(Command):
         self.optparser.add_option("-n", "--no-cleanup", 
                                   action="store_true", dest="no_cleanup", 
                                   help = "Don't release resources on failure.")
+
+        self.optparser.add_option("-w", "--wait-concurrency", 
+                                  action="store", type="int", dest="wait_concurrency", 
+                                  help = "Maximum number of EC2 tasks to run concurrently (default: no limit).")
+
+        self.optparser.add_option("-p", "--configure-concurrency", 
+                                  action="store", type="int", dest="configure_concurrency", 
+                                  help = "Maximum number of instances to configure concurrently (default: no limit).")
+
+        self.optparser.add_option("-o", "--fanout", 
+                                  action="store", type="int", dest="fanout", 
+                                  help = "Distribute files to each organization's nodes through its server, with each node relaying the files to at most this many other nodes.")
+
+        self.optparser.add_option("-u", "--pull", 
+                                  action="store", type="string", dest="pull", metavar="HOST[:PORT]",
+                                  help = "Have the instances configure themselves, with files they download from an artifact server started on this host (which the instances must be able to reach at HOST[:PORT]).")
+
+        self.optparser.add_option("-r", "--resume", 
+                                  action="store_true", dest="resume", 
+                                  help = "Resume a failed launch (that was run with --no-cleanup), reusing its instances and only configuring the nodes that weren't fully configured.")
+
+        self.optparser.add_option("-t", "--trace", 
+                                  action="store", type="string", dest="trace", metavar="FILE",
+                                  help = "Save a trace of the launch to FILE (in Chrome trace format), and print a summary of the slowest nodes and phases.")
+                
+    def run(self):    
+        self.parse_options()
+
+        config = DemoGridConfig(self.opt.conf)
+        
+        if self.opt.debug:
+            loglevel = 2
+        elif self.opt.verbose:
+            loglevel = 1
+        else:
+            loglevel = 0
+        
+        from demogrid.ec2.launch import EC2Launcher
+        c = EC2Launcher(self.dg_location, config, self.opt.dir, loglevel, self.opt.no_cleanup,
+                        self.opt.wait_concurrency, self.opt.configure_concurrency, self.opt.fanout,
+                        self.opt.pull, self.opt.resume, self.opt.trace)
+        c.run()          
+        
+class demogrid_ec2_scale(Command):
+    
+    name = "demogrid-ec2-scale"
+    
+    def __init__(self, argv):
+        Command.__init__(self, argv)
+        
+        self.optparser.add_option("-c", "--conf", 
+                                  action="store", type="string", dest="conf", 
+                                  default = defaults.CONFIG_FILE,
+                                  help = "Configuration file.")
+        
+        self.optparser.add_option("-g", "--generated-dir", 
+                                  action="store", type="string", dest="dir", 
+                                  default = defaults.GENERATED_LOCATION,
+                                  help = "Directory with generated files.")
+
+        self.optparser.add_option("-v", "--verbose", 
+                                  action="store_true", dest="verbose", 
+                                  help = "Produce verbose output.")
+
+        self.optparser.add_option("-d", "--debug", 
+                                  action="store_true", dest="debug", 
+                                  help = "Write debugging information. Implies -v.")
+
+        self.optparser.add_option("-n", "--no-cleanup", 
+                                  action="store_true", dest="no_cleanup", 
+                                  help = "Don't release resources on failure.")
+
+        self.optparser.add_option("-r", "--org", 
+                                  action="store", type="string", dest="org", 
+                                  help = "Organization to scale.")
+
+        self.optparser.add_option("-s", "--clusternodes", 
+                                  action="store", type="string", dest="clusternodes", metavar="[+|-]N",
+                                  help = "Number of cluster nodes the organization should have. +N adds N nodes, and -N removes N nodes.")
+
+        self.optparser.add_option("-w", "--wait-concurrency", 
+                                  action="store", type="int", dest="wait_concurrency", 
+                                  help = "Maximum number of EC2 tasks to run concurrently (default: no limit).")
+
+        self.optparser.add_option("-p", "--configure-concurrency", 
+                                  action="store", type="int", dest="configure_concurrency", 
+                                  help = "Maximum number of instances to configure (or drain) concurrently (default: no limit).")
+
+        self.optparser.add_option("-t", "--drain-timeout", 
+                                  action="store", type="int", dest="drain_timeout", default = 3600,
+                                  help = "When removing nodes, maximum number of seconds to wait for their jobs to finish (default: 3600).")
                 
     def run(self):    
         self.parse_options()
 
+        if self.opt.org == None or self.opt.clusternodes == None:
+            print "You must specify an organization (--org) and a number of cluster nodes (--clusternodes)"
+            exit(1)
+
+        try:
+            int(self.opt.clusternodes)
+        except ValueError:
+            print "--clusternodes must be a number, optionally preceded by + or -"
+            exit(1)
+
         config = DemoGridConfig(self.opt.conf)
         
         if self.opt.debug:
@@ -260,8 +608,11 @@ class demogrid_ec2_launch(Command):
         else:
             loglevel = 0
         
-        c = EC2Launcher(self.dg_location, config, self.opt.dir, loglevel, self.opt.no_cleanup)
-        c.launch()          
+        from demogrid.ec2.scale import EC2Scaler
+        c = EC2Scaler(self.dg_location, config, self.opt.dir, loglevel, self.opt.no_cleanup,
+                      self.opt.org, self.opt.clusternodes, 
+                      self.opt.wait_concurrency, self.opt.configure_concurrency, self.opt.drain_timeout)
+        c.run()          
         
 class demogrid_ec2_create_chef_volume(Command):
     
@@ -281,11 +632,22 @@ class demogrid_ec2_create_chef_volume(Command):
         self.optparser.add_option("-f", "--keypair-file", 
                                   action="store", type="string", dest="keyfile", 
                                   help = "EC2 keypair file")
+
+        self.optparser.add_option("-c", "--conf", 
+                                  action="store", type="string", dest="conf", 
+                                  help = "Configuration file. If specified, the new snapshot is built from "
+                                         "its current snapshot, and the new snapshot is added to it.")
                 
     def run(self):    
         self.parse_options()
         
-        c = EC2ChefVolumeCreator(self.dg_location, self.opt.ami, self.opt.keypair, self.opt.keyfile)
+        if self.opt.conf != None:
+            config = DemoGridConfig(self.opt.conf)
+        else:
+            config = None
+        
+        from demogrid.ec2.images import EC2ChefVolumeCreator
+        c = EC2ChefVolumeCreator(self.dg_location, self.opt.ami, self.opt.keypair, self.opt.keyfile, config)
         c.run()  
         
 
@@ -298,7 +660,7 @@ class demogrid_ec2_create_ami(Command):
         
         self.optparser.add_option("-a", "--ami", 
                                   action="store", type="string", dest="ami", 
-                                  help = "AMI to use to create the volume.")
+                                  help = "AMI(s) to build the AMIs from (comma-separated list).")
 
         self.optparser.add_option("-s", "--snapshot", 
                                   action="store", type="string", dest="snap", 
@@ -315,9 +677,55 @@ class demogrid_ec2_create_ami(Command):
         self.optparser.add_option("-f", "--keypair-file", 
                                   action="store", type="string", dest="keyfile", 
                                   help = "EC2 keypair file")
+
+        self.optparser.add_option("-t", "--instance-types", 
+                                  action="store", type="string", dest="instance_types", 
+                                  default = "c1.medium",
+                                  help = "Instance type(s) to build the AMIs on (comma-separated list).")
+
+        self.optparser.add_option("-r", "--roles", 
+                                  action="store", type="string", dest="roles", 
+                                  help = "Create one AMI for each of these role sets, with only the software "
+                                         "those roles need (comma-separated list of role sets, with the roles "
+                                         "in a set separated by '+'; 'all' creates one AMI per role).")
+
+        self.optparser.add_option("-c", "--conf", 
+                                  action="store", type="string", dest="conf", 
+                                  help = "Configuration file. If specified, the role AMIs are added to it.")
+
+        self.optparser.add_option("-o", "--output-dir", 
+                                  action="store", type="string", dest="output_dir", 
+                                  default = "ami-build",
+                                  help = "Directory for the build logs and the manifest of AMIs.")
+
+        self.optparser.add_option("-p", "--concurrency", 
+                                  action="store", type="int", dest="concurrency", 
+                                  default = 4,
+                                  help = "Maximum number of AMIs to build at the same time.")
                 
     def run(self):    
         self.parse_options()
         
-        c = EC2AMICreator(self.dg_location, self.opt.ami, self.opt.aminame, self.opt.snap, self.opt.keypair, self.opt.keyfile)
+        from demogrid.ec2.images import EC2AMICreator, get_roles
+
+        base_amis = [a.strip() for a in self.opt.ami.split(",")]
+        instance_types = [t.strip() for t in self.opt.instance_types.split(",")]
+        
+        if self.opt.roles == None:
+            role_sets = [None]
+        elif self.opt.roles == "all":
+            role_sets = [[r] for r in get_roles(self.dg_location)]
+        else:
+            role_sets = [[r.strip() for r in rs.split("+")] for rs in self.opt.roles.split(",")]
+
+        if self.opt.conf != None:
+            if len(base_amis) > 1:
+                print "\033[1;31mERROR\033[0m - Role AMIs can only be added to the configuration file when building from a single AMI."
+                exit(1)
+            config = DemoGridConfig(self.opt.conf)
+        else:
+            config = None
+        
+        c = EC2AMICreator(self.dg_location, base_amis, self.opt.aminame, self.opt.snap, self.opt.keypair, self.opt.keyfile, 
+                          instance_types, role_sets, self.opt.output_dir, self.opt.concurrency, config)
         c.run()          
\ No newline at end of file
@@ -1,5 +1,7 @@
 import ConfigParser
 import csv
+import re
+import os
 
 class DemoGridConfig(object):
     
@@ -21,6 +23,7 @@ class DemoGridConfig(object):
 
     EC2_SEC = "ec2"
     AMI_OPT = "ami"
+    ROLE_AMIS_OPT = "role_amis"
     SNAP_OPT = "snap"
     KEYPAIR_OPT = "keypair"
     KEYFILE_OPT = "keyfile"
@@ -30,8 +33,12 @@ class DemoGridConfig(object):
 
     
     def __init__(self, configfile):
+        self.configfile = configfile
         self.config = ConfigParser.ConfigParser()
         self.config.readfp(open(configfile, "r"))
+        # Options that have been set since the file was read,
+        # as (section, option, value) tuples (see save())
+        self.changes = []
         
         organizations = self.config.get(self.GENERAL_SEC, self.ORGANIZATIONS_OPT)
         self.organizations = organizations.split()
@@ -96,15 +103,27 @@ class DemoGridConfig(object):
     def __get_org_sec(self, org_name):
         return self.ORGANIZATION_SEC + org_name
     
-    def get_ami(self):
+    def get_ami(self, role = None):
+        # Role-specific AMIs (see EC2AMICreator) are listed as role:ami pairs
+        if role != None and self.config.has_option(self.EC2_SEC, self.ROLE_AMIS_OPT):
+            role_amis = dict([ra.split(":") for ra in self.config.get(self.EC2_SEC, self.ROLE_AMIS_OPT).split()])
+            if role_amis.has_key(role):
+                return role_amis[role]
         return self.config.get(self.EC2_SEC, self.AMI_OPT)
 
+    def set_role_amis(self, role_amis):
+        self.__set(self.EC2_SEC, self.ROLE_AMIS_OPT, 
+                   " ".join(["%s:%s" % (role, ami) for role, ami in sorted(role_amis.items())]))
+
     def has_snap(self):
         return self.config.has_option(self.EC2_SEC, self.SNAP_OPT)
     
     def get_snap(self):
         return self.config.get(self.EC2_SEC, self.SNAP_OPT)
 
+    def set_snap(self, snap):
+        self.__set(self.EC2_SEC, self.SNAP_OPT, snap)
+
     def get_keypair(self):
         return self.config.get(self.EC2_SEC, self.KEYPAIR_OPT)
 
@@ -113,6 +132,12 @@ class DemoGridConfig(object):
     
     def get_instance_type(self):
         return self.config.get(self.EC2_SEC, self.INSTYPE_OPT)
+
+    def get_role_instance_type(self, role):
+        # The instance type option is a list of role:type pairs,
+        # with the default type for any other role as *:type
+        role_insttype = dict([ri.split(":") for ri in self.get_instance_type().split()])
+        return role_insttype.get(role, role_insttype["*"])
     
     def get_ec2_zone(self):
         return self.config.get(self.EC2_SEC, self.ZONE_OPT)        
@@ -120,5 +145,65 @@ class DemoGridConfig(object):
     def get_ec2_access_type(self):
         return self.config.get(self.EC2_SEC, self.ACCESS_OPT) 
 
+    def save(self):
+        """Writes the options that have been set to the configuration file.
+        Only the lines for those options are changed (an option that
+        isn't in the file yet is added at the end of its section), so
+        the rest of the file, comments included, is left as it was."""
+        f = open(self.configfile, "r")
+        lines = f.read().splitlines()
+        f.close()
+        
+        for section, option, value in self.changes:
+            lines = self.__update_lines(lines, section, option, value)
+        
+        # Write to a temporary file first, so a failure can't leave
+        # the configuration file half-written
+        f = open(self.configfile + ".tmp", "w")
+        f.write("\n".join(lines) + "\n")
+        f.close()
+        os.rename(self.configfile + ".tmp", self.configfile)
+        self.changes = []
+
+    def __set(self, section, option, value):
+        if not self.config.has_section(section):
+            self.config.add_section(section)
+        self.config.set(section, option, value)
+        self.changes.append((section, option, value))
+
+    def __update_lines(self, lines, section, option, value):
+        section_re = re.compile(r"\[(?P<name>[^]]+)\]")
+        option_re = re.compile(r"(?P<name>[^:=\s][^:=]*?)\s*[:=]")
+        new_line = "%s: %s" % (option, value)
+        
+        start = None
+        for i, line in enumerate(lines):
+            m = section_re.match(line)
+            if m != None:
+                if start != None:
+                    break
+                if m.group("name") == section:
+                    start = i + 1
+            elif start != None:
+                m = option_re.match(line)
+                if m != None and m.group("name").lower() == option.lower():
+                    # Drop the option's continuation lines too
+                    end = i + 1
+                    while end < len(lines) and lines[end][:1] in (" ", "\t") and lines[end].strip() != "":
+                        end += 1
+                    return lines[:i] + [new_line] + lines[end:]
+        
+        if start == None:
+            return lines + ["", "[%s]" % section, new_line]
+        
+        # Add the option after the last option in the section
+        end = start
+        for i in range(start, len(lines)):
+            if section_re.match(lines[i]) != None:
+                break
+            if lines[i].strip() != "" and not lines[i].startswith("#") and not lines[i].startswith(";"):
+                end = i + 1
+        return lines[:end] + [new_line] + lines[end:]
+
             
         
\ No newline at end of file
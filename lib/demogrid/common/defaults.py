@@ -1,4 +1,7 @@
 import os.path
 
 CONFIG_FILE = os.path.expanduser("~/.demogrid/demogrid.conf")
-GENERATED_LOCATION = os.path.expanduser("~/.demogrid/generated")
\ No newline at end of file
+GENERATED_LOCATION = os.path.expanduser("~/.demogrid/generated")
+
+# Manifest of the files uploaded to the Chef directory of an EC2 instance
+CHEF_MANIFEST = "/chef/.demogrid-manifest"
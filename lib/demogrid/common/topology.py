@@ -20,6 +20,9 @@ class DGGrid(object):
 
     def add_node(self, node):
         self.grid_nodes.append(node)
+
+    def remove_node(self, node):
+        self.grid_nodes.remove(node)
         
     def get_nodes(self):
         nodes = self.grid_nodes[:]
@@ -27,6 +30,16 @@ class DGGrid(object):
             nodes += org.get_nodes()
         return nodes
     
+    def get_nodes_by(self, role = None, org_name = None):
+        """Returns the nodes with the given role and/or
+        in the given organization"""
+        nodes = self.get_nodes()
+        if role != None:
+            nodes = [n for n in nodes if n.role == role]
+        if org_name != None:
+            nodes = [n for n in nodes if n.org != None and n.org.name == org_name]
+        return nodes
+    
     def get_node_by_id(self, host_id):
         nodes = self.get_nodes()
         node = [n for n in nodes if n.demogrid_host_id == host_id]
@@ -151,6 +164,17 @@ class DGOrganization(object):
         return self.users
     
 class DGNode(object):
+    
+    # Roles that don't depend on any other node
+    NO_DEPS_ROLES = ("org-server", "grid-auth")
+    
+    # Other nodes in the organization (besides the org server) that must
+    # have been configured before a node with these roles can converge.
+    # Cluster nodes register with their LRM head node. The auth node is
+    # only referenced by hostname, so nobody has to wait for it.
+    ROLE_DEPENDS = {"org-clusternode-pbs": ("lrm",),
+                    "org-clusternode-condor": ("lrm",)}
+    
     def __init__(self, role, ip, hostname, org = None):
         self.role = role
         self.ip = ip
@@ -159,6 +183,18 @@ class DGNode(object):
         self.demogrid_host_id = hostname.split(".")[0]
         self.org = org
         self.attrs = {}
+
+    def get_depends(self):
+        """Returns the nodes that must be up (and configured)
+        before this node's role can be configured."""
+        if self.role in self.NO_DEPS_ROLES:
+            return []
+        depends = [self.org.server]
+        for attr in self.ROLE_DEPENDS.get(self.role, ()):
+            dep = getattr(self.org, attr)
+            if dep != None and dep != self and not dep in depends:
+                depends.append(dep)
+        return depends
         
 class DGOrgUser(object):
     def __init__(self, login, description, gridenabled, password, password_hash, auth_type=None):
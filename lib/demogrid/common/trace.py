@@ -0,0 +1,110 @@
+'''
+Created on Jan 17, 2011
+
+@author: borja
+'''
+
+import threading
+import time
+import json
+
+# Spans are recorded on "tracks" (one per node, plus one for the
+# launcher itself). Each thread records its spans on the track it has
+# set with set_track(), unless a track is given explicitly.
+
+_lock = threading.Lock()
+_local = threading.local()
+_spans = []
+_t0 = time.time()
+
+def reset():
+    global _spans, _t0
+    with _lock:
+        _spans = []
+        _t0 = time.time()
+
+def set_track(track):
+    _local.track = track
+
+def get_track():
+    return getattr(_local, "track", threading.current_thread().name)
+
+def add(name, category, start, end, track = None, args = None):
+    if track == None:
+        track = get_track()
+    with _lock:
+        _spans.append((track, name, category, start, end, args or {}))
+
+class span(object):
+    """Context manager that records a span around a block of code"""
+
+    def __init__(self, name, category, track = None, **args):
+        self.name = name
+        self.category = category
+        self.track = track
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type != None:
+            self.args["error"] = exc_type.__name__
+        add(self.name, self.category, self.start, time.time(), self.track, self.args)
+        return False
+
+def save_chrome_trace(filename):
+    """Saves the spans in the Chrome trace event format, which
+    can be loaded in chrome://tracing or in Perfetto"""
+    with _lock:
+        spans = _spans[:]
+
+    tids = {}
+    events = []
+    for track, name, category, start, end, args in spans:
+        if not tids.has_key(track):
+            tids[track] = len(tids) + 1
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tids[track],
+                           "args": {"name": track}})
+        events.append({"name": name, "cat": category, "ph": "X", "pid": 1, "tid": tids[track],
+                       "ts": int((start - _t0) * 1000000), "dur": int((end - start) * 1000000),
+                       "args": args})
+
+    f = open(filename, "w")
+    json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    f.close()
+
+def summary(top = 10):
+    """Returns a table with the slowest tracks, the time spent in
+    each category of span, and the slowest spans"""
+    with _lock:
+        spans = _spans[:]
+
+    tracks = {}
+    categories = {}
+    for track, name, category, start, end, args in spans:
+        first, last = tracks.get(track, (start, end))
+        tracks[track] = (min(first, start), max(last, end))
+        count, total, longest = categories.get(category, (0, 0.0, 0.0))
+        categories[category] = (count + 1, total + (end - start), max(longest, end - start))
+
+    s = "Slowest nodes:\n"
+    s += "  %-30s %10s %10s\n" % ("Node", "Start", "Duration")
+    by_duration = sorted(tracks.items(), key = lambda item: item[1][1] - item[1][0], reverse = True)
+    for track, (first, last) in by_duration[:top]:
+        s += "  %-30s %9.1fs %9.1fs\n" % (track, first - _t0, last - first)
+
+    s += "\nTime per phase:\n"
+    s += "  %-30s %10s %10s %10s\n" % ("Phase", "Count", "Total", "Longest")
+    by_total = sorted(categories.items(), key = lambda item: item[1][1], reverse = True)
+    for category, (count, total, longest) in by_total:
+        s += "  %-30s %10i %9.1fs %9.1fs\n" % (category, count, total, longest)
+
+    s += "\nSlowest steps:\n"
+    s += "  %-30s %-40s %10s\n" % ("Node", "Step", "Duration")
+    by_span = sorted(spans, key = lambda sp: sp[4] - sp[3], reverse = True)
+    for track, name, category, start, end, args in by_span[:top]:
+        s += "  %-30s %-40s %9.1fs\n" % (track, name[:40], end - start)
+
+    return s
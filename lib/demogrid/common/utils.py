@@ -5,146 +5,212 @@ Created on Dec 6, 2010
 '''
 
 import threading
-import paramiko
 import operator
 import traceback
 import select
 import sys
 import time
-from boto.ec2.connection import EC2Connection
 from os import walk, environ
 import socket    
-from demogrid.common import log
+from demogrid.common import log, trace
 import os
-import signal
+import hashlib
+import heapq
         
 class ThreadAbortException(Exception):
     pass
         
-class DemoGridThread (threading.Thread):
-    def __init__ (self, multi, name, depends = None):
-        threading.Thread.__init__(self)
-        self.multi = multi
+class DemoGridTask(object):
+    """A unit of work run by a TaskScheduler, in its own thread.
+    
+    A task can depend on any number of other tasks, and will only run
+    once all of them have finished successfully. Each task belongs to a
+    resource class (see TaskScheduler), and has an estimated cost that
+    is used to run the tasks on the critical path first."""
+    
+    def __init__(self, name, depends = [], resource = None, cost = 1.0):
         self.name = name
+        self.depends = list(depends)
+        self.resource = resource
+        self.cost = cost
+        self.scheduler = None
         self.exception = None
         self.status = -1
-        self.depends = depends
         
     def check_continue(self):
-        if self.multi.abort.is_set():
+        if self.scheduler.abort.is_set():
             raise ThreadAbortException()
         
     def run2(self):
         pass
-        
-    def run(self):
-        try:
-            self.run2()
-            self.status = 0
-        except Exception, e:
-            self.exception = e
-            self.status = 1
-            self.multi.thread_failure(self)
-            
-        if self.status == 0:
-            self.multi.thread_success(self)
 
-class MultiThread(object):
-    def __init__(self):
-        self.num_threads = 0
-        self.done_threads = 0
-        self.threads = {}
+
+class TaskScheduler(object):
+    """Runs a DAG of DemoGridTasks.
+    
+    Tasks are grouped into resource classes, and each class can have a
+    limit on how many of its tasks run at the same time (e.g., how many
+    concurrent EC2 API calls or SSH sessions we allow). When several tasks
+    are ready to run, the ones with the longest path to the end of the
+    DAG (the critical path) are run first.
+    
+    If a task fails, the scheduler aborts: tasks that haven't started
+    are not run, and running tasks will stop at their next call to
+    check_continue()."""
+    
+    # Resource classes
+    EC2 = "ec2"
+    SSH = "ssh"
+    CPU = "cpu"
+    DISK = "disk"
+    HTTP = "http"
+    
+    def __init__(self, limits = {}):
+        # Maximum number of running tasks per resource class
+        # (a class that doesn't appear here has no limit)
+        self.limits = dict(limits)
+        self.tasks = {}
         self.lock = threading.Lock()
         self.all_done = threading.Event()
         self.abort = threading.Event()
+        self.num_done = 0
 
-    def add_thread(self, thread):
-        self.threads[thread.name] = thread     
-        self.num_threads += 1
+    def add_task(self, task):
+        task.scheduler = self
+        self.tasks[task.name] = task
 
     def run(self):
-        self.done_threads = 0
-        for t in [th for th in self.threads.values() if th.depends == None]:
-            t.start()
-        self.all_done.wait()
+        tasks = self.tasks.values()
         
-    def thread_success(self, thread):
-        with self.lock:
-            self.done_threads += 1
-            log.debug("%s thread has finished successfully." % thread.name)
-            log.debug("%i threads are done. Remaining: %s" % (self.done_threads, ",".join([t.name for t in self.threads.values() if t.status == -1])))
-            for t in [th for th in self.threads.values() if th.depends == thread]:
-                t.start()            
-            if self.done_threads == self.num_threads:
-                self.all_done.set()            
+        # Dependents of each task, and the number of unfinished
+        # dependencies of each task
+        self.dependents = dict([(t, []) for t in tasks])
+        self.pending_deps = {}
+        for t in tasks:
+            self.pending_deps[t] = len(t.depends)
+            for d in t.depends:
+                self.dependents[d].append(t)
+        
+        # Priority of each task: the cost of the most expensive
+        # path from the task to the end of the DAG.
+        self.priority = {}
+        for t in self.__topological_order(tasks)[::-1]:
+            self.priority[t] = t.cost + max([0] + [self.priority[d] for d in self.dependents[t]])
 
-    def thread_failure(self, thread):
+        self.num_done = 0
+        self.running = {}
+        self.ready = {}
+        self.started = set()
+        self.all_done.clear()
+        
+        if len(tasks) == 0:
+            return
+        
         with self.lock:
-            if not isinstance(thread.exception, ThreadAbortException):
-                log.debug("%s thread has failed." % thread.name)
-                self.abort.set()
-            else:
-                log.debug("%s thread is being aborted." % thread.name)
-                thread.status = 2
-            self.done_threads += 1
-            log.debug("%i threads are done. Remaining: %s" % (self.done_threads, ",".join([t.name for t in self.threads.values() if t.status == -1])))
-            if self.done_threads == self.num_threads:
-                self.all_done.set()           
-                
+            for t in tasks:
+                if self.pending_deps[t] == 0:
+                    self.__add_ready(t)
+            self.__start_ready()
+        
+        # Wait with a timeout, so the main thread can still get signals
+        try:
+            while not self.all_done.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        
+    def cancel(self):
+        """Stops the scheduler: tasks that haven't started will not be run,
+        and running tasks will stop at their next call to check_continue()."""
+        with self.lock:
+            self.abort.set()
+            self.__abort_pending()
+        
     def all_success(self):
-        return all([t.status == 0 for t in self.threads.values()])
+        return all([t.status == 0 for t in self.tasks.values()])
         
     def get_exceptions(self):
-        return dict([(t.name, t.exception) for t in self.threads.values() if t.status == 1]) 
+        return dict([(t.name, t.exception) for t in self.tasks.values() if t.status == 1]) 
 
-# From http://code.activestate.com/recipes/496735-workaround-for-missed-sigint-in-multithreaded-prog/
-# Modified so it will run a cleanup function
-class SIGINTWatcher(object):
-    """this class solves two problems with multithreaded
-    programs in Python, (1) a signal might be delivered
-    to any thread (which is just a malfeature) and (2) if
-    the thread that gets the signal is waiting, the signal
-    is ignored (which is a bug).
+    def __topological_order(self, tasks):
+        order = []
+        pending = dict([(t, len(t.depends)) for t in tasks])
+        queue = [t for t in tasks if pending[t] == 0]
+        while len(queue) > 0:
+            t = queue.pop()
+            order.append(t)
+            for d in self.dependents[t]:
+                pending[d] -= 1
+                if pending[d] == 0:
+                    queue.append(d)
+        if len(order) != len(tasks):
+            raise Exception("Task dependencies have a cycle")
+        return order
 
-    The watcher is a concurrent process (not thread) that
-    waits for a signal and the process that contains the
-    threads.  See Appendix A of The Little Book of Semaphores.
-    http://greenteapress.com/semaphores/
+    def __add_ready(self, task):
+        heapq.heappush(self.ready.setdefault(task.resource, []), (-self.priority[task], task.name, task))
 
-    I have only tested this on Linux.  I would expect it to
-    work on the Macintosh and not work on Windows.
-    """
-    
-    def __init__(self, cleanup_func):
-        """ Creates a child thread, which returns.  The parent
-            thread waits for a KeyboardInterrupt and then kills
-            the child thread.
-        """
-        self.cleanup_func = cleanup_func
-        self.child = os.fork()
-        if self.child == 0:
-            return
-        else:
-            self.watch()
+    def __start_ready(self):
+        # Must be called with the lock held
+        for resource, ready in self.ready.items():
+            limit = self.limits.get(resource)
+            while len(ready) > 0 and (limit == None or self.running.get(resource, 0) < limit):
+                priority, name, task = heapq.heappop(ready)
+                self.running[resource] = self.running.get(resource, 0) + 1
+                self.started.add(task)
+                thread = threading.Thread(target=self.__run_task, args=(task,), name=task.name)
+                # Don't keep the process alive for tasks that
+                # are stuck when the scheduler is cancelled
+                thread.daemon = True
+                thread.start()
 
-    def watch(self):
+    def __run_task(self, task):
         try:
-            os.wait()
-        except KeyboardInterrupt:
-            self.cleanup_func()
-            self.kill()
-        sys.exit()
+            task.run2()
+            task.status = 0
+        except Exception, e:
+            task.exception = e
+            task.status = 1
 
-    def kill(self):
-        try:
-            os.kill(self.child, signal.SIGKILL)
-        except OSError: pass
-        
+        with self.lock:
+            self.num_done += 1
+            self.running[task.resource] -= 1
+            if task.status == 0:
+                log.debug("%s task has finished successfully." % task.name)
+                for d in self.dependents[task]:
+                    self.pending_deps[d] -= 1
+                    if self.pending_deps[d] == 0:
+                        self.__add_ready(d)
+            elif isinstance(task.exception, ThreadAbortException):
+                log.debug("%s task has been aborted." % task.name)
+                task.status = 2
+            else:
+                log.debug("%s task has failed." % task.name)
+                self.abort.set()
+
+            if self.abort.is_set():
+                self.__abort_pending()
+            else:
+                self.__start_ready()
+            log.debug("%i tasks are done. Remaining: %i" % (self.num_done, len(self.tasks) - self.num_done))
+            if self.num_done == len(self.tasks):
+                self.all_done.set()
+                
+    def __abort_pending(self):
+        # Must be called with the lock held. Tasks that haven't
+        # started will never run, so they are counted as aborted.
+        self.ready = {}
+        for t in self.tasks.values():
+            if not t in self.started and t.status == -1:
+                t.status = 2
+                self.num_done += 1
 
 class SSHCommandFailureException(Exception):
-    def __init__(self, ssh, command):
+    def __init__(self, ssh, command, output = None):
         self.ssh = ssh
         self.command = command
+        self.output = output
         
         
 class SSH(object):
@@ -157,42 +223,53 @@ class SSH(object):
         self.port = port
         
     def open(self):
+        # Not imported at module level, so the modules that only need
+        # the task scheduler don't have to load paramiko
+        import paramiko
         key = paramiko.RSAKey.from_private_key_file(self.key_path)
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         connected = False
-        while not connected:
-            try:
-                self.client.connect(self.hostname, self.port, self.username, pkey=key)
-                connected = True
-            except socket.error, e:
-                if e.errno == 111: # Connection refused
-                    time.sleep(2)
-                else:
+        with trace.span("ssh-connect", "ssh-connect"):
+            while not connected:
+                try:
+                    self.client.connect(self.hostname, self.port, self.username, pkey=key)
+                    connected = True
+                except socket.error, e:
+                    if e.errno == 111: # Connection refused
+                        time.sleep(2)
+                    else:
+                        time.sleep(2)
+                except EOFError, e:
                     time.sleep(2)
-            except EOFError, e:
-                time.sleep(2)
         self.sftp = paramiko.SFTPClient.from_transport(self.client.get_transport())    
         
     def close(self):
         self.client.close()
         
     def run(self, command, outf=None, errf=None, exception_on_error = True, expectnooutput=False):
+        t_start = time.time()
         channel = self.client.get_transport().open_session()
         
         log.debug("%s - Running %s" % (self.hostname,command))
         
+        # Only the files opened here are closed when we're done
+        # (the default ones may be shared by several commands)
+        close_outf = False
+        close_errf = False
         if expectnooutput:
             outf = None
             errf = None
         else:
             if outf != None:
                 outf = open(outf, "w")
+                close_outf = True
             else:
                 outf = self.default_outf
         
             if errf != None:
                 errf = open(errf, "w")
+                close_errf = True
             else:
                 errf = self.default_errf
             
@@ -204,21 +281,22 @@ class SSH(object):
                     rl, wl, xl = select.select([channel],[],[])
                     if len(rl) > 0:
                         # Must be stdout
-                        x = channel.recv(1)
+                        x = channel.recv(4096)
                         if not x: break
                         outf.write(x)
                         outf.flush()
                 
-                if outf != sys.stdout:
+                if close_outf:
                     outf.close()
                     
-                if errf != sys.stderr:
-                    outf.close()
+                if close_errf:
+                    errf.close()
             
             log.debug("%s - Waiting for exit status: %s" % (self.hostname,command))
             rc = channel.recv_exit_status()
             log.debug("%s - Ran %s" % (self.hostname,command))
             channel.close()
+            trace.add(command, self.__trace_category(command), t_start, time.time(), args = {"rc": rc})
         except Exception, e:
             raise # Replace by something more meaningful
          
@@ -226,13 +304,113 @@ class SSH(object):
             raise SSHCommandFailureException(self, command)
         else:
             return rc
+
+    # Marker used to delimit the steps of a batch in the remote output
+    BATCH_MARKER = "@@DEMOGRID-BATCH@@"
+
+    def run_batch(self, commands, outf=None, expectnooutput=False):
+        """Runs a sequence of commands as a single remote script, using
+        a single channel (instead of one channel per command).
+        
+        The commands are run in order and the batch stops at the first
+        command that fails, in which case an SSHCommandFailureException
+        is raised for that command (with its output). Returns a list of
+        (command, rc, elapsed seconds) tuples, one per command."""
+        if len(commands) == 0:
+            return []
+        
+        script = "exec 2>&1\n"
+        for i, command in enumerate(commands):
+            script += "echo '%s START %i'\n" % (self.BATCH_MARKER, i)
+            script += "__dg_t0=$(date +%s%N)\n"
+            script += "(\n%s\n)\n" % command
+            script += "__dg_rc=$?\n"
+            script += "echo \"%s END %i $__dg_rc $(( ($(date +%%s%%N) - __dg_t0) / 1000000 ))\"\n" % (self.BATCH_MARKER, i)
+            script += "[ $__dg_rc -eq 0 ] || exit $__dg_rc\n"
+
+        close_outf = False
+        if expectnooutput:
+            outf = None
+        elif outf != None:
+            outf = open(outf, "w")
+            close_outf = True
+        else:
+            outf = self.default_outf
+
+        log.debug("%s - Running batch: %s" % (self.hostname, "; ".join(commands)))
+
+        channel = self.client.get_transport().open_session()
+        channel.exec_command("bash -s")
+        channel.sendall(script)
+        channel.shutdown_write()
+        
+        results = []
+        outputs = [""] * len(commands)
+        starts = [None] * len(commands)
+        current = None
+        pending = ""
+        while True:
+            data = channel.recv(4096)
+            if data:
+                pending += data
+                lines = pending.split("\n")
+                pending = lines.pop()
+            elif pending != "":
+                lines = [pending]
+            else:
+                lines = []
+            for line in lines:
+                # A command whose output doesn't end in a newline will
+                # have the marker appended to its last line.
+                pos = line.find(self.BATCH_MARKER)
+                if pos == -1:
+                    text = line + "\n"
+                else:
+                    text = line[:pos]
+                if current != None and text != "":
+                    outputs[current] += text
+                    if outf != None:
+                        outf.write(text)
+                        outf.flush()
+                if pos != -1:
+                    fields = line[pos:].split()
+                    if fields[1] == "START":
+                        current = int(fields[2])
+                        starts[current] = time.time()
+                    elif fields[1] == "END":
+                        step = int(fields[2])
+                        results.append((commands[step], int(fields[3]), int(fields[4]) / 1000.0))
+                        trace.add(commands[step], self.__trace_category(commands[step]), starts[step], time.time(), 
+                                  args = {"rc": int(fields[3]), "remote_elapsed": results[-1][2]})
+                        log.debug("%s - Ran %s (rc=%s, %ss)" % (self.hostname, commands[step], fields[3], results[-1][2]))
+                        current = None
+            if not data:
+                break
+
+        rc = channel.recv_exit_status()
+        channel.close()
+        if close_outf:
+            outf.close()
+        
+        if rc != 0:
+            # Either the last command we got a result for failed, or the
+            # script died in the middle of a command.
+            if len(results) > 0 and results[-1][1] != 0:
+                step = len(results) - 1
+            else:
+                step = len(results)
+            step = min(step, len(commands) - 1)
+            raise SSHCommandFailureException(self, commands[step], outputs[step])
+        
+        return results
     
 
         
         
     def scp(self, fromf, tof):
         try:
-            self.sftp.put(fromf, tof)
+            with trace.span("upload %s" % tof, "upload"):
+                self.sftp.put(fromf, tof)
         except Exception, e:
             traceback.print_exc()
             try:
@@ -251,12 +429,139 @@ class SSH(object):
             for f in files:
                 fromfile = root + "/" + f
                 tofile = todir_full + "/" + f
-                self.sftp.put(fromfile, tofile)
+                with trace.span("upload %s" % tofile, "upload"):
+                    self.sftp.put(fromfile, tofile)
                 log.debug("scp %s -> %s:%s" % (fromfile, self.hostname, tofile))
 
+    def sync(self, files, manifest, delete = False):
+        """Uploads a list of (local file, remote file) pairs, skipping
+        the files whose content is already on the remote host.
+        
+        The remote host keeps a manifest (one "hash path" line per file)
+        of the files that have been uploaded to it. Only files that are
+        missing from the manifest, or whose hash has changed, are
+        transferred. If 'delete' is true, files in the manifest that
+        are not in the list are removed from the remote host.
+        Returns a (bytes sent, bytes saved) tuple."""
+        remote_hashes = self.__read_manifest(manifest)
+        
+        sent = 0
+        saved = 0
+        remote_dirs = set()
+        for fromfile, tofile in files:
+            tofile = os.path.normpath(tofile)
+            h = file_hash(fromfile)
+            size = os.path.getsize(fromfile)
+            if remote_hashes.get(tofile) == h:
+                saved += size
+                continue
+            
+            self.__mkdirs(os.path.dirname(tofile), remote_dirs)
+            with trace.span("upload %s" % tofile, "upload", bytes = size):
+                self.sftp.put(fromfile, tofile)
+            log.debug("scp %s -> %s:%s" % (fromfile, self.hostname, tofile))
+            remote_hashes[tofile] = h
+            sent += size
+        
+        removed = 0
+        if delete:
+            wanted = set([os.path.normpath(tofile) for fromfile, tofile in files])
+            for path in [p for p in remote_hashes.keys() if not p in wanted]:
+                try:
+                    self.sftp.remove(path)
+                except IOError, e:
+                    # Already gone
+                    pass
+                log.debug("rm %s:%s" % (self.hostname, path))
+                del remote_hashes[path]
+                removed += 1
+        
+        if sent > 0 or removed > 0:
+            self.__write_manifest(manifest, remote_hashes)
+        
+        log.debug("%s - Synced %i files. %i bytes sent, %i bytes already up to date." % (self.hostname, len(files), sent, saved))
+        return sent, saved
+
+    def record(self, files, manifest):
+        """Adds a list of (local file, remote file) pairs to the manifest
+        used by sync(), for files that were put on the remote host by
+        other means (e.g., extracted from an archive)."""
+        remote_hashes = self.__read_manifest(manifest)
+        for fromfile, tofile in files:
+            remote_hashes[os.path.normpath(tofile)] = file_hash(fromfile)
+        self.__write_manifest(manifest, remote_hashes)
+
+    def __read_manifest(self, manifest):
+        remote_hashes = {}
+        try:
+            f = self.sftp.open(manifest, "r")
+            for line in f.read().splitlines():
+                fields = line.split(" ", 1)
+                if len(fields) == 2:
+                    remote_hashes[fields[1]] = fields[0]
+            f.close()
+        except IOError, e:
+            # No manifest yet
+            pass
+        return remote_hashes
+
+    def __write_manifest(self, manifest, remote_hashes):
+        f = self.sftp.open(manifest, "w")
+        f.write("".join(["%s %s\n" % (h, path) for path, h in sorted(remote_hashes.items())]))
+        f.close()
+
+    def __trace_category(self, command):
+        if "chef-solo" in command:
+            return "chef"
+        else:
+            return "command"
+
+    def __mkdirs(self, todir, known_dirs):
+        if todir in known_dirs or todir in ("", "/"):
+            return
+        try:
+            self.sftp.stat(todir)
+        except IOError, e:
+            self.__mkdirs(os.path.dirname(todir), known_dirs)
+            self.sftp.mkdir(todir)
+        known_dirs.add(todir)
+    
+    
+def dir_files(fromdir, todir):
+    """Returns the (local file, remote file) pairs needed to
+    upload the contents of fromdir into todir with SSH.sync()"""
+    files = []
+    for root, dirs, filenames in walk(fromdir):
+        todir_full = todir + "/" + root[len(fromdir):]
+        for f in filenames:
+            files.append((root + "/" + f, todir_full + "/" + f))
+    return files
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    f = open(filename, "rb")
+    while True:
+        data = f.read(65536)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+    
+def tree_hash(files):
+    """Returns a hash of the contents (and remote paths) of a list
+    of (local file, remote file) pairs, as returned by dir_files()"""
+    h = hashlib.sha1()
+    for fromfile, tofile in sorted(files, key = lambda f: f[1]):
+        h.update("%s %s\n" % (file_hash(fromfile), os.path.normpath(tofile)))
+    return h.hexdigest()
     
 def create_ec2_connection():
+    """Returns a connection to EC2, wrapped in an EC2Gateway (so it can
+    safely be used from many threads at once)."""
+    from demogrid.ec2.gateway import EC2Gateway
     if not (environ.has_key("AWS_ACCESS_KEY_ID") and environ.has_key("AWS_SECRET_ACCESS_KEY")):
         return None
     else:
-        return EC2Connection()
\ No newline at end of file
+        from boto.ec2.connection import EC2Connection
+        return EC2Gateway(EC2Connection())
\ No newline at end of file
@@ -0,0 +1,286 @@
+'''
+Created on Jan 10, 2011
+
+@author: borja
+'''
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from demogrid.common.utils import file_hash
+from demogrid.common import log, trace
+import threading
+import hashlib
+import hmac
+import os
+import time
+
+# Passed to each instance as user-data. The instance identifies itself
+# with its instance ID, and uses the token (which is specific to the
+# reservation it belongs to) to authenticate itself to the artifact server.
+BOOTSTRAP_SCRIPT = """#!/bin/bash
+SERVER=%(server)s
+TOKEN=%(token)s
+LOG=/var/log/demogrid-bootstrap.log
+exec > $LOG 2>&1
+
+ID=`wget -q -O - http://169.254.169.254/latest/meta-data/instance-id`
+BASE=$SERVER/$TOKEN/$ID
+
+# The manifest is only available once all the instances are running
+# and the nodes this node depends on have been configured.
+until wget -q -O /tmp/demogrid-manifest $BASE/manifest; do
+    sleep 5
+done
+
+configure() {
+    set -e
+    MOUNT=no
+    while read KIND VALUE REST; do
+        case $KIND in
+            hostname) NEWHOSTNAME=$VALUE ;;
+            role) ROLE=$VALUE ;;
+            mount) MOUNT=$VALUE ;;
+        esac
+    done < /tmp/demogrid-manifest
+
+    if [ "$MOUNT" = "yes" ]; then
+        while [ ! -e /dev/sdh ]; do sleep 2; done
+        mount -t ext3 /dev/sdh /chef
+    fi
+
+    grep "^file " /tmp/demogrid-manifest | while read KIND HASH DEST NAME; do
+        mkdir -p `dirname $DEST`
+        wget -q -O $DEST $BASE/files/$NAME
+        echo "$HASH  $DEST" | sha1sum -c
+    done
+
+    cp /chef/cookbooks/demogrid/files/default/hosts /etc/hosts
+    echo $NEWHOSTNAME > /etc/hostname
+    /etc/init.d/hostname restart
+
+    echo "{ \\"run_list\\": \\"role[$ROLE]\\" }" > /tmp/chef.json
+    chef-solo -c /chef/chef.conf -j /tmp/chef.json
+
+    # The Chef recipes will overwrite the hostname, so
+    # we need to set it again.
+    echo $NEWHOSTNAME > /etc/hostname
+    /etc/init.d/hostname restart
+    update-rc.d nis enable
+
+    if [ "$MOUNT" = "yes" ]; then
+        umount /chef
+    fi
+}
+
+( configure )
+RC=$?
+tail -n 50 $LOG > /tmp/demogrid-report
+until wget -q -O /dev/null --post-file=/tmp/demogrid-report $BASE/report/$RC; do
+    sleep 5
+done
+"""
+
+def compare_digest(a, b):
+    """Compares two strings in constant time (so the time taken doesn't
+    tell how much of a token was right). Same as hmac.compare_digest,
+    which is only available in Python 2.7.7 and later."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+if hasattr(hmac, "compare_digest"):
+    compare_digest = hmac.compare_digest
+
+class BootstrapFailureException(Exception):
+    def __init__(self, node, rc, output):
+        self.node = node
+        self.rc = rc
+        self.output = output
+
+    def __str__(self):
+        return "Bootstrap script exited with code %i" % self.rc
+
+
+class BootstrapTimeoutException(Exception):
+    def __init__(self, node, timeout):
+        self.node = node
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Instance hasn't been heard from in %i seconds" % self.timeout
+
+
+class ArtifactServer(object):
+    """HTTP server that instances launched in pull mode get their
+    files from (and report back to once they have configured themselves).
+
+    Each instance gets a manifest listing the files it has to download
+    (with their hashes). A node's manifest is only handed out once it has
+    been published, and all the nodes it depends on have reported
+    that they were configured successfully.
+
+    A node fails if nothing is heard from it for 'timeout' seconds: its
+    instance never asks for its manifest (e.g., because it didn't boot),
+    or never reports back after getting it (e.g., because the bootstrap
+    script died)."""
+
+    def __init__(self, port, timeout = 3600):
+        self.port = port
+        self.timeout = timeout
+        self.secret = os.urandom(20).encode("hex")
+        self.files = {}
+        self.nodes = {}
+        self.manifests = {}
+        self.depends = {}
+        self.results = {}
+        self.published = {}
+        # When each node was last heard from
+        self.contact = {}
+        self.cond = threading.Condition()
+        self.httpd = None
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("", self.port), ArtifactRequestHandler)
+        self.httpd.artifact_server = self
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        log.info("Artifact server listening on port %i" % self.port)
+
+    def stop(self):
+        if self.httpd != None:
+            self.httpd.shutdown()
+            self.httpd = None
+
+    def get_token(self, role):
+        return hmac.new(self.secret, role, hashlib.sha1).hexdigest()
+
+    def get_user_data(self, server_url, role):
+        return BOOTSTRAP_SCRIPT % {"server": server_url,
+                                   "token": self.get_token(role)}
+
+    def add_file(self, name, path):
+        self.files[name] = (path, file_hash(path))
+
+    def publish(self, instance_id, node, files, mount, depends = None):
+        """Makes the manifest for a node available. files is a list of
+        (file name, remote path) pairs, where the file name must have been
+        added with add_file()."""
+        manifest = "hostname %s\n" % node.hostname
+        manifest += "role %s\n" % node.role
+        if mount:
+            manifest += "mount yes\n"
+        for name, remote in files:
+            manifest += "file %s %s %s\n" % (self.files[name][1], remote, name)
+        with self.cond:
+            self.nodes[instance_id] = node
+            self.manifests[instance_id] = manifest
+            self.depends[instance_id] = depends
+            self.published[instance_id] = time.time()
+            self.contact[instance_id] = time.time()
+
+    def wait(self, check_continue = None):
+        """Waits until every node has reported back, or until one of
+        them fails or times out (since the nodes that depend on it will
+        never report back). Returns a dict mapping nodes to exceptions,
+        for the nodes that failed."""
+        with self.cond:
+            while len(self.results) < len(self.nodes) and not any(self.results.values()):
+                self.cond.wait(2.0)
+                if check_continue != None:
+                    check_continue()
+                now = time.time()
+                for instance_id, node in self.nodes.items():
+                    if not self.results.has_key(instance_id) and now - self.contact[instance_id] > self.timeout:
+                        log.info("Configuration timed out.", node)
+                        self.results[instance_id] = BootstrapTimeoutException(node, self.timeout)
+            return dict([(self.nodes[i], e) for i, e in self.results.items() if e != None])
+
+    def _authenticate(self, token, instance_id):
+        node = self.nodes.get(instance_id)
+        if node == None:
+            return None
+        if not compare_digest(token, self.get_token(node.role)):
+            return None
+        return node
+
+    def _get_manifest(self, instance_id):
+        with self.cond:
+            # The instance stops asking once it has its manifest, so the
+            # timeout is counted from then while it configures itself
+            self.contact[instance_id] = time.time()
+            depends = self.depends.get(instance_id)
+            if depends != None:
+                results = [(i, e) for i, e in self.results.items() if self.nodes[i] == depends]
+                if len(results) == 0 or results[0][1] != None:
+                    return None
+            return self.manifests.get(instance_id)
+
+    def _report(self, instance_id, rc, output):
+        node = self.nodes[instance_id]
+        trace.add("bootstrap", "bootstrap", self.published[instance_id], time.time(), 
+                  track = node.demogrid_host_id, args = {"rc": rc})
+        with self.cond:
+            if rc == 0:
+                self.results[instance_id] = None
+                log.info("Configuration done.", node)
+            else:
+                self.results[instance_id] = BootstrapFailureException(node, rc, output)
+                log.info("Configuration failed.", node)
+            self.cond.notify_all()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ArtifactRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server.artifact_server
+        fields = self.path.strip("/").split("/")
+        if len(fields) < 3:
+            return self.send_error(404)
+        token, instance_id, what = fields[0], fields[1], fields[2]
+        node = server._authenticate(token, instance_id)
+        if node == None:
+            return self.send_error(403)
+
+        if what == "manifest":
+            manifest = server._get_manifest(instance_id)
+            if manifest == None:
+                # Not ready yet. The instance will keep trying.
+                return self.send_error(503)
+            self.__send(manifest)
+        elif what == "files" and len(fields) == 4 and server.files.has_key(fields[3]):
+            f = open(server.files[fields[3]][0], "rb")
+            self.__send(f.read())
+            f.close()
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        server = self.server.artifact_server
+        fields = self.path.strip("/").split("/")
+        if len(fields) != 4 or fields[2] != "report":
+            return self.send_error(404)
+        token, instance_id, rc = fields[0], fields[1], fields[3]
+        node = server._authenticate(token, instance_id)
+        if node == None:
+            return self.send_error(403)
+        length = int(self.headers.get("Content-Length", 0))
+        output = self.rfile.read(length)
+        server._report(instance_id, int(rc), output)
+        self.__send("")
+
+    def __send(self, data):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug("Artifact server: %s - %s" % (self.address_string(), format % args))
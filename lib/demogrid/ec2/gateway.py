@@ -0,0 +1,220 @@
+'''
+Created on Jan 26, 2011
+
+@author: borja
+'''
+from boto.exception import EC2ResponseError
+from demogrid.common import log
+import threading
+import random
+import time
+
+class TokenBucket(object):
+    """Allows up to 'rate' operations per second, with
+    bursts of up to 'burst' operations."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                delay = (1.0 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class _PendingCall(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class EC2Gateway(object):
+    """Wraps an EC2Connection, and makes sure we play nice with the
+    EC2 API when a lot of threads are making calls at the same time:
+
+    - Calls are rate-limited with a token bucket per API action.
+    - Throttling errors are retried with exponential backoff. Server
+      errors are only retried for Describe calls: a call that changes
+      something might have gone through before the error, and retrying
+      it could, e.g., launch the same instances twice.
+    - Identical Describe calls that are issued concurrently are
+      coalesced into a single request, and their results are cached
+      for a short time. Any other call invalidates the cache.
+
+    The gateway can be used wherever an EC2Connection is used. The boto
+    objects it returns (instances, volumes, etc.) are bound to the
+    gateway, so calls made through them (e.g., vol.attach()) also
+    go through the gateway."""
+
+    # Calls that don't change anything, and can be coalesced and cached
+    DESCRIBE_ACTIONS = ("get_all_instances", "get_all_volumes", "get_all_snapshots",
+                        "get_all_images", "get_image", "get_all_zones")
+
+    # Rate (calls per second) and burst size for each action.
+    # Actions not listed here get DEFAULT_RATE.
+    RATES = {"run_instances": (2, 5),
+             "terminate_instances": (2, 5),
+             "create_volume": (5, 10),
+             "create_snapshot": (2, 5),
+             "create_image": (1, 2)}
+    DEFAULT_RATE = (10, 20)
+
+    # Errors that are worth retrying. EC2 rejects throttled requests
+    # before doing anything, so they can always be retried. Server
+    # errors can happen after the request was carried out, so they
+    # are only retried for DESCRIBE_ACTIONS.
+    THROTTLE_CODES = ("RequestLimitExceeded", "Throttling")
+    SERVER_ERROR_CODES = ("ServiceUnavailable", "Unavailable", "InternalError")
+    MAX_RETRIES = 8
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30.0
+
+    # Maximum number of instances requested in a single RunInstances call
+    RUN_CHUNK_SIZE = 20
+
+    def __init__(self, conn, cache_ttl = 1.0):
+        self.conn = conn
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.cache = {}
+        self.inflight = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return call
+
+    def call(self, action, *args, **kwargs):
+        if action in self.DESCRIBE_ACTIONS:
+            return self.__describe(action, args, kwargs)
+        else:
+            # Any other call can change the state of something
+            with self.lock:
+                self.cache = {}
+            return self.__call(action, args, kwargs)
+
+    def run_instances_concurrently(self, requests):
+        """Issues several run_instances requests at the same time, each of
+        them split into chunks of at most RUN_CHUNK_SIZE instances.
+        'requests' is a list of (key, image_id, count, kwargs) tuples.
+
+        Returns two dicts: one mapping each key to the instances that
+        were launched for it (in order) and one mapping each key to
+        the exception raised by its failed chunk, if any. Instances in
+        other chunks are still returned, so they can be cleaned up."""
+        chunks = []
+        for key, image_id, count, kwargs in requests:
+            for start in range(0, count, self.RUN_CHUNK_SIZE):
+                size = min(self.RUN_CHUNK_SIZE, count - start)
+                chunks.append((key, start, image_id, size, kwargs))
+
+        results = {}
+        errors = {}
+        lock = threading.Lock()
+        def run_chunk(key, start, image_id, size, kwargs):
+            try:
+                reservation = self.call("run_instances", image_id, min_count = size, max_count = size, **kwargs)
+                with lock:
+                    results[(key, start)] = reservation.instances
+            except Exception, exc:
+                with lock:
+                    errors.setdefault(key, exc)
+
+        threads = [threading.Thread(target=run_chunk, args=chunk, name="run-instances-%s" % chunk[0]) for chunk in chunks]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # Join with a timeout, so the main thread can still get signals
+            while thread.is_alive():
+                thread.join(1.0)
+
+        instances = {}
+        for key, start in sorted(results.keys()):
+            instances.setdefault(key, []).extend(results[(key, start)])
+        return instances, errors
+
+    def __bucket(self, action):
+        with self.lock:
+            if not self.buckets.has_key(action):
+                rate, burst = self.RATES.get(action, self.DEFAULT_RATE)
+                self.buckets[action] = TokenBucket(rate, burst)
+            return self.buckets[action]
+
+    def __call(self, action, args, kwargs):
+        bucket = self.__bucket(action)
+        retry_codes = self.THROTTLE_CODES
+        if action in self.DESCRIBE_ACTIONS:
+            retry_codes += self.SERVER_ERROR_CODES
+        for attempt in range(self.MAX_RETRIES + 1):
+            bucket.acquire()
+            try:
+                return self.__bind(getattr(self.conn, action)(*args, **kwargs))
+            except EC2ResponseError, exc:
+                if not exc.error_code in retry_codes or attempt == self.MAX_RETRIES:
+                    raise
+                # Exponential backoff, with some jitter so that the
+                # threads that were throttled don't retry in lockstep
+                delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+                log.debug("EC2 returned %s for %s. Retrying in %.1fs." % (exc.error_code, action, delay))
+                time.sleep(delay)
+
+    def __describe(self, action, args, kwargs):
+        key = (action, repr(args), repr(sorted(kwargs.items())))
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached != None and time.time() - cached[0] < self.cache_ttl:
+                return cached[1]
+            pending = self.inflight.get(key)
+            owner = pending == None
+            if owner:
+                pending = _PendingCall()
+                self.inflight[key] = pending
+
+        if owner:
+            try:
+                pending.result = self.__call(action, args, kwargs)
+            except Exception, exc:
+                pending.error = exc
+            with self.lock:
+                del self.inflight[key]
+                if pending.error == None:
+                    self.cache[key] = (time.time(), pending.result)
+            pending.event.set()
+        else:
+            # Wait with a timeout, so the main thread can still get signals
+            while not pending.event.wait(1.0):
+                pass
+
+        if pending.error != None:
+            raise pending.error
+        return pending.result
+
+    def __bind(self, result):
+        # Make the returned boto objects use the gateway
+        if isinstance(result, list):
+            objs = result
+        else:
+            objs = [result]
+        for obj in objs:
+            if hasattr(obj, "connection"):
+                obj.connection = self
+            for instance in getattr(obj, "instances", []):
+                instance.connection = self
+        return result
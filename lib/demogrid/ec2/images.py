@@ -3,175 +3,465 @@ Created on Dec 6, 2010
 
 @author: borja
 '''
-from demogrid.common.utils import create_ec2_connection, SSH
+from demogrid.common.utils import create_ec2_connection, SSH, dir_files, tree_hash, DemoGridTask, TaskScheduler, ThreadAbortException
 from demogrid.common import log
+from boto.exception import EC2ResponseError
+from demogrid.ec2.poller import EC2Poller
+from demogrid.ec2.teardown import EC2Teardown
+import demogrid.common.defaults as defaults
+import json
+import os
+import re
 import time
 
 
 class EC2ChefVolumeCreator(object):
-    def __init__(self, demogrid_dir, ami, keypair, keyfile):
+    """Creates the snapshot with the Chef files that launches mount
+    on /chef (the [ec2] snap option).
+    
+    Snapshots are identified by a hash of the chef/ tree (which is
+    included in their description), so if there is already a snapshot
+    with the current Chef files, it is reused. Otherwise, the new
+    snapshot is built from the configuration's current snapshot (if
+    any), and only the files that have changed are uploaded."""
+    
+    DESCRIPTION = "DemoGrid Chef partition 0.2"
+    
+    def __init__(self, demogrid_dir, ami, keypair, keyfile, config = None):
         self.demogrid_dir = demogrid_dir
         self.ami = ami
         self.keypair = keypair
         self.keyfile = keyfile
+        self.config = config
 
     def run(self):
         conn = create_ec2_connection()
         
-        print "Creating instance"
-        reservation = conn.run_instances(self.ami, 
-                                         min_count=1, max_count=1,
-                                         instance_type='t1.micro', 
-                                         key_name=self.keypair)
-        instance = reservation.instances[0]
-        print "Instance %s created. Waiting for it to start..." % instance.id
-        
-        while instance.update() != "running":
-            time.sleep(2)
+        files = dir_files("%s/chef" % self.demogrid_dir, "/chef")
+        description = "%s (chef tree %s)" % (self.DESCRIPTION, tree_hash(files))
         
-        print "Instance running. Creating volume."
+        snap = self.find_snapshot(conn, description)
+        if snap != None:
+            print "The Chef files haven't changed since snapshot %s was created." % snap.id
+        else:
+            snap = self.create_snapshot(conn, files, description, self.get_previous_snapshot(conn))
         
-        vol = conn.create_volume(1, instance.placement)
-        vol.attach(instance.id, '/dev/sdh')
-        while vol.update() != "in-use":
-            time.sleep(2)
+        print "The snapshot ID is %s" % snap.id
         
-        print "Volume created."
+        if self.config != None and not (self.config.has_snap() and self.config.get_snap() == snap.id):
+            self.config.set_snap(snap.id)
+            self.config.save()
+            print "The snapshot has been added to %s" % self.config.configfile
 
-        ssh = SSH("ubuntu", instance.public_dns_name, self.keyfile)
-        ssh.open()
-        
-        print "Preparing volume."
-        ssh.scp("%s/lib/scripts/prepare_chef_volume.sh" % self.demogrid_dir,
-                "/tmp/prepare_chef_volume.sh")
-        
-        ssh.run("chmod u+x /tmp/prepare_chef_volume.sh")
+    def find_snapshot(self, conn, description):
+        """Returns our snapshot with the given description, if any"""
+        snaps = [s for s in conn.get_all_snapshots(owner="self") 
+                 if s.description == description and s.status != "error"]
+        if len(snaps) > 0:
+            return snaps[0]
+        else:
+            return None
 
-        ssh.run("sudo /tmp/prepare_chef_volume.sh")
-        
-        print "Copying Chef files."
-        ssh.scp_dir("%s/chef" % self.demogrid_dir, "/chef")
-                
-        ssh.run("sudo umount /chef")
-        
-        print "Detaching volume"
-        vol.detach()
-        while vol.update() != "available":
-            time.sleep(1)
+    def get_previous_snapshot(self, conn):
+        """Returns the ID of the snapshot in the configuration file,
+        if there is one and it still exists"""
+        if self.config == None or not self.config.has_snap():
+            return None
+        snap_id = self.config.get_snap()
+        try:
+            if len(conn.get_all_snapshots([snap_id])) == 1:
+                return snap_id
+        except EC2ResponseError, exc:
+            # The snapshot is gone
+            pass
+        return None
 
-        print "Creating snapshot"
-        snap = vol.create_snapshot("DemoGrid Chef partition 0.2")
-        snap.share(groups=['all'])
-        
-        vol.delete()
+    def create_snapshot(self, conn, files, description, previous = None):
+        poller = EC2Poller(conn)
+        poller.start()
+        instance = None
+        vol = None
+        try:
+            print "Creating instance"
+            reservation = conn.run_instances(self.ami, 
+                                             min_count=1, max_count=1,
+                                             instance_type='t1.micro', 
+                                             key_name=self.keypair)
+            instance = reservation.instances[0]
+            print "Instance %s created. Waiting for it to start..." % instance.id
+            instance = poller.wait(instance.id, "running")
+            
+            if previous != None:
+                print "Instance running. Creating volume from snapshot %s." % previous
+            else:
+                print "Instance running. Creating volume."
+            vol = conn.create_volume(1, instance.placement, previous)
+            poller.wait(vol.id, "available")
+            vol.attach(instance.id, '/dev/sdh')
+            poller.wait(vol.id, "in-use")
+            print "Volume created."
+    
+            ssh = SSH("ubuntu", instance.public_dns_name, self.keyfile)
+            ssh.open()
+            
+            if previous != None:
+                print "Mounting volume."
+                ssh.run("sudo mkdir /chef")
+                ssh.run("sudo mount -t ext3 /dev/sdh /chef")
+                ssh.run("sudo chown -R ubuntu /chef")
+            else:
+                print "Preparing volume."
+                ssh.scp("%s/lib/scripts/prepare_chef_volume.sh" % self.demogrid_dir,
+                        "/tmp/prepare_chef_volume.sh")
+                ssh.run("chmod u+x /tmp/prepare_chef_volume.sh")
+                ssh.run("sudo /tmp/prepare_chef_volume.sh")
+            
+            print "Copying Chef files."
+            # The manifest is stored in the snapshot, so launches (and
+            # the next snapshot built from this one) will only upload
+            # files that are not already there.
+            sent, saved = ssh.sync(files, defaults.CHEF_MANIFEST, delete = True)
+            print "Uploaded %i bytes (%i bytes were already up to date)." % (sent, saved)
+                    
+            ssh.run("sudo umount /chef")
+            ssh.close()
+            
+            print "Detaching volume"
+            vol.detach()
+            poller.wait(vol.id, "available")
+    
+            print "Creating snapshot"
+            snap = vol.create_snapshot(description)
+            snap.share(groups=['all'])
+            
+            vol.delete()
+            vol = None
+        finally:
+            # Also releases the volume if we didn't get to delete it
+            print "Terminating instance"
+            instance_ids = []
+            vols = []
+            if instance != None:
+                instance_ids.append(instance.id)
+            if vol != None:
+                vols.append(vol)
+            EC2Teardown(conn, poller).release(instance_ids, vols)
+            poller.stop()
         
-        print "The snapshot ID is %s" % snap.id
+        return snap
 
-        print "Terminating instance"
-        conn.terminate_instances([instance.id])
-        while instance.update() != "terminated":
-            time.sleep(2)
-        print "Instance terminated"        
-        
 
+# For each recipe in a role's run list, the recipe that installs the software
+# it needs (without depending on the topology), so it can be baked into
+# an AMI for that role.
+BAKE_RECIPES = {"globus": "globus",
+                "condor_head": "condor",
+                "condor_worker": "condor",
+                "torque_head": "torque",
+                "torque_worker": "torque",
+                "gram-condor": "gram-condor",
+                "gram-pbs": "gram-pbs"}
+
+def get_roles(demogrid_dir):
+    """Returns the roles that DemoGrid nodes can have"""
+    roles = [f[:-3] for f in os.listdir("%s/chef/roles" % demogrid_dir) if f.endswith(".rb")]
+    return sorted([r for r in roles if r.startswith("org-") or r.startswith("grid-")])
+
+def get_bake_run_list(demogrid_dir, roles):
+    """Returns the run list to bake into an AMI for a set of roles
+    (None means all the DemoGrid software)"""
+    if roles == None:
+        return ["recipe[demogrid::ec2]"]
+    run_list = ["recipe[demogrid::ec2_base]"]
+    for role in roles:
+        for recipe in _get_role_recipes(demogrid_dir, role):
+            bake = BAKE_RECIPES.get(recipe)
+            if bake != None and not "recipe[demogrid::%s]" % bake in run_list:
+                run_list.append("recipe[demogrid::%s]" % bake)
+    return run_list
+
+def _get_role_recipes(demogrid_dir, role):
+    f = open("%s/chef/roles/%s.rb" % (demogrid_dir, role), "r")
+    role_file = f.read()
+    f.close()
+    recipes = []
+    for kind, name in re.findall(r"(role|recipe)\[(?:demogrid::)?([\w-]+)\]", role_file):
+        if kind == "role":
+            recipes += _get_role_recipes(demogrid_dir, name)
+        else:
+            recipes.append(name)
+    return recipes
+
+
+class AMIVariant(object):
+    """One of the AMIs built by EC2AMICreator: the AMI it is built from,
+    the instance type it is built on, and the roles whose software is
+    baked into it (None for all the DemoGrid software).
+    
+    The variant's name (which identifies it in the manifest) joins the
+    roles with "+", which EC2 doesn't allow in AMI names, so the AMI
+    itself is registered as 'ami_name', with the roles joined by "_"."""
+    
+    def __init__(self, name, base_ami, instance_type, roles, ami_name = None):
+        self.name = name
+        self.ami_name = ami_name or name
+        self.base_ami = base_ami
+        self.instance_type = instance_type
+        self.roles = roles
 
 
 class EC2AMICreator(object):
-    def __init__(self, demogrid_dir, base_ami, ami_name, snapshot, keypair, keyfile):
+    """Builds a matrix of AMIs (base AMIs x instance types x role sets).
+    
+    The builds run concurrently (at most 'concurrency' at a time), and
+    share a single EC2Poller, so waiting on all the instances, volumes
+    and images takes one Describe call per kind of object. The output
+    of each build goes to <output_dir>/<variant>.log, and the AMIs that
+    were built are listed in <output_dir>/manifest.json.
+    
+    If no connection is given, one is created with create_ec2_connection()."""
+    
+    MANIFEST_FILE = "manifest.json"
+    
+    def __init__(self, demogrid_dir, base_amis, ami_name, snapshot, keypair, keyfile, 
+                 instance_types = ["c1.medium"], role_sets = [None], output_dir = ".", 
+                 concurrency = 4, config = None, conn = None):
         self.demogrid_dir = demogrid_dir
-        self.base_ami = base_ami
+        self.base_amis = base_amis
         self.ami_name = ami_name
         self.snapshot = snapshot
         self.keypair = keypair
         self.keyfile = keyfile
+        self.instance_types = instance_types
+        self.role_sets = role_sets
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.config = config
+        self.conn = conn
+        self.poller = None
+
+    def get_variants(self):
+        variants = []
+        for base_ami in self.base_amis:
+            for instance_type in self.instance_types:
+                for roles in self.role_sets:
+                    # The name only includes the dimensions that
+                    # actually vary between variants
+                    name = [self.ami_name]
+                    if len(self.base_amis) > 1:
+                        name.append(base_ami)
+                    if len(self.instance_types) > 1:
+                        name.append(instance_type)
+                    if roles != None:
+                        ami_name = "-".join(name + ["_".join(roles)])
+                        name.append("+".join(roles))
+                    else:
+                        ami_name = "-".join(name)
+                    variants.append(AMIVariant("-".join(name), base_ami, instance_type, roles, ami_name))
+        return variants
 
     def run(self):
-        log.init_logging(2)
+        log.init_logging(1)
         
-        conn = create_ec2_connection()
+        t_start = time.time()
+        if self.conn == None:
+            self.conn = create_ec2_connection()
+        self.poller = EC2Poller(self.conn)
+        self.poller.start()
+        
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
 
-        print "Creating instance"
-        reservation = conn.run_instances(self.base_ami, 
-                                         min_count=1, max_count=1,
-                                         instance_type='c1.medium', 
-                                         key_name=self.keypair)
-        instance = reservation.instances[0]
-        print "Instance %s created. Waiting for it to start..." % instance.id
+        variants = self.get_variants()
+        print "Building %i AMIs (%i at a time)" % (len(variants), self.concurrency)
+
+        sched = TaskScheduler({TaskScheduler.SSH: self.concurrency})
+        tasks = [self.create_task(v) for v in variants]
+        for task in tasks:
+            sched.add_task(task)
+        try:
+            sched.run()
+        except KeyboardInterrupt:
+            print "\033[1;31mINTERRUPTED\033[0m - Releasing the build instances"
+            self.cleanup(tasks)
+            exit(1)
+        self.cleanup(tasks)
+
+        manifest = {}
+        for task in tasks:
+            v = task.variant
+            entry = {"base_ami": v.base_ami,
+                     "instance_type": v.instance_type,
+                     "roles": v.roles,
+                     "ami": task.ami}
+            if task.error != None:
+                entry["error"] = str(task.error)
+            manifest[v.name] = entry
+        manifest_file = "%s/%s" % (self.output_dir, self.MANIFEST_FILE)
+        f = open(manifest_file, "w")
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.close()
+
+        for task in tasks:
+            if task.ami != None:
+                print "%s: %s" % (task.variant.name, task.ami)
+            else:
+                print "%s: \033[1;31mFAILED\033[0m (see %s)" % (task.variant.name, task.logfile)
+        delta = time.time() - t_start
+        print "Built %i of %i AMIs in %i minutes and %i seconds. The manifest is in %s" % (len([t for t in tasks if t.ami != None]), 
+                                                                                            len(tasks), int(delta / 60), int(delta % 60),
+                                                                                            manifest_file)
+
+        if self.config != None:
+            # Launches will pick the role AMIs from the configuration
+            # file. Only AMIs built on the instance type that the
+            # launches use for the role can be used.
+            role_amis = dict([(t.variant.roles[0], t.ami) for t in tasks 
+                              if t.ami != None and t.variant.roles != None and len(t.variant.roles) == 1
+                              and t.variant.instance_type == self.config.get_role_instance_type(t.variant.roles[0])])
+            if len(role_amis) > 0:
+                self.config.set_role_amis(role_amis)
+                self.config.save()
+                print "The role AMIs have been added to %s" % self.config.configfile
+
+        if len([t for t in tasks if t.ami == None]) > 0:
+            exit(1)
+
+    def create_task(self, variant):
+        run_list = get_bake_run_list(self.demogrid_dir, variant.roles)
+        return AMIBuildTask("build-%s" % variant.name, self, variant, run_list)
+
+    def cleanup(self, tasks):
+        # Release whatever the unfinished builds left behind
+        instance_ids = [t.instance.id for t in tasks if t.instance != None]
+        vols = [t.vol for t in tasks if t.vol != None]
+        if len(instance_ids) + len(vols) > 0:
+            errors = EC2Teardown(self.conn, self.poller).release(instance_ids, vols)
+            for obj_id, exc in errors.items():
+                print "\033[1;31mERROR\033[0m - Could not release %s: %s" % (obj_id, exc)
+        self.poller.stop()
+
+
+class AMIBuildTask(DemoGridTask):
+    """Builds the AMI for a variant: launches an instance, installs
+    the variant's software on it with chef-solo, and creates an
+    AMI from it once it's stopped."""
+    
+    def __init__(self, name, creator, variant, run_list, depends = []):
+        DemoGridTask.__init__(self, name, depends, resource = TaskScheduler.SSH)
+        self.creator = creator
+        self.variant = variant
+        self.run_list = run_list
+        self.logfile = "%s/%s.log" % (creator.output_dir, variant.name)
+        self.instance = None
+        self.vol = None
+        self.ami = None
+        self.error = None
+        self.logf = None
         
-        while instance.update() != "running":
-            time.sleep(2)
+    def run2(self):
+        self.logf = open(self.logfile, "w")
+        try:
+            self.build()
+        except ThreadAbortException:
+            raise
+        except Exception, exc:
+            # A failed build must not abort the other builds, so the
+            # error is recorded here instead of being raised.
+            self.error = exc
+            self.log("Build failed: %s" % exc)
+        finally:
+            self.logf.close()
+
+    def build(self):
+        conn = self.creator.conn
+        poller = self.creator.poller
+        v = self.variant
         
-        print "Instance running."
+        self.log("Launching %s instance from %s" % (v.instance_type, v.base_ami))
+        reservation = conn.run_instances(v.base_ami, 
+                                         min_count=1, max_count=1,
+                                         instance_type=v.instance_type, 
+                                         key_name=self.creator.keypair)
+        self.instance = reservation.instances[0]
+        self.log("Instance %s created. Waiting for it to start..." % self.instance.id)
+        instance = poller.wait(self.instance.id, "running", self.check_continue)
+        self.log("Instance running.")
+
+        if self.creator.snapshot != None:
+            self.log("Creating Chef volume.")
+            self.vol = conn.create_volume(1, instance.placement, self.creator.snapshot)
+            poller.wait(self.vol.id, "available", self.check_continue)
+            self.vol.attach(instance.id, '/dev/sdh')
+            poller.wait(self.vol.id, "in-use", self.check_continue)
+            self.log("Chef volume %s is in-use." % self.vol.id)
+
+        self.configure(instance)
+        self.check_continue()
 
-        ssh = SSH("ubuntu", instance.public_dns_name, self.keyfile)
+        if self.vol != None:
+            self.log("Releasing Chef volume.")
+            self.vol.detach()
+            poller.wait(self.vol.id, "available", self.check_continue)
+            self.vol.delete()
+            self.vol = None
+            
+        # Apparently instance.stop() will terminate
+        # the instance (this is a known bug), so we 
+        # use stop_instances instead.
+        self.log("Stopping instance")
+        conn.stop_instances([instance.id])
+        poller.wait(instance.id, "stopped", self.check_continue)
+        
+        self.log("Creating AMI %s" % v.ami_name)
+        ami = conn.create_image(instance.id, v.ami_name, description=v.name)
+        poller.wait(ami, "available", self.check_continue)
+        self.ami = ami
+        self.log("AMI %s is available." % ami)
+
+        self.log("Terminating instance")
+        conn.terminate_instances([instance.id])
+        self.instance = None
+
+    def configure(self, instance):
+        """Installs the variant's software on the instance"""
+        ssh = SSH("ubuntu", instance.public_dns_name, self.creator.keyfile, self.logf, self.logf)
         ssh.open()
         
-        if self.snapshot != None:
-            print "Creating volume + attaching."
-            
-            vol = conn.create_volume(1, instance.placement, self.snapshot)
-            vol.attach(instance.id, '/dev/sdh')
-            while vol.update() != "in-use":
-                time.sleep(2)
-            
-            print "Volume created."        
-    
-            print "Mounting volume."  
+        if self.vol != None:
+            self.log("Mounting Chef volume.")  
             ssh.run("sudo mkdir /chef")
             ssh.run("sudo mount -t ext3 /dev/sdh /chef")
             ssh.run("sudo chown -R ubuntu /chef")
         else:
-            print "Copying Chef files"
+            self.log("Copying Chef files")
             ssh.run("sudo mkdir /chef")
             ssh.run("sudo chown -R ubuntu /chef")
-            ssh.scp_dir("%s/chef" % self.demogrid_dir, "/chef")
-            
+            ssh.sync(dir_files("%s/chef" % self.creator.demogrid_dir, "/chef"), defaults.CHEF_MANIFEST)
         
+        self.log("Installing Chef")
         ssh.run("sudo apt-add-repository 'deb http://apt.opscode.com/ lucid main'")
         ssh.run("wget -qO - http://apt.opscode.com/packages@opscode.com.gpg.key | sudo apt-key add -")
         ssh.run("sudo apt-get update")
         ssh.run("echo 'chef chef/chef_server_url string http://127.0.0.1:4000' | sudo debconf-set-selections")
         ssh.run("sudo apt-get -q=2 install chef")
         
-        ssh.scp("%s/lib/ec2/chef.conf" % self.demogrid_dir,
+        ssh.scp("%s/lib/ec2/chef.conf" % self.creator.demogrid_dir,
                 "/tmp/chef.conf")        
         
-        ssh.run("echo '{ \"run_list\": \"recipe[demogrid::ec2]\" }' > /tmp/chef.json")
+        ssh.run("echo '%s' > /tmp/chef.json" % json.dumps({"run_list": self.run_list}))
 
+        self.log("Running chef-solo with %s" % ", ".join(self.run_list))
         ssh.run("sudo chef-solo -c /tmp/chef.conf -j /tmp/chef.json")    
         
         ssh.run("sudo update-rc.d nis disable")
         ssh.run("sudo update-rc.d chef-client disable")
         
-        if self.snapshot != None:
+        if self.vol != None:
             ssh.run("sudo umount /chef")
-            print "Detaching volume"
-            vol.detach()
-            while vol.update() != "available":
-                time.sleep(1)        
-            
-        # Apparently instance.stop() will terminate
-        # the instance (this is a known bug), so we 
-        # use stop_instances instead.
-        print "Stopping instance"
-        conn.stop_instances([instance.id])
-        while instance.update() != "stopped":
-            time.sleep(2)
-        print "Instance stopped"
-        
-        print "Creating AMI"
-        # Doesn't actually return AMI. Have to make it public manually.
-        ami = conn.create_image(instance.id, self.ami_name, description=self.ami_name)       
-        
-        print "Cleaning up"
+        ssh.close()
 
-        
-        print "Terminating instance"
-        conn.terminate_instances([instance.id])
-        while instance.update() != "terminated":
-            time.sleep(2)
-        print "Instance terminated"   
-                
-        if self.snapshot != None:                
-            vol.delete()     
-        
\ No newline at end of file
+    def log(self, msg):
+        self.logf.write("%s %s\n" % (time.strftime("%H:%M:%S"), msg))
+        self.logf.flush()
+        log.info("%s - %s" % (self.variant.name, msg))
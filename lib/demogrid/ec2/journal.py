@@ -0,0 +1,121 @@
+'''
+Created on Jan 14, 2011
+
+@author: borja
+'''
+import json
+import os
+import threading
+
+class LaunchJournal(object):
+    """On-disk record of an EC2 launch: which instance (and Chef volume)
+    each node is running on, and which configuration phases have been
+    completed on each node. Every change is appended to the journal as
+    soon as it happens (as one JSON line), so an interrupted launch can
+    be resumed from where it left off. The journal is compacted (to one
+    line per instance, volume and phase) when it is loaded."""
+
+    FILENAME = "ec2_launch.journal"
+
+    def __init__(self, generated_dir):
+        self.filename = "%s/%s" % (generated_dir, self.FILENAME)
+        self.lock = threading.Lock()
+        self.file = None
+        self.instances = {}
+        self.volumes = {}
+        self.phases = {}
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self):
+        with self.lock:
+            self.instances = {}
+            self.volumes = {}
+            self.phases = {}
+            f = open(self.filename, "r")
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete, if we crashed
+                    # while writing it
+                    break
+                self.__apply(entry)
+            f.close()
+            self.__compact()
+
+    def reset(self):
+        with self.lock:
+            self.instances = {}
+            self.volumes = {}
+            self.phases = {}
+            self.__compact()
+
+    def set_instance(self, node, instance_id):
+        self.__record({"op": "instance", "node": node.demogrid_host_id, "id": instance_id})
+
+    def get_instance(self, node):
+        return self.instances.get(node.demogrid_host_id)
+
+    def set_volume(self, node, volume_id):
+        self.__record({"op": "volume", "node": node.demogrid_host_id, "id": volume_id})
+
+    def get_volume(self, node):
+        return self.volumes.get(node.demogrid_host_id)
+
+    def complete_phase(self, node, phase):
+        self.__record({"op": "phase", "node": node.demogrid_host_id, "phase": phase})
+
+    def reset_phases(self, node):
+        """Forgets the phases that were completed on a node (so it
+        will be fully configured again)"""
+        self.__record({"op": "reset-phases", "node": node.demogrid_host_id})
+
+    def remove_node(self, node):
+        self.__record({"op": "remove", "node": node.demogrid_host_id})
+
+    def is_complete(self, node, phase):
+        return phase in self.phases.get(node.demogrid_host_id, [])
+
+    def __record(self, entry):
+        with self.lock:
+            self.__apply(entry)
+            if self.file == None:
+                self.file = open(self.filename, "a")
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def __apply(self, entry):
+        node = entry["node"]
+        op = entry["op"]
+        if op == "instance":
+            self.instances[node] = entry["id"]
+        elif op == "volume":
+            if entry["id"] == None:
+                self.volumes.pop(node, None)
+            else:
+                self.volumes[node] = entry["id"]
+        elif op == "phase":
+            self.phases.setdefault(node, []).append(entry["phase"])
+        elif op == "reset-phases":
+            self.phases.pop(node, None)
+        elif op == "remove":
+            self.instances.pop(node, None)
+            self.volumes.pop(node, None)
+            self.phases.pop(node, None)
+
+    def __compact(self):
+        # Must be called with the lock held. Write to a temporary file
+        # first, so a crash can't leave a truncated journal behind.
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        entries = [{"op": "instance", "node": n, "id": i} for n, i in sorted(self.instances.items())]
+        entries += [{"op": "volume", "node": n, "id": v} for n, v in sorted(self.volumes.items())]
+        entries += [{"op": "phase", "node": n, "phase": p} for n, phases in sorted(self.phases.items()) for p in phases]
+        tmp = self.filename + ".tmp"
+        f = open(tmp, "w")
+        f.write("".join([json.dumps(e) + "\n" for e in entries]))
+        f.close()
+        os.rename(tmp, self.filename)
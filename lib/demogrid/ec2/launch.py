@@ -1,25 +1,63 @@
 from cPickle import load
 from boto.exception import BotoClientError, EC2ResponseError
-from demogrid.common.utils import create_ec2_connection, SSH, MultiThread,\
-    DemoGridThread, SSHCommandFailureException, SIGINTWatcher
-import random
+from demogrid.common.utils import create_ec2_connection, SSH, TaskScheduler,\
+    DemoGridTask, SSHCommandFailureException, dir_files,\
+    file_hash
+import demogrid.common.defaults as defaults
 import time
 import sys
 import traceback
-from demogrid.common import log
+import threading
+import tarfile
+import json
+import os
+from demogrid.common import log, trace
 from demogrid.common.certs import CertificateGenerator
+from demogrid.common.topology import DGNode
+from demogrid.ec2.bootstrap import ArtifactServer, BootstrapFailureException, BootstrapTimeoutException
+from demogrid.ec2.journal import LaunchJournal
+from demogrid.ec2.volumes import ChefVolumeManager
+from demogrid.ec2.teardown import EC2Teardown
+from demogrid.ec2.poller import EC2Poller, EC2StateException
+from demogrid.ec2.images import get_bake_run_list
 
 
 class EC2Launcher(object):
-    def __init__(self, demogrid_dir, config, generated_dir, loglevel, no_cleanup):
+    
+    # Where the artifact bundle is placed (and served from)
+    # on the instances, when using fan-out distribution
+    DIST_DIR = "/tmp/demogrid-dist"
+    DIST_PORT = 8765
+    
+    # Nodes with these roles don't depend on any other node
+    NO_DEPS_ROLES = DGNode.NO_DEPS_ROLES
+    
+    # Run list of the base phase, which doesn't depend on any other node
+    # (the role's software is added to it, see get_base_run_list())
+    BASE_RUN_LIST = "recipe[demogrid::demogrid_node]"
+    
+    def __init__(self, demogrid_dir, config, generated_dir, loglevel, no_cleanup,
+                 wait_concurrency = None, configure_concurrency = None, fanout = None,
+                 pull_server = None, resume = False, trace_file = None):
         self.demogrid_dir = demogrid_dir
         self.config = config
         self.generated_dir = generated_dir
         self.loglevel = loglevel
         self.conn = None
+        self.poller = None
         self.instances = None
-        self.vols = []
+        self.chef_volumes = None
         self.no_cleanup = no_cleanup
+        self.wait_concurrency = wait_concurrency
+        self.configure_concurrency = configure_concurrency
+        self.fanout = fanout
+        self.distributor = None
+        self.pull_server = pull_server
+        self.artifact_server = None
+        self.resume = resume
+        self.journal = LaunchJournal(generated_dir)
+        self.trace_file = trace_file
+        self.addresses_ready = threading.Event()
      
     def run(self):
         # This try-except will catch anything that isn't
@@ -27,42 +65,24 @@ class EC2Launcher(object):
         # exceptions)
         try:
             self.launch()
+        except KeyboardInterrupt:
+            # Any scheduler that was running has already been cancelled
+            print
+            print "\033[1;31mINTERRUPTED\033[0m - The launch has been cancelled."
+            self.cleanup()
+            exit(1)
         except Exception, exc:
             self.handle_unexpected_exception(exc)
             
         
     def launch(self):     
-        SIGINTWatcher(self.cleanup_after_kill)
         t_start = time.time()
-        
-        ami = self.config.get_ami()
-        keypair = self.config.get_keypair()
-        insttypes = self.config.get_instance_type()
-        zone = self.config.get_ec2_zone()   
-        
-        # Parse the instance type option
-        role_insttype = {}
-        for ri in insttypes.split():
-            role, insttype = ri.split(":")
-            role_insttype[role] = insttype
-        default_insttype = role_insttype["*"]
+        trace.reset()
+        trace.set_track("launcher")
         
         log.init_logging(self.loglevel)
         
-        try:
-            log.debug("Connecting to EC2...")
-            self.conn = create_ec2_connection()
-            if self.conn == None:
-                print "AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variables are not set."
-                exit(1)
-            log.debug("Connected to EC2.")
-        except BotoClientError, exc:
-            print "\033[1;31mERROR\033[0m - Could not connect to EC2."
-            print "        Reason: %s" % exc.reason
-            exit(1)
-        except Exception, exc:
-            self.handle_unexpected_exception(exc)
-            
+        self.connect()
         
         # Load topology
         log.debug("Loading topology file...")
@@ -79,6 +99,121 @@ class EC2Launcher(object):
         nodes = topology.get_nodes()
         num_instances = len(nodes)
         
+        if self.resume:
+            if not self.journal.exists():
+                print "\033[1;31mERROR\033[0m - There is no launch to resume in %s" % self.generated_dir
+                exit(1)
+            if self.pull_server != None:
+                print "\033[1;31mERROR\033[0m - Launches in pull mode can't be resumed."
+                exit(1)
+            self.journal.load()
+            if self.fanout:
+                # Nodes that were already configured won't be relaying
+                # files, so fall back to uploading files directly.
+                log.info("Not using fan-out distribution when resuming a launch.")
+                self.fanout = None
+        else:
+            self.journal.reset()
+        
+        if self.pull_server != None:
+            # Instances will get their files from (and report back to)
+            # an artifact server running on this host
+            if ":" in self.pull_server:
+                port = int(self.pull_server.split(":")[1])
+            else:
+                port = 80
+            self.artifact_server = ArtifactServer(port)
+            self.artifact_server.start()
+
+        if self.resume:
+            instance_ids = [self.journal.get_instance(n) for n in nodes]
+            if None in instance_ids:
+                print "\033[1;31mERROR\033[0m - The launch can't be resumed, because not all the instances were requested."
+                exit(1)
+            log.info("Resuming launch of %i EC2 instances." % num_instances)
+            try:
+                reservations = self.conn.get_all_instances(instance_ids)
+            except EC2ResponseError, exc:
+                self.handle_ec2response_exception(exc, "getting instances to resume")
+            self.instances = [i for r in reservations for i in r.instances]
+            gone = [i.id for i in self.instances if not i.state in ("pending", "running")]
+            if len(gone) > 0:
+                print "\033[1;31mERROR\033[0m - The launch can't be resumed, because these instances are no longer running: %s" % " ".join(gone)
+                exit(1)
+        else:
+            # Launch instances
+            if self.loglevel == 0:
+                print "\033[1;37mLaunching %i EC2 instances...\033[0m" % num_instances,
+                sys.stdout.flush()
+
+            self.instances = []
+            self.request_instances(nodes)
+        
+        log.debug("Instances: %s" % " ".join([i.id for i in self.instances]))
+
+        if self.loglevel == 0:
+            print "\033[1;32mdone!\033[0m"            
+        
+        if self.artifact_server != None:
+            # The manifests can't be published until we know
+            # the addresses of all the nodes
+            try:
+                node_instance = self.wait_instances(nodes)
+            except EC2StateException, exc:
+                self.handle_mt_exceptions({exc.obj_id: exc}, "Exception raised while waiting for instances.")
+            self.gen_address_files(topology, nodes, node_instance)
+            
+            if self.loglevel == 0:
+                print "\033[1;37mConfiguring DemoGrid nodes...\033[0m (this may take a few minutes)"
+            log.info("Setting up DemoGrid on instances")        
+            self.__configure_pull(node_instance)
+        else:
+            if self.loglevel == 0:
+                print "\033[1;37mConfiguring DemoGrid nodes...\033[0m (this may take a few minutes)"
+            log.info("Setting up DemoGrid on instances")        
+            node_instance = self.configure_push(topology, nodes)
+
+        t_end = time.time()
+        
+        delta = t_end - t_start
+        minutes = int(delta / 60)
+        seconds = int(delta - (minutes * 60))
+        print "You just went \033[1;34mfrom zero to grid\033[0m in \033[1;37m%i minutes and %s seconds\033[0m!" % (minutes, seconds)
+
+        print "Your login nodes are:"
+        for node, instance in node_instance.items():
+            if node.role == "org-login":
+                print "%s: %s" % (node.hostname.split(".")[0], instance.public_dns_name)
+        
+        self.save_trace()
+
+
+    def connect(self):
+        try:
+            log.debug("Connecting to EC2...")
+            self.conn = create_ec2_connection()
+            if self.conn == None:
+                print "AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variables are not set."
+                exit(1)
+            log.debug("Connected to EC2.")
+            self.poller = EC2Poller(self.conn)
+            self.poller.start()
+            if self.config.has_snap():
+                self.chef_volumes = ChefVolumeManager(self.conn, self.poller, self.journal, self.config.get_snap())
+        except BotoClientError, exc:
+            print "\033[1;31mERROR\033[0m - Could not connect to EC2."
+            print "        Reason: %s" % exc.reason
+            exit(1)
+        except Exception, exc:
+            self.handle_unexpected_exception(exc)
+
+    def request_instances(self, nodes):
+        """Requests instances for the given nodes, and records them in
+        the journal (and in self.instances, so they will be released
+        if something goes wrong)."""
+        keypair = self.config.get_keypair()
+        zone = self.config.get_ec2_zone()   
+
         nodes_by_role = {}
         for n in nodes:
             if not nodes_by_role.has_key(n.role):
@@ -86,62 +221,100 @@ class EC2Launcher(object):
             else:
                 nodes_by_role[n.role].append(n)
 
-        # Launch instances
-        if self.loglevel == 0:
-            print "\033[1;37mLaunching %i EC2 instances...\033[0m" % num_instances,
-            sys.stdout.flush()
-
-        self.instances = []
-        instances_by_role = {}
-        log.info("Launching a total of %i EC2 instances." % num_instances)
+        log.info("Launching a total of %i EC2 instances." % len(nodes))
+        requests = []
         for role, n in nodes_by_role.items():     
-            try:   
-                insttype = role_insttype.get(role, default_insttype)
-                log.info(" |- Launching %i %s instances." % (len(n), insttype))
-                reservation = self.conn.run_instances(ami, 
-                                                 min_count=len(n), 
-                                                 max_count=len(n),
-                                                 instance_type=insttype,
-                                                 security_groups= ["default"],
-                                                 key_name=keypair,
-                                                 placement = zone)
-                self.instances += reservation.instances
-                instances_by_role[role] = reservation.instances
-            except EC2ResponseError, exc:
-                self.handle_ec2response_exception(exc, "requesting instances")
-            except Exception, exc:
-                self.handle_unexpected_exception(exc)            
-        
-        
-        log.debug("Instances: %s" % " ".join([i.id for i in self.instances]))
+            insttype = self.config.get_role_instance_type(role)
+            log.info(" |- Launching %i %s instances." % (len(n), insttype))
+            if self.artifact_server != None:
+                user_data = self.artifact_server.get_user_data("http://%s" % self.pull_server, role)
+            else:
+                user_data = None
+            # Use the role's own AMI if one has been baked
+            ami = self.config.get_ami(role)
+            requests.append((role, ami, len(n), {"instance_type": insttype,
+                                                 "security_groups": ["default"],
+                                                 "key_name": keypair,
+                                                 "placement": zone,
+                                                 "user_data": user_data}))
+        
+        # All the roles are requested at the same time (in chunks, so
+        # a large role doesn't fail for lack of capacity in one go)
+        try:
+            with trace.span("run_instances", "run_instances", count = len(nodes)):
+                role_instances, errors = self.conn.run_instances_concurrently(requests)
+        except Exception, exc:
+            self.handle_unexpected_exception(exc)
         
+        for role, instances in role_instances.items():
+            self.instances += instances
+            zone_nodes = {}
+            for node, instance in zip(nodes_by_role[role], instances):
+                self.journal.set_instance(node, instance.id)
+                zone_nodes.setdefault(instance.placement, []).append(node)
+            if self.chef_volumes != None:
+                # Get the Chef volumes ready while the instances start
+                for instance_zone, zn in zone_nodes.items():
+                    self.chef_volumes.create(zn, instance_zone)
+        
+        for role, exc in errors.items():
+            if isinstance(exc, EC2ResponseError):
+                self.handle_ec2response_exception(exc, "requesting %s instances" % role)
+            else:
+                self.handle_unexpected_exception(exc)
+
+    def wait_instances(self, nodes, check_continue = None):
+        """Waits for the instances of the given nodes to be running.
+        Returns a dict mapping each node to its (fresh) Instance object."""
         log.debug("Waiting for instances to start.")
         
-        mt_instancewait = MultiThread()
-        
-        for i in self.instances:
-            mt_instancewait.add_thread(InstanceWaitThread(mt_instancewait, "wait-%s" % i.id, i, self))
-        mt_instancewait.run()
-        
-        if not mt_instancewait.all_success():
-            self.handle_mt_exceptions(mt_instancewait.get_exceptions(), "Exception raised while waiting for instances.")
-            
-        if self.loglevel == 0:
-            print "\033[1;32mdone!\033[0m"            
+        # The poller gives us fresh Instance objects, so we don't run
+        # into the bug in boto where update() won't get some of the
+        # attributes (specially the private IP, which we need)
+        waiters = dict([(n, self.poller.watch(self.journal.get_instance(n), "running")) for n in nodes])
+        t_wait = time.time()
+        node_instance = {}
+        for node, waiter in waiters.items():
+            node_instance[node] = waiter.wait(check_continue)
+            trace.add("wait-running", "wait-running", t_wait, waiter.time, 
+                      track = node.demogrid_host_id, args = {"instance": waiter.obj_id})
+            log.info("Instance %s is running. Hostname: %s" % (waiter.obj_id, node_instance[node].public_dns_name), node)
         log.info("Instances are running.")
+        return node_instance
 
-        self.instances = []
-        node_instance = {}
-        for role, instances in instances_by_role.items():
-            # Kluge: This is because of a known bug in the stable release of boto.
-            # Basically, update() won't get some of the attributes (specially
-            # the private IP, which we need), and the workaround is to force
-            # boto to create a new Instance object.
-            # Can be removed once they push a new stable release
-            r = self.conn.get_all_instances([i.id for i in instances])
-            self.instances += r[0].instances
-            node_instance.update(dict(zip(nodes_by_role[role], r[0].instances)))
-        
+    def wait_instance(self, node, check_continue = None):
+        """Waits for the instance of the given node to be running.
+        Returns its (fresh) Instance object."""
+        return self.poller.wait(self.journal.get_instance(node), "running", check_continue)
+
+    def open_shell(self, node, instance, outf = None, errf = None):
+        """Returns an open SSH connection to the given node's instance"""
+        ssh = SSH("ubuntu", instance.public_dns_name, self.config.get_keyfile(), outf, errf)
+        ssh.open()
+        return ssh
+
+    def get_base_run_list(self, node):
+        """Returns the run list of a node's base phase: the basic node
+        setup, and the installation of the software its role needs (the
+        same recipes that are baked into the role's AMI). None of this
+        depends on other nodes, so it runs while the org server is still
+        converging, and the role converge only has to configure it."""
+        return [self.BASE_RUN_LIST] + get_bake_run_list(self.demogrid_dir, [node.role])
+
+    def get_node_files(self, node):
+        """Returns the (local file, remote file) pairs that have to be
+        uploaded to a node before Chef can run on it."""
+        files = [("%s/hosts_ec2" % self.generated_dir, "/chef/cookbooks/demogrid/files/default/hosts"),
+                 ("%s/topology_ec2.rb" % self.generated_dir, "/chef/cookbooks/demogrid/attributes/topology.rb"),
+                 ("%s/lib/ec2/chef.conf" % self.demogrid_dir, "/chef/chef.conf")]
+        files += dir_files("%s/certs" % self.generated_dir, "/chef/cookbooks/demogrid/files/default/")
+        return files
+
+    def gen_address_files(self, topology, nodes, node_instance):
+        """Generates the files that need to know the address of every
+        node (hosts file, topology attributes, etc.). Once this is done,
+        the address map is published (nodes waiting on wait_addresses()
+        can proceed)."""
         for node, instance in node_instance.items():
             node.ip = instance.private_ip_address
             if self.config.get_ec2_access_type() == "public":
@@ -161,67 +334,133 @@ class EC2Launcher(object):
                 if node.org.auth != None:
                     attrs["auth"] = "\"%s\"" % node.org.auth.hostname
                 
-        
         if self.config.get_ec2_access_type() == "public":
             self.__gen_public_host_certificates(node_instance)
         
         topology.gen_ruby_file(self.generated_dir + "/topology_ec2.rb")
         topology.gen_hosts_file(self.generated_dir + "/hosts_ec2") 
         topology.gen_csv_file(self.generated_dir + "/topology_ec2.csv")
+        # Saved so the grid can be scaled later on
+        topology.save(self.generated_dir + "/topology_ec2.dat")
         
-        if self.loglevel == 0:
-            print "\033[1;37mConfiguring DemoGrid nodes...\033[0m (this may take a few minutes)"
-        log.info("Setting up DemoGrid on instances")        
-        
-        mt_configure = MultiThread()
-
-        no_deps_roles = ("org-server", "grid-auth")
-
-        no_deps = dict([(n,InstanceConfigureThread(mt_configure, 
-                                                  "configure-%s" % n.hostname.split(".")[0], 
-                                                  n, 
-                                                  i, 
-                                                  self,
-                                                  depends = None)) 
-                                                  for n,i in node_instance.items()
-                                                  if n.role in no_deps_roles])
-        rest = dict([(n,InstanceConfigureThread(mt_configure, 
-                                                  "configure-%s" % n.hostname.split(".")[0], 
-                                                  n, 
-                                                  i, 
-                                                  self,
-                                                  depends = no_deps[n.org.server])) 
-                                                  for n,i in node_instance.items()
-                                                  if not n.role in no_deps_roles])
-
-        for thread in no_deps.values() + rest.values():
-            mt_configure.add_thread(thread)
-        mt_configure.run()        
-        
-        if not mt_configure.all_success():
-            self.handle_mt_exceptions(mt_configure.get_exceptions(), "DemoGrid was unable to configure the instances.")
+        if self.fanout:
+            self.__gen_bundle()
+            self.distributor = ArtifactDistributor(self.fanout)
+            
+        self.addresses_ready.set()
+        log.info("Address map has been published.")
 
-        t_end = time.time()
+    def wait_addresses(self, check_continue = None):
+        # Wait with a timeout, so the main thread can still get signals
+        while not self.addresses_ready.wait(1.0):
+            if check_continue != None:
+                check_continue()
+
+    def configure_push(self, topology, nodes):
+        """Configures the instances by SSHing into each of them. Each node
+        is configured as soon as its instance is running, and only the
+        steps that need the address of every node wait for all the
+        instances to be running. Returns a dict mapping each node
+        to its Instance object."""
+        sched_configure = self.__create_scheduler()
+
+        address_task = AddressMapTask("address-map", topology, nodes, self)
+        sched_configure.add_task(address_task)
+
+        setup_tasks = {}
+        converge_tasks = {}
+        for n in nodes:
+            if self.journal.is_complete(n, InstanceConvergeTask.PHASE_DONE):
+                log.info("Node was already configured. Skipping.", n)
+                continue
+            name = n.hostname.split(".")[0]
+            setup_tasks[n] = InstanceSetupTask("setup-%s" % name, n, self)
+            converge_tasks[n] = InstanceConvergeTask("converge-%s" % name, setup_tasks[n], depends = [setup_tasks[n]])
+            
+        # Only the role converge has to wait for other nodes (the org
+        # server, and whatever else the role needs). Everything up to
+        # that point runs right away.
+        for n, task in converge_tasks.items():
+            for dep in self.get_node_depends(n):
+                if converge_tasks.has_key(dep):
+                    task.depends.append(converge_tasks[dep])
+
+        for task in setup_tasks.values() + converge_tasks.values():
+            sched_configure.add_task(task)
+        sched_configure.run()        
         
-        delta = t_end - t_start
-        minutes = int(delta / 60)
-        seconds = int(delta - (minutes * 60))
-        print "You just went \033[1;34mfrom zero to grid\033[0m in \033[1;37m%i minutes and %s seconds\033[0m!" % (minutes, seconds)
+        if not sched_configure.all_success():
+            self.handle_mt_exceptions(sched_configure.get_exceptions(), "DemoGrid was unable to configure the instances.")
+
+        self.__wait_chef_volumes()
+
+        if self.fanout:
+            # The org servers keep serving the bundle until every
+            # node in the organization has been configured.
+            for n, task in setup_tasks.items():
+                if n.role in self.NO_DEPS_ROLES and n.org != None:
+                    task.ssh.run("pkill -f 'SimpleHTTPServer %i'" % self.DIST_PORT, exception_on_error = False, expectnooutput = True)
+                    
+        return address_task.node_instance
+
+    def get_node_depends(self, node):
+        """Returns the nodes that must be configured before
+        the given node's role can converge."""
+        return node.get_depends()
+
+    def __configure_pull(self, node_instance):
+        """Lets the instances configure themselves, with the files
+        they get from the artifact server, and waits for all of
+        them to report back."""
+        server = self.artifact_server
+        
+        server.add_file("hosts", "%s/hosts_ec2" % self.generated_dir)
+        server.add_file("topology.rb", "%s/topology_ec2.rb" % self.generated_dir)
+        server.add_file("chef.conf", "%s/lib/ec2/chef.conf" % self.demogrid_dir)
+        files = [("hosts", "/chef/cookbooks/demogrid/files/default/hosts"),
+                 ("topology.rb", "/chef/cookbooks/demogrid/attributes/topology.rb"),
+                 ("chef.conf", "/chef/chef.conf")]
+        for fromfile, tofile in dir_files("%s/certs" % self.generated_dir, "/chef/cookbooks/demogrid/files/default"):
+            name = fromfile.split("/")[-1]
+            server.add_file(name, fromfile)
+            files.append((name, tofile.replace("//", "/")))
+        
+        if self.chef_volumes != None:
+            # The bootstrap script waits for the volume to show up
+            self.chef_volumes.attach_all(node_instance)
 
-        print "Your login nodes are:"
         for node, instance in node_instance.items():
-            if node.role == "org-login":
-                print "%s: %s" % (node.hostname.split(".")[0], instance.public_dns_name)
+            if node.role in self.NO_DEPS_ROLES:
+                depends = None
+            else:
+                depends = node.org.server
+            server.publish(instance.id, node, files, self.config.has_snap(), depends)
+        
+        failures = server.wait()
+        if len(failures) > 0:
+            self.handle_mt_exceptions(dict([(n.hostname.split(".")[0], e) for n, e in failures.items()]), 
+                                      "DemoGrid was unable to configure the instances.")
+        server.stop()
+        
+        if self.chef_volumes != None:
+            for node in node_instance.keys():
+                self.chef_volumes.release(node)
+        self.__wait_chef_volumes()
+
+    def __wait_chef_volumes(self):
+        if self.chef_volumes != None:
+            errors = self.chef_volumes.wait_released()
+            if len(errors) > 0:
+                self.handle_mt_exceptions(errors, "DemoGrid was unable to release the Chef volumes.")
+
 
+    def __create_scheduler(self):
+        return TaskScheduler({TaskScheduler.EC2: self.wait_concurrency,
+                              TaskScheduler.SSH: self.configure_concurrency})
 
-    def wait_state(self, obj, state, interval = 2.0):
-        jitter = random.uniform(0.0, 0.5)
-        while True:
-            time.sleep(interval + jitter)
-            newstate = obj.update()
-            if newstate == state:
-                return True
-        # TODO: Check errors
+    def wait_state(self, obj, state, check_continue = None):
+        self.poller.wait(obj.id, state, check_continue)
+        return True
 
     def handle_ec2response_exception(self, exc, what=""):
         if what != "": what = " when " + what
@@ -245,6 +484,13 @@ class EC2Launcher(object):
         for name, exception in exceptions.items():
             if isinstance(exception, SSHCommandFailureException):
                 print "        %s: Error while running '%s'" % (name, exception.command)
+                if exception.output:
+                    print "        Output: %s" % exception.output.strip()
+            elif isinstance(exception, BootstrapFailureException):
+                print "        %s: %s" % (name, exception)
+                print "        Output: %s" % exception.output.strip()
+            elif isinstance(exception, BootstrapTimeoutException):
+                print "        %s: %s" % (name, exception)
             elif isinstance(exception, EC2ResponseError):
                 print "        %s: EC2 error '%s'" % (name, exception.reason)
                 print "        Body: %s" % exception.body
@@ -255,34 +501,64 @@ class EC2Launcher(object):
         self.cleanup()
         exit(1)
 
+    def save_trace(self):
+        if self.trace_file != None:
+            trace.save_chrome_trace(self.trace_file)
+            print
+            print trace.summary()
+            print "The launch trace has been saved to %s" % self.trace_file
+
     def cleanup(self):
+        self.save_trace()
+        if self.artifact_server != None:
+            self.artifact_server.stop()
         if self.no_cleanup:
             print "--no-cleanup has been specified, so DemoGrid will not release EC2 resources."
             print "Remember to do this manually"
-        else:
+            if self.journal.exists():
+                print "You can also resume the launch (reusing the same instances) with --resume"
+        elif self.conn != None:
             print "DemoGrid is attempting to release all EC2 resources..."
+            if self.instances != None:
+                instance_ids = [i.id for i in self.instances]
+            else:
+                instance_ids = []
+            vols = []
             try:
-                if self.conn != None:
-                    for v in self.vols:
-                        if v.attachment_state == "attached":
-                            v.detach()
-                    if self.instances != None:
-                        self.conn.terminate_instances([i.id for i in self.instances])
-                    for v in self.vols:
-                        self.wait_state(v, "available")        
-                        v.delete()
-                    print "DemoGrid has released all EC2 resources."
+                if self.chef_volumes != None:
+                    # Make sure no more volumes are created behind our back
+                    self.chef_volumes.cancel()
+                    vols = self.chef_volumes.get_volumes()
+                errors = EC2Teardown(self.conn, self.poller).release(instance_ids, vols)
+            except KeyboardInterrupt:
+                errors = dict([(i, None) for i in instance_ids + [v.id for v in vols]])
             except:
                 traceback.print_exc()
+                errors = dict([(i, None) for i in instance_ids + [v.id for v in vols]])
+            
+            if len(errors) == 0:
+                print "DemoGrid has released all EC2 resources."
+            else:
                 print "DemoGrid was unable to release all EC2 resources."
-                if self.instances != None:
-                    print "Please make sure the following instances have been terminated: " % [i.id for i in self.instances]
-                if len(self.vols) > 0:
-                    print "Please make sure the following volumes have been deleted: " % [v.id for v in self.vols]
-        
-    def cleanup_after_kill(self):
-        print "DemoGrid has been unexpectedly killed and cannot release EC2 resources."
-        print "Please make sure you manually release all DemoGrid instances and volumes."
+                print "Please make sure the following instances have been terminated and volumes have been deleted:"
+                print "  " + " ".join(sorted(errors.keys()))
+        
+    def __gen_bundle(self):
+        """Packs the files that every node needs (hosts file, topology
+        file, certificates and Chef configuration) into a single bundle,
+        to be extracted into /chef on each node."""
+        log.info("Generating artifact bundle")
+        self.bundle_file = "%s/ec2_bundle.tgz" % self.generated_dir
+        self.bundle_files = self.get_node_files(None)
+        bundle = tarfile.open(self.bundle_file, "w:gz")
+        for fromfile, tofile in self.bundle_files:
+            bundle.add(fromfile, os.path.relpath(os.path.normpath(tofile), "/chef"))
+        bundle.close()
+        self.bundle_hash = file_hash(self.bundle_file)
+        # The bundle has every host's private key, so the nodes serving
+        # it only hand it out under this (unguessable) path
+        self.bundle_secret = os.urandom(20).encode("hex")
+        log.info("Generated artifact bundle (SHA-1: %s)" % self.bundle_hash)
 
     def __gen_public_host_certificates(self, node_instance):
         log.info("Generating host certificates for public hosts")
@@ -312,39 +588,55 @@ class EC2Launcher(object):
 
         log.info("Generated host certificates for public hosts")
             
-class InstanceWaitThread(DemoGridThread):
-    def __init__(self, multi, name, instance, launcher, depends = None):
-        DemoGridThread.__init__(self, multi, name, depends)
-        self.instance = instance
+class AddressMapTask(DemoGridTask):
+    """Waits for all the instances to be running, and then
+    generates the files that need the address of every node."""
+    
+    def __init__(self, name, topology, nodes, launcher, depends = []):
+        DemoGridTask.__init__(self, name, depends, resource = TaskScheduler.EC2)
+        self.topology = topology
+        self.nodes = nodes
         self.launcher = launcher
-                    
-    def run2(self):
-        self.launcher.wait_state(self.instance, "running")
-        log.info("Instance %s is running. Hostname: %s" % (self.instance.id, self.instance.public_dns_name))
+        self.node_instance = None
         
-class InstanceConfigureThread(DemoGridThread):
-    def __init__(self, multi, name, node, instance, launcher, depends = None):
-        DemoGridThread.__init__(self, multi, name, depends)
+    def run2(self):
+        self.node_instance = self.launcher.wait_instances(self.nodes, self.check_continue)
+        self.check_continue()
+        self.launcher.gen_address_files(self.topology, self.nodes, self.node_instance)
+
+
+class InstanceSetupTask(DemoGridTask):
+    """Gets a node ready for its role converge: waits for its instance,
+    sets up the Chef volume, uploads the files and installs the base
+    packages. None of this depends on any other node."""
+    
+    # Configuration phases, as recorded in the launch journal
+    PHASE_FILES = "files"
+    PHASE_HOSTNAME = "hostname"
+    PHASE_BASE = "base"
+    
+    def __init__(self, name, node, launcher, depends = []):
+        DemoGridTask.__init__(self, name, depends, resource = TaskScheduler.SSH)
         self.node = node
-        self.instance = instance
+        self.instance = None
         self.launcher = launcher
+        self.ssh = None
+        self.vol = None
         
     def run2(self):
         node = self.node
-        instance = self.instance
+        journal = self.launcher.journal
+        trace.set_track(node.demogrid_host_id)
+        
+        # Wait for this node's instance (and only this node's instance)
+        # to be running
+        instance = self.launcher.wait_instance(node, self.check_continue)
+        self.instance = instance
         
         log.info("Setting up instance %s. Hostname: %s" % (instance.id, instance.public_dns_name), node)
 
-        if self.launcher.config.has_snap():
-            log.debug("Creating Chef volume.", node)
-            vol = self.launcher.conn.create_volume(1, instance.placement, self.launcher.config.get_snap())
-            log.debug("Created Chef volume %s. Attaching." % vol.id, node)
-            vol.attach(instance.id, '/dev/sdh')
-            log.debug("Chef volume attached. Waiting for it to become in-use.", node)
-            self.launcher.wait_state(vol, "in-use")
-            log.debug("Volume is in-use", node)
-    
-            self.launcher.vols.append(vol)
+        if self.launcher.chef_volumes != None:
+            self.vol = self.launcher.chef_volumes.attach(node, instance, self.check_continue)
 
         self.check_continue()
 
@@ -356,68 +648,194 @@ class InstanceConfigureThread(DemoGridThread):
             ssh_err = sys.stderr
 
         log.debug("Establishing SSH connection", node)
-        ssh = SSH("ubuntu", instance.public_dns_name, self.launcher.config.get_keyfile(), ssh_out, ssh_err)
-        ssh.open()
+        ssh = self.launcher.open_shell(node, instance, ssh_out, ssh_err)
+        self.ssh = ssh
         log.debug("SSH connection established", node)
 
         self.check_continue()
         
-        if self.launcher.config.has_snap():
+        if self.vol != None:
             log.debug("Mounting Chef volume", node)
-            ssh.run("sudo mount -t ext3 /dev/sdh /chef", expectnooutput=True)
+            # The volume may still be mounted if we're resuming a launch
+            ssh.run("mountpoint -q /chef || sudo mount -t ext3 /dev/sdh /chef", expectnooutput=True)
         
-        # Upload host file and update hostname
-        log.debug("Uploading host file and updating hostname", node)
-        ssh.scp("%s/hosts_ec2" % self.launcher.generated_dir,
-                "/chef/cookbooks/demogrid/files/default/hosts")             
-        ssh.run("sudo cp /chef/cookbooks/demogrid/files/default/hosts /etc/hosts", expectnooutput=True)
-        ssh.run("sudo bash -c \"echo %s > /etc/hostname\"" % node.hostname, expectnooutput=True)
-        ssh.run("sudo /etc/init.d/hostname restart")
+        # Everything from here on needs the address map
+        with trace.span("wait-addresses", "wait-addresses"):
+            self.launcher.wait_addresses(self.check_continue)
         
-        self.check_continue()
+        if not journal.is_complete(node, self.PHASE_FILES):
+            if self.launcher.distributor != None:
+                self.fetch_bundle(ssh)
+            else:
+                # Upload host file, topology file, certificates and Chef
+                # configuration (skipping whatever is already up to date)
+                log.debug("Uploading files", node)
+                sent, saved = ssh.sync(self.launcher.get_node_files(node), defaults.CHEF_MANIFEST)
+                log.info("Uploaded %i bytes (%i bytes were already up to date)" % (sent, saved), node)
+            journal.complete_phase(node, self.PHASE_FILES)
         
-        # Upload topology file
-        log.debug("Uploading topology file", node)
-        ssh.scp("%s/topology_ec2.rb" % self.launcher.generated_dir,
-                "/chef/cookbooks/demogrid/attributes/topology.rb")             
+        self.check_continue()
         
-        # Copy certificates
-        log.debug("Copying certificates", node)
-        ssh.scp_dir("%s/certs" % self.launcher.generated_dir, 
-                    "/chef/cookbooks/demogrid/files/default/")
+        if not journal.is_complete(node, self.PHASE_HOSTNAME):
+            # Update hostname
+            log.debug("Updating hostname", node)
+            ssh.run_batch(["sudo cp /chef/cookbooks/demogrid/files/default/hosts /etc/hosts",
+                           "sudo bash -c \"echo %s > /etc/hostname\"" % node.hostname,
+                           "sudo /etc/init.d/hostname restart"])
+            journal.complete_phase(node, self.PHASE_HOSTNAME)
         
         self.check_continue()
 
+        if not journal.is_complete(node, self.PHASE_BASE):
+            log.debug("Installing base packages", node)
+            ssh.run_batch(["echo '%s' > /tmp/chef-base.json" % json.dumps({"run_list": self.launcher.get_base_run_list(node)}),
+                           "sudo chef-solo -c /chef/chef.conf -j /tmp/chef-base.json"])
+            journal.complete_phase(node, self.PHASE_BASE)
+
         if self.launcher.loglevel == 0:
             print "   \033[1;37m%s\033[0m: Basic setup is done. Installing Grid software now." % node.hostname.split(".")[0]
+
+    def fetch_bundle(self, ssh):
+        """Gets the artifact bundle onto the node, checks it, and extracts
+        it into /chef. Org servers (and nodes outside an organization) get
+        the bundle from the launcher. Other nodes fetch it over HTTP from
+        a node in their organization that already has it, and then start
+        serving it themselves."""
+        node = self.node
+        distributor = self.launcher.distributor
+        dist_dir = EC2Launcher.DIST_DIR
+        path = "%s/bundle.tgz" % self.launcher.bundle_secret
+        bundle = "%s/%s" % (dist_dir, path)
+        # The empty index keeps the server from listing the
+        # directory (and giving away the bundle's path)
+        mkdirs = ["mkdir -p %s" % os.path.dirname(bundle),
+                  "touch %s/index.html" % dist_dir]
+        
+        cmds = []
+        source = None
+        if node.org == None or node == node.org.server:
+            log.debug("Uploading artifact bundle", node)
+            ssh.run_batch(mkdirs)
+            ssh.scp(self.launcher.bundle_file, bundle)
+        else:
+            source = distributor.acquire(node.org, self.check_continue)
+            log.debug("Fetching artifact bundle from %s" % source.hostname, node)
+            cmds += mkdirs
+            cmds.append("wget -q -O %s http://%s:%i/%s" % (bundle, source.ip, EC2Launcher.DIST_PORT, path))
+        
+        cmds += ["echo '%s  %s' | sha1sum -c" % (self.launcher.bundle_hash, bundle),
+                 "tar xzf %s -C /chef" % bundle]
+        if node.org != None:
+            cmds.append("cd %s && nohup python -m SimpleHTTPServer %i > /dev/null 2>&1 < /dev/null &" % (dist_dir, EC2Launcher.DIST_PORT))
+        try:
+            ssh.run_batch(cmds)
+        finally:
+            if source != None:
+                distributor.release(node.org, source)
         
-        # Run chef
-        log.debug("Running chef", node)
-        ssh.scp("%s/lib/ec2/chef.conf" % self.launcher.demogrid_dir,
-                "/tmp/chef.conf")        
+        # So later syncs (e.g., when resuming) know these files are up to date
+        ssh.record(self.launcher.bundle_files, defaults.CHEF_MANIFEST)
         
-        ssh.run("echo '{ \"run_list\": \"role[%s]\" }' > /tmp/chef.json" % node.role, expectnooutput=True)
+        if node.org != None:
+            distributor.add_source(node.org, node)
+        log.debug("Artifact bundle is in place", node)
 
-        ssh.run("sudo chef-solo -c /tmp/chef.conf -j /tmp/chef.json")    
+
+class InstanceConvergeTask(DemoGridTask):
+    """Runs the node's role converge, once the node has been set up and
+    the nodes its role depends on have been configured, and then
+    finishes off the node."""
+    
+    PHASE_CHEF = "chef"
+    PHASE_DONE = "done"
+    
+    def __init__(self, name, setup, depends = []):
+        DemoGridTask.__init__(self, name, depends, resource = TaskScheduler.SSH)
+        self.setup = setup
+        self.node = setup.node
+        self.launcher = setup.launcher
+        
+    def run2(self):
+        node = self.node
+        ssh = self.setup.ssh
+        vol = self.setup.vol
+        journal = self.launcher.journal
+        trace.set_track(node.demogrid_host_id)
+
+        if not journal.is_complete(node, self.PHASE_CHEF):
+            # Run chef
+            log.debug("Running chef", node)
+            ssh.run_batch(["echo '{ \"run_list\": \"role[%s]\" }' > /tmp/chef.json" % node.role,
+                           "sudo chef-solo -c /chef/chef.conf -j /tmp/chef.json"])
+            journal.complete_phase(node, self.PHASE_CHEF)
 
         self.check_continue()
 
         # The Chef recipes will overwrite the hostname, so
         # we need to set it again.
-        ssh.run("sudo bash -c \"echo %s > /etc/hostname\"" % node.hostname, expectnooutput=True)
-        ssh.run("sudo /etc/init.d/hostname restart")
-        
-        if self.launcher.config.has_snap():
-            ssh.run("sudo umount /chef", expectnooutput=True)
-            vol.detach()
-            self.launcher.wait_state(vol, "available")        
-            vol.delete()
-            
-            self.launcher.vols.remove(vol)
-        
-        ssh.run("sudo update-rc.d nis enable")     
+        cmds = ["sudo bash -c \"echo %s > /etc/hostname\"" % node.hostname,
+                "sudo /etc/init.d/hostname restart",
+                "sudo update-rc.d nis enable"]
+        if vol != None:
+            cmds.append("sudo umount /chef")
+        if self.launcher.distributor != None and node.org != None and node != node.org.server:
+            self.launcher.distributor.withdraw(node.org, node, self.check_continue)
+            cmds.append("pkill -f 'SimpleHTTPServer %i' || true" % EC2Launcher.DIST_PORT)
+        ssh.run_batch(cmds)
+        
+        if vol != None:
+            # The volume is released in the background
+            self.launcher.chef_volumes.release(node)
 
+        journal.complete_phase(node, self.PHASE_DONE)
         log.info("Configuration done.", node)
         
         if self.launcher.loglevel == 0:
             print "   \033[1;37m%s\033[0m is ready." % node.hostname.split(".")[0]
+
+
+class ArtifactDistributor(object):
+    """Keeps track of which nodes in each organization can serve the
+    artifact bundle to other nodes, and makes sure no node serves more
+    than 'fanout' nodes at a time. Every node that gets the bundle becomes
+    a source itself, so the bundle spreads through the organization as
+    a tree rooted at the org server."""
+    
+    def __init__(self, fanout):
+        self.fanout = fanout
+        self.cond = threading.Condition()
+        self.sources = {}
+        
+    def add_source(self, org, node):
+        with self.cond:
+            self.sources.setdefault(org.name, {})[node] = 0
+            self.cond.notify_all()
+
+    def acquire(self, org, check_continue):
+        with self.cond:
+            while True:
+                sources = self.sources.get(org.name, {})
+                available = [(active, n) for n, active in sources.items() if active < self.fanout]
+                if len(available) > 0:
+                    active, node = min(available)
+                    sources[node] += 1
+                    return node
+                self.cond.wait(2.0)
+                check_continue()
+                
+    def release(self, org, node):
+        with self.cond:
+            sources = self.sources.get(org.name, {})
+            if sources.has_key(node):
+                sources[node] -= 1
+            self.cond.notify_all()
+
+    def withdraw(self, org, node, check_continue):
+        """Stops handing out a node as a source, waiting until
+        any nodes fetching the bundle from it are done."""
+        with self.cond:
+            sources = self.sources.get(org.name, {})
+            while sources.get(node, 0) > 0:
+                self.cond.wait(2.0)
+                check_continue()
+            sources.pop(node, None)
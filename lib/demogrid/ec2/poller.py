@@ -0,0 +1,226 @@
+'''
+Created on Jan 19, 2011
+
+@author: borja
+'''
+from boto.exception import EC2ResponseError
+from demogrid.common import log
+import threading
+import time
+
+class EC2StateException(Exception):
+    def __init__(self, obj_id, state, expected):
+        self.obj_id = obj_id
+        self.state = state
+        self.expected = expected
+
+    def __str__(self):
+        return "%s went into state '%s' while waiting for '%s'" % (self.obj_id, self.state, self.expected)
+
+
+class EC2TimeoutException(Exception):
+    def __init__(self, obj_id, expected, timeout):
+        self.obj_id = obj_id
+        self.expected = expected
+        self.timeout = timeout
+
+    def __str__(self):
+        return "%s did not reach state '%s' in %i seconds" % (self.obj_id, self.expected, self.timeout)
+
+
+class EC2Waiter(object):
+    """Returned by EC2Poller when watching an instance, volume or image. Once the
+    object reaches the expected state, 'result' holds a fresh (and fully
+    populated) boto object for it, and 'time' the time it was seen in
+    that state."""
+
+    def __init__(self, obj_id, state, poller = None, timeout = None):
+        self.obj_id = obj_id
+        self.state = state
+        self.poller = poller
+        self.timeout = timeout
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.time = None
+
+    def wait(self, check_continue = None):
+        if self.timeout != None:
+            deadline = time.time() + self.timeout
+        # Wait with a timeout, so the main thread can still get signals
+        while not self.event.wait(1.0):
+            if check_continue != None:
+                check_continue()
+            if self.timeout != None and time.time() > deadline:
+                if self.poller != None:
+                    self.poller.unwatch(self)
+                raise EC2TimeoutException(self.obj_id, self.state, self.timeout)
+        if self.error != None:
+            raise self.error
+        return self.result
+
+    def _done(self, result, error = None):
+        self.result = result
+        self.error = error
+        self.time = time.time()
+        self.event.set()
+
+
+class EC2Poller(object):
+    """Polls EC2 for the state of the instances, volumes and images that are being
+    waited on. Instead of every waiter polling its own object, each
+    tick makes one Describe call per kind of object (per batch of IDs),
+    and wakes up the waiters whose object has reached the state they
+    are waiting for.
+
+    Errors never stop the poller: each kind of object is polled on its
+    own, so an error only affects that kind in that tick. If a Describe
+    call fails because some of the IDs don't exist, the IDs are described
+    one at a time, and the waiters of the IDs that are still missing after
+    NOT_FOUND_GRACE seconds (new objects can take a while to show up in
+    Describe calls) get an error. Waiters give up after 'timeout' seconds."""
+
+    # Maximum number of IDs per Describe call
+    BATCH_SIZE = 100
+
+    # States that an object will never leave (so waiting for
+    # any other state is pointless)
+    FINAL_STATES = ("terminated", "shutting-down", "error", "deleting", "deleted", "failed")
+
+    # Seconds an object can be missing from Describe calls before
+    # its waiters are told it doesn't exist
+    NOT_FOUND_GRACE = 60
+
+    def __init__(self, conn, interval = 2.0, timeout = 3600):
+        self.conn = conn
+        self.interval = interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.waiters = {}
+        # When each missing object was first found to be missing
+        self.missing = {}
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.__poll_loop, name="ec2-poller")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def watch(self, obj_id, state):
+        """Starts watching an instance, volume or image, and returns an
+        EC2Waiter that will be notified when it reaches the given state."""
+        waiter = EC2Waiter(obj_id, state, self, self.timeout)
+        with self.lock:
+            self.waiters.setdefault(obj_id, []).append(waiter)
+        return waiter
+
+    def unwatch(self, waiter):
+        """Stops watching an object for a waiter that is no longer waiting"""
+        with self.lock:
+            waiters = [w for w in self.waiters.get(waiter.obj_id, []) if w != waiter]
+            if len(waiters) > 0:
+                self.waiters[waiter.obj_id] = waiters
+            else:
+                self.waiters.pop(waiter.obj_id, None)
+                self.missing.pop(waiter.obj_id, None)
+
+    def wait(self, obj_id, state, check_continue = None):
+        return self.watch(obj_id, state).wait(check_continue)
+
+    def wait_all(self, obj_ids, state, check_continue = None):
+        """Waits for several objects to reach a state. Returns a
+        dict mapping each ID to its (fresh) boto object."""
+        waiters = [self.watch(obj_id, state) for obj_id in obj_ids]
+        return dict([(w.obj_id, w.wait(check_continue)) for w in waiters])
+
+    def __poll_loop(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.interval)
+            with self.lock:
+                ids = self.waiters.keys()
+            if len(ids) == 0:
+                continue
+
+            self.__poll([i for i in ids if i.startswith("i-")], self.__describe_instances)
+            self.__poll([i for i in ids if i.startswith("vol-")], self.__describe_volumes)
+            self.__poll([i for i in ids if i.startswith("ami-")], self.__describe_images)
+
+    def __poll(self, ids, describe):
+        for batch in self.__batches(ids):
+            try:
+                found = describe(batch)
+            except EC2ResponseError, exc:
+                if exc.error_code == None or not exc.error_code.endswith(".NotFound"):
+                    log.debug("Error while polling EC2: %s" % exc.reason)
+                    continue
+                # Some of the IDs don't exist. Find out which ones.
+                found = {}
+                for obj_id in batch:
+                    try:
+                        found.update(describe([obj_id]))
+                    except EC2ResponseError, exc:
+                        if exc.error_code == None or not exc.error_code.endswith(".NotFound"):
+                            log.debug("Error while polling EC2: %s" % exc.reason)
+                            found[obj_id] = None
+                    except Exception, exc:
+                        log.debug("Error while polling EC2: %s" % exc)
+                        found[obj_id] = None
+            except Exception, exc:
+                # Anything else (a network error, a response we can't
+                # parse, etc.) We'll try again in the next tick.
+                log.debug("Error while polling EC2: %s" % exc)
+                continue
+
+            for obj_id in batch:
+                if not found.has_key(obj_id):
+                    self.__not_found(obj_id)
+                elif found[obj_id] != None:
+                    state, obj = found[obj_id]
+                    self.__update(obj_id, state, obj)
+
+    def __describe_instances(self, ids):
+        return dict([(i.id, (i.state, i)) for r in self.conn.get_all_instances(ids) for i in r.instances])
+
+    def __describe_volumes(self, ids):
+        return dict([(v.id, (v.status, v)) for v in self.conn.get_all_volumes(ids)])
+
+    def __describe_images(self, ids):
+        return dict([(i.id, (i.state, i)) for i in self.conn.get_all_images(ids)])
+
+    def __not_found(self, obj_id):
+        now = time.time()
+        with self.lock:
+            first = self.missing.setdefault(obj_id, now)
+            if now - first < self.NOT_FOUND_GRACE:
+                # Newly created objects might not be visible yet
+                # to Describe calls. We'll try again in the next tick.
+                return
+            log.debug("%s does not exist." % obj_id)
+            for w in self.waiters.pop(obj_id, []):
+                w._done(None, EC2StateException(obj_id, "not-found", w.state))
+            del self.missing[obj_id]
+
+    def __batches(self, ids):
+        return [ids[i:i+self.BATCH_SIZE] for i in range(0, len(ids), self.BATCH_SIZE)]
+
+    def __update(self, obj_id, state, obj):
+        with self.lock:
+            self.missing.pop(obj_id, None)
+            waiters = self.waiters.get(obj_id, [])
+            remaining = []
+            for w in waiters:
+                if state == w.state:
+                    w._done(obj)
+                elif state in self.FINAL_STATES and not w.state in self.FINAL_STATES:
+                    w._done(obj, EC2StateException(obj_id, state, w.state))
+                else:
+                    remaining.append(w)
+            if len(remaining) > 0:
+                self.waiters[obj_id] = remaining
+            else:
+                self.waiters.pop(obj_id, None)
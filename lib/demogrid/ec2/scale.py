@@ -0,0 +1,251 @@
+'''
+Created on Jan 28, 2011
+
+@author: borja
+'''
+from cPickle import load
+from demogrid.common.utils import TaskScheduler, DemoGridTask
+from demogrid.common.topology import DGNode
+from demogrid.common.certs import CertificateGenerator
+from demogrid.common import log, trace
+from demogrid.ec2.launch import EC2Launcher
+from demogrid.ec2.teardown import EC2Teardown
+from demogrid.prepare import Preparator
+import os
+import sys
+import time
+
+class EC2Scaler(EC2Launcher):
+    """Adds cluster nodes to (or removes them from) an organization in a
+    grid that was launched with EC2Launcher.
+
+    Only the new instances are launched and configured, and the only
+    existing node that is touched is the organization's LRM head (which
+    gets the updated hosts file and node list). When removing nodes, they
+    are drained first (they stop taking jobs, and we wait for their
+    running jobs to finish), and the highest-numbered nodes are removed,
+    so cluster nodes are always numbered 1..N."""
+
+    TOPOLOGY_FILE = "topology_ec2.dat"
+
+    # Role of the cluster nodes, for each LRM head role
+    CLUSTERNODE_ROLES = {Preparator.GATEKEEPER_CONDOR_ROLE: Preparator.LRM_NODE_CONDOR_ROLE,
+                         Preparator.LRM_CONDOR_ROLE: Preparator.LRM_NODE_CONDOR_ROLE,
+                         Preparator.GATEKEEPER_PBS_ROLE: Preparator.LRM_NODE_PBS_ROLE,
+                         Preparator.LRM_PBS_ROLE: Preparator.LRM_NODE_PBS_ROLE}
+
+    def __init__(self, demogrid_dir, config, generated_dir, loglevel, no_cleanup,
+                 org_name, clusternodes, wait_concurrency = None, configure_concurrency = None,
+                 drain_timeout = 3600):
+        EC2Launcher.__init__(self, demogrid_dir, config, generated_dir, loglevel, no_cleanup,
+                             wait_concurrency, configure_concurrency)
+        self.org_name = org_name
+        self.clusternodes = clusternodes
+        self.drain_timeout = drain_timeout
+        self.new_nodes = []
+        self.saved_topology = None
+
+    def launch(self):
+        # EC2Launcher.run() calls launch(), so this is where we scale the grid
+        t_start = time.time()
+        trace.reset()
+        trace.set_track("launcher")
+
+        log.init_logging(self.loglevel)
+
+        topology_file = "%s/%s" % (self.generated_dir, self.TOPOLOGY_FILE)
+        if not os.path.exists(topology_file) or not self.journal.exists():
+            print "\033[1;31mERROR\033[0m - There is no running grid in %s" % self.generated_dir
+            exit(1)
+        f = open(topology_file, "r")
+        self.saved_topology = f.read()
+        f.seek(0)
+        topology = load(f)
+        f.close()
+        self.journal.load()
+
+        org = topology.organizations.get(self.org_name)
+        if org == None:
+            print "\033[1;31mERROR\033[0m - There is no organization called '%s'" % self.org_name
+            exit(1)
+        if org.lrm == None:
+            print "\033[1;31mERROR\033[0m - Organization '%s' does not have an LRM (and, thus, no cluster nodes)" % self.org_name
+            exit(1)
+
+        clusternodes = self.get_clusternodes(topology, org)
+        if self.clusternodes.startswith("+") or self.clusternodes.startswith("-"):
+            target = len(clusternodes) + int(self.clusternodes)
+        else:
+            target = int(self.clusternodes)
+        if target < 0:
+            print "\033[1;31mERROR\033[0m - Organization '%s' only has %i cluster nodes" % (self.org_name, len(clusternodes))
+            exit(1)
+        if target == len(clusternodes):
+            print "Organization '%s' already has %i cluster nodes." % (self.org_name, target)
+            return
+
+        self.connect()
+
+        if target > len(clusternodes):
+            self.scale_out(topology, org, clusternodes, target)
+        else:
+            self.scale_in(topology, org, clusternodes, target)
+
+        delta = time.time() - t_start
+        minutes = int(delta / 60)
+        seconds = int(delta - (minutes * 60))
+        print "Organization '%s' now has \033[1;37m%i cluster nodes\033[0m (took %i minutes and %i seconds)" % (self.org_name, target, minutes, seconds)
+        self.save_trace()
+
+    def scale_out(self, topology, org, clusternodes, target):
+        role = self.CLUSTERNODE_ROLES[org.lrm.role]
+        domain = org.lrm.hostname.split(".", 1)[1]
+
+        for i in range(len(clusternodes) + 1, target + 1):
+            hostname = "%s-%s-%i.%s" % (org.name, Preparator.LRM_NODE_HOSTNAME, i, domain)
+            node = DGNode(role = role, ip = None, hostname = hostname, org = org)
+
+            # The organization-wide attributes are the same as the LRM head's
+            node.attrs = dict([(k, v) for k, v in org.lrm.attrs.items() if not k in ("public_dns", "public_ip")])
+            node.attrs["demogrid_hostname"] = "\"%s\"" % node.demogrid_hostname
+            node.attrs["demogrid_host_id"] = "\"%s\"" % node.demogrid_host_id
+            node.attrs["run_list"] = "[ \"role[%s]\" ]" % role
+            topology.add_org_node(org, node)
+            self.new_nodes.append(node)
+
+        self.__update_lrm_nodes(topology, org, target)
+        if self.config.get_ec2_access_type() != "public":
+            # (with public hostnames, the certificates are generated
+            # once we know the hostnames)
+            self.__gen_host_certificates(self.new_nodes)
+
+        if self.loglevel == 0:
+            print "\033[1;37mLaunching %i EC2 instances...\033[0m" % len(self.new_nodes),
+            sys.stdout.flush()
+        self.instances = []
+        self.request_instances(self.new_nodes)
+        if self.loglevel == 0:
+            print "\033[1;32mdone!\033[0m"
+
+        if self.loglevel == 0:
+            print "\033[1;37mConfiguring new cluster nodes...\033[0m (this may take a few minutes)"
+
+        # The LRM head is configured again, so it knows about the new nodes
+        self.journal.reset_phases(org.lrm)
+        self.configure_push(topology, self.new_nodes + [org.lrm])
+
+    def scale_in(self, topology, org, clusternodes, target):
+        nodes = clusternodes[target:]
+
+        if self.loglevel == 0:
+            print "\033[1;37mDraining %i cluster nodes...\033[0m" % len(nodes)
+        head_ssh = None
+        if org.lrm.role in (Preparator.GATEKEEPER_PBS_ROLE, Preparator.LRM_PBS_ROLE):
+            # Torque nodes are taken offline from the head node
+            head_ssh = self.open_ssh(org.lrm)
+
+        sched = TaskScheduler({TaskScheduler.SSH: self.configure_concurrency})
+        for n in nodes:
+            sched.add_task(ClusterNodeDrainTask("drain-%s" % n.demogrid_host_id, n, self, head_ssh))
+        sched.run()
+        if not sched.all_success():
+            self.handle_mt_exceptions(sched.get_exceptions(), "DemoGrid was unable to drain the cluster nodes.")
+
+        if self.loglevel == 0:
+            print "\033[1;37mTerminating %i EC2 instances...\033[0m" % len(nodes),
+            sys.stdout.flush()
+        errors = EC2Teardown(self.conn, self.poller).release([self.journal.get_instance(n) for n in nodes], [])
+        if len(errors) > 0:
+            self.handle_mt_exceptions(errors, "DemoGrid was unable to terminate the cluster nodes.")
+        if self.loglevel == 0:
+            print "\033[1;32mdone!\033[0m"
+
+        for n in nodes:
+            topology.remove_node(n)
+            self.journal.remove_node(n)
+        self.__update_lrm_nodes(topology, org, target)
+
+        if self.loglevel == 0:
+            print "\033[1;37mUpdating LRM head node...\033[0m"
+        self.journal.reset_phases(org.lrm)
+        self.configure_push(topology, [org.lrm])
+
+    def get_clusternodes(self, topology, org):
+        """Returns the organization's cluster nodes, sorted by number"""
+        prefix = "%s-%s-" % (org.name, Preparator.LRM_NODE_HOSTNAME)
+        nodes = [n for n in topology.get_nodes() if n.org == org and n.demogrid_host_id.startswith(prefix)]
+        nodes.sort(key = lambda n: int(n.demogrid_host_id[len(prefix):]))
+        return nodes
+
+    def open_ssh(self, node):
+        return self.open_shell(node, self.wait_instance(node))
+
+    def cleanup(self):
+        EC2Launcher.cleanup(self)
+        if not self.no_cleanup and len(self.new_nodes) > 0:
+            # The new nodes are gone, so go back to the old topology
+            f = open("%s/%s" % (self.generated_dir, self.TOPOLOGY_FILE), "w")
+            f.write(self.saved_topology)
+            f.close()
+            for n in self.new_nodes:
+                self.journal.remove_node(n)
+
+    def __update_lrm_nodes(self, topology, org, num_clusternodes):
+        for n in topology.get_nodes():
+            if n.org == org and n.attrs.has_key("lrm_nodes"):
+                n.attrs["lrm_nodes"] = "%i" % num_clusternodes
+
+    def __gen_host_certificates(self, nodes):
+        certs_dir = "%s/certs" % self.generated_dir
+        f = open("%s/ca_cert.hash" % certs_dir, "r")
+        h = f.read().strip()
+        f.close()
+
+        certg = CertificateGenerator()
+        ca_cert, ca_key = certg.load_certificate("%s/%s.0" % (certs_dir, h), "%s/ca_key.pem" % certs_dir)
+        certg.set_ca(ca_cert, ca_key)
+        for node in nodes:
+            cert, key = certg.gen_host_cert(hostname = node.hostname)
+            certg.save_certificate(cert, key,
+                                   "%s/%s_cert.pem" % (certs_dir, node.demogrid_host_id),
+                                   "%s/%s_key.pem" % (certs_dir, node.demogrid_host_id))
+
+
+class ClusterNodeDrainTask(DemoGridTask):
+    """Stops a cluster node from taking new jobs, and waits (up to the
+    scaler's drain timeout) for the jobs it is running to finish."""
+
+    # Seconds between checks
+    POLL_INTERVAL = 15
+
+    def __init__(self, name, node, scaler, head_ssh = None, depends = []):
+        DemoGridTask.__init__(self, name, depends, resource = TaskScheduler.SSH)
+        self.node = node
+        self.scaler = scaler
+        self.head_ssh = head_ssh
+
+    def run2(self):
+        node = self.node
+        name = node.hostname.split(".")[0]
+        trace.set_track(node.demogrid_host_id)
+
+        with trace.span("drain", "drain"):
+            if self.head_ssh != None:
+                self.head_ssh.run("sudo pbsnodes -o %s" % name, expectnooutput=True)
+                ssh = self.head_ssh
+                busy = "pbsnodes %s | grep -q 'jobs = '" % name
+            else:
+                ssh = self.scaler.open_ssh(node)
+                ssh.run("sudo condor_off -peaceful -startd", expectnooutput=True)
+                busy = "pgrep -x condor_startd > /dev/null"
+
+            deadline = time.time() + self.scaler.drain_timeout
+            while ssh.run(busy, exception_on_error = False, expectnooutput = True) == 0:
+                if time.time() > deadline:
+                    log.info("Node is still running jobs, but the drain timeout has expired.", node)
+                    break
+                log.debug("Node is still running jobs.", node)
+                for i in range(self.POLL_INTERVAL):
+                    time.sleep(1)
+                    self.check_continue()
+        log.info("Node has been drained.", node)
@@ -0,0 +1,66 @@
+'''
+Created on Jan 24, 2011
+
+@author: borja
+'''
+from demogrid.common import log
+import threading
+
+class EC2Teardown(object):
+    """Releases the EC2 resources of a launch as fast as possible.
+
+    Instances are terminated with one TerminateInstances call per batch
+    of IDs. Volumes are force-detached right away (we don't care about
+    what's on them), and each volume is deleted as soon as the poller
+    sees it become available. Volume operations are run concurrently,
+    with at most 'concurrency' API calls in flight at a time."""
+
+    # Maximum number of IDs per TerminateInstances call
+    BATCH_SIZE = 100
+
+    def __init__(self, conn, poller, concurrency = 16):
+        self.conn = conn
+        self.poller = poller
+        self.semaphore = threading.Semaphore(concurrency)
+        self.lock = threading.Lock()
+        self.errors = {}
+
+    def release(self, instance_ids, volumes):
+        """Terminates the given instances, and detaches and deletes the
+        given volumes. Returns a dict mapping the IDs of the resources
+        that couldn't be released to the exception that was raised."""
+        for i in range(0, len(instance_ids), self.BATCH_SIZE):
+            batch = instance_ids[i:i+self.BATCH_SIZE]
+            log.debug("Terminating %i instances" % len(batch))
+            try:
+                self.conn.terminate_instances(batch)
+            except Exception, exc:
+                for instance_id in batch:
+                    self.errors[instance_id] = exc
+
+        threads = []
+        for vol in volumes:
+            thread = threading.Thread(target=self.__release_volume, args=(vol,), name="release-%s" % vol.id)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # Join with a timeout, so the main thread can still get signals
+            while thread.is_alive():
+                thread.join(1.0)
+
+        return self.errors
+
+    def __release_volume(self, vol):
+        try:
+            waiter = self.poller.watch(vol.id, "available")
+            if vol.attachment_state() in ("attaching", "attached"):
+                with self.semaphore:
+                    vol.detach(force = True)
+            waiter.wait()
+            with self.semaphore:
+                vol.delete()
+            log.debug("Volume %s has been deleted" % vol.id)
+        except Exception, exc:
+            with self.lock:
+                self.errors[vol.id] = exc
@@ -0,0 +1,189 @@
+'''
+Created on Jan 21, 2011
+
+@author: borja
+'''
+from boto.exception import EC2ResponseError
+from demogrid.common import log, trace
+from demogrid.common.utils import ThreadAbortException
+import threading
+
+class ChefVolumeManager(object):
+    """Takes care of the Chef volumes (created from the [ec2] snap snapshot)
+    that the nodes mount on /chef while they're being configured.
+
+    Volumes are created as soon as we know what zone the instances will
+    run in (i.e., as soon as the reservation exists), so they're usually
+    ready by the time the instances are running. Volumes are released in
+    the background, so a node doesn't have to wait for its volume to be
+    detached and deleted. All the waiting is done through the poller, so
+    state changes are polled for in batches."""
+
+    DEVICE = "/dev/sdh"
+    SIZE = 1
+
+    def __init__(self, conn, poller, journal, snapshot):
+        self.conn = conn
+        self.poller = poller
+        self.journal = journal
+        self.snapshot = snapshot
+        self.cond = threading.Condition()
+        self.volumes = {}
+        self.pending = set()
+        self.errors = {}
+        self.releasing = []
+        self.release_errors = {}
+        self.cancelled = False
+
+    def create(self, nodes, zone):
+        """Starts creating a Chef volume for each of the given nodes, in
+        the given zone. Returns immediately."""
+        with self.cond:
+            self.pending.update(nodes)
+        thread = threading.Thread(target=self.__create, args=(nodes, zone), name="chef-volumes")
+        thread.daemon = True
+        thread.start()
+
+    def attach(self, node, instance, check_continue = None):
+        """Attaches the node's Chef volume to its instance, and waits
+        for it to be in-use. If we're resuming a launch, and the volume
+        is still attached to the instance, it is reused."""
+        vol = self.__get_volume(node, instance, check_continue)
+        if vol.status == "in-use":
+            log.debug("Reusing Chef volume %s." % vol.id, node)
+            return vol
+
+        with trace.span("volume-attach", "volume", volume = vol.id):
+            self.poller.wait(vol.id, "available", check_continue)
+            log.debug("Attaching Chef volume %s." % vol.id, node)
+            vol.attach(instance.id, self.DEVICE)
+            vol = self.poller.wait(vol.id, "in-use", check_continue)
+        with self.cond:
+            self.volumes[node] = vol
+        log.debug("Chef volume is in-use.", node)
+        return vol
+
+    def attach_all(self, node_instance, check_continue = None):
+        """Attaches the Chef volumes of several nodes, without waiting
+        for them to be in-use (the nodes will wait for the device
+        to show up themselves)."""
+        vols = dict([(node, self.__get_volume(node, instance, check_continue))
+                     for node, instance in node_instance.items()])
+        self.poller.wait_all([v.id for v in vols.values() if v.status != "in-use"], "available", check_continue)
+        for node, vol in vols.items():
+            if vol.status != "in-use":
+                vol.attach(node_instance[node].id, self.DEVICE)
+
+    def release(self, node):
+        """Starts detaching and deleting the node's Chef volume.
+        Returns immediately."""
+        with self.cond:
+            vol = self.volumes.get(node)
+            if vol == None:
+                return
+            thread = threading.Thread(target=self.__release, args=(node, vol), name="release-%s" % vol.id)
+            thread.daemon = True
+            self.releasing.append(thread)
+        thread.start()
+
+    def wait_released(self, check_continue = None):
+        """Waits for all the volumes that are being released. Returns
+        a dict mapping volume IDs to the exception that was raised while
+        releasing them, for the volumes that couldn't be released."""
+        with self.cond:
+            threads = self.releasing[:]
+        for thread in threads:
+            # Join with a timeout, so the main thread can still get signals
+            while thread.is_alive():
+                thread.join(1.0)
+                if check_continue != None:
+                    check_continue()
+        with self.cond:
+            return dict(self.release_errors)
+
+    def cancel(self):
+        """Stops creating volumes, and waits for the volume that is
+        currently being created (so that get_volumes() returns every
+        volume that has to be released)."""
+        with self.cond:
+            self.cancelled = True
+            while len(self.pending) > 0:
+                self.cond.wait(1.0)
+
+    def get_volumes(self):
+        """Returns all the Chef volumes that haven't been released yet"""
+        with self.cond:
+            return self.volumes.values()
+
+    def __create(self, nodes, zone):
+        for node in nodes:
+            try:
+                if self.cancelled:
+                    raise ThreadAbortException()
+                with trace.span("volume-create", "volume", track = node.demogrid_host_id):
+                    vol = self.conn.create_volume(self.SIZE, zone, self.snapshot)
+                self.journal.set_volume(node, vol.id)
+                log.debug("Created Chef volume %s." % vol.id, node)
+                with self.cond:
+                    self.volumes[node] = vol
+            except Exception, exc:
+                with self.cond:
+                    self.errors[node] = exc
+            with self.cond:
+                self.pending.discard(node)
+                self.cond.notify_all()
+
+    def __get_volume(self, node, instance, check_continue):
+        with self.cond:
+            while node in self.pending:
+                self.cond.wait(1.0)
+                if check_continue != None:
+                    check_continue()
+            if self.errors.has_key(node):
+                raise self.errors[node]
+            vol = self.volumes.get(node)
+        if vol != None:
+            return vol
+
+        # The volume wasn't created in advance. If we're resuming a
+        # launch, it may still be around.
+        vol_id = self.journal.get_volume(node)
+        if vol_id != None:
+            try:
+                vols = self.conn.get_all_volumes([vol_id])
+            except EC2ResponseError, exc:
+                # The volume is gone
+                vols = []
+            if len(vols) == 1:
+                vol = vols[0]
+                if (vol.status == "in-use" and vol.attach_data.instance_id == instance.id) or vol.status == "available":
+                    with self.cond:
+                        self.volumes[node] = vol
+                    return vol
+
+        with trace.span("volume-create", "volume"):
+            vol = self.conn.create_volume(self.SIZE, instance.placement, self.snapshot)
+        self.journal.set_volume(node, vol.id)
+        log.debug("Created Chef volume %s." % vol.id, node)
+        if vol_id != None:
+            # The files uploaded to the old volume are gone, so the
+            # node has to be configured again from the start.
+            log.info("Chef volume %s is gone. The node will be configured again." % vol_id, node)
+            self.journal.reset_phases(node)
+        with self.cond:
+            self.volumes[node] = vol
+        return vol
+
+    def __release(self, node, vol):
+        try:
+            with trace.span("volume-release", "volume", track = node.demogrid_host_id, volume = vol.id):
+                vol.detach()
+                self.poller.wait(vol.id, "available")
+                vol.delete()
+            with self.cond:
+                self.volumes.pop(node, None)
+            self.journal.set_volume(node, None)
+            log.debug("Chef volume %s has been released." % vol.id, node)
+        except Exception, exc:
+            with self.cond:
+                self.release_errors[vol.id] = exc
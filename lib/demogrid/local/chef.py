@@ -0,0 +1,270 @@
+'''
+Created on Feb 3, 2011
+
+@author: borja
+'''
+from demogrid.common.utils import DemoGridTask, TaskScheduler
+from demogrid.common import log
+import httplib
+import urlparse
+import binascii
+import hashlib
+import base64
+import Queue
+import json
+import time
+import re
+import os
+
+class ChefAPIException(Exception):
+    def __init__(self, method, path, status, reason):
+        self.method = method
+        self.path = path
+        self.status = status
+        self.reason = reason
+
+    def __str__(self):
+        return "%s %s returned %i %s" % (self.method, self.path, self.status, self.reason)
+
+
+class ChefClient(object):
+    """A client for the Chef server API. Requests are signed with the
+    client's key (the same way knife does), and are sent over a pool
+    of persistent HTTP connections, so several threads can use the
+    client at the same time without reconnecting for every request."""
+    
+    CHEF_VERSION = "0.9.12"
+    
+    def __init__(self, server_url, client_name, client_key, pool_size = 4):
+        url = urlparse.urlparse(server_url)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip("/")
+        self.client_name = client_name
+        self.n, self.d = load_rsa_key(client_key)
+        self.pool = Queue.Queue()
+        for i in range(pool_size):
+            self.pool.put(None)
+
+    def get(self, path):
+        return self.request("GET", path)
+
+    def post(self, path, obj):
+        return self.request("POST", path, obj)
+
+    def put(self, path, obj):
+        return self.request("PUT", path, obj)
+
+    def delete(self, path):
+        return self.request("DELETE", path)
+
+    def request(self, method, path, obj = None):
+        """Sends a request, and returns the decoded JSON response. Raises
+        a ChefAPIException if the server returns an error (the status
+        is in the exception, so callers can check for a 404)."""
+        path = self.prefix + path
+        if obj != None:
+            body = json.dumps(obj)
+        else:
+            body = ""
+        headers = self.sign(method, path, body)
+        headers["Accept"] = "application/json"
+        headers["X-Chef-Version"] = self.CHEF_VERSION
+        if obj != None:
+            headers["Content-Type"] = "application/json"
+        
+        conn = self.pool.get()
+        try:
+            # A connection that the server has closed is
+            # only noticed when we try to use it
+            for attempt in range(2):
+                if conn == None:
+                    conn = self.__connect()
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                    break
+                except (httplib.HTTPException, IOError), exc:
+                    conn.close()
+                    conn = None
+                    if attempt == 1:
+                        raise
+        finally:
+            self.pool.put(conn)
+        
+        log.debug("%s %s: %i" % (method, path, response.status))
+        if response.status >= 300:
+            raise ChefAPIException(method, path, response.status, response.reason)
+        if data == "":
+            return None
+        else:
+            return json.loads(data)
+
+    def sign(self, method, path, body):
+        """Returns the authentication headers for a request (version 1.0
+        of the Chef signing protocol)"""
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        content_hash = base64.b64encode(hashlib.sha1(body).digest())
+        canonical = "\n".join(["Method:%s" % method.upper(),
+                               "Hashed Path:%s" % base64.b64encode(hashlib.sha1(path).digest()),
+                               "X-Ops-Content-Hash:%s" % content_hash,
+                               "X-Ops-Timestamp:%s" % timestamp,
+                               "X-Ops-UserId:%s" % self.client_name])
+        signature = base64.b64encode(rsa_private_encrypt(canonical, self.n, self.d))
+        
+        headers = {"X-Ops-Sign": "version=1.0",
+                   "X-Ops-Userid": self.client_name,
+                   "X-Ops-Timestamp": timestamp,
+                   "X-Ops-Content-Hash": content_hash}
+        for i in range(0, len(signature), 60):
+            headers["X-Ops-Authorization-%i" % (i / 60 + 1)] = signature[i:i+60]
+        return headers
+
+    def __connect(self):
+        if self.scheme == "https":
+            return httplib.HTTPSConnection(self.host, self.port)
+        else:
+            return httplib.HTTPConnection(self.host, self.port)
+
+
+def load_rsa_key(filename):
+    """Returns the modulus and private exponent of an RSA key"""
+    # Only needed to parse the key, so it's not loaded at module level
+    import paramiko
+    key = paramiko.RSAKey.from_private_key_file(filename)
+    if hasattr(key, "d"):
+        return key.n, key.d
+    else:
+        # Newer versions of paramiko keep the key in a cryptography object
+        numbers = key.key.private_numbers()
+        return numbers.public_numbers.n, numbers.d
+
+def rsa_private_encrypt(data, n, d):
+    """RSA-encrypts data with the private key, with PKCS #1 v1.5
+    (type 1) padding, like OpenSSL's RSA_private_encrypt"""
+    k = (len("%x" % n) + 1) / 2
+    if len(data) > k - 11:
+        raise ValueError("Data is too long for the key")
+    padded = "\x00\x01" + "\xff" * (k - 3 - len(data)) + "\x00" + data
+    c = pow(long(binascii.hexlify(padded), 16), d, n)
+    return binascii.unhexlify("%0*x" % (k * 2, c))
+
+def read_knife_config(filename):
+    """Returns the Chef server URL, client name and client key from a
+    knife.rb file (only simple string values are understood)"""
+    f = open(filename, "r")
+    knife = f.read()
+    f.close()
+    
+    current_dir = os.path.dirname(os.path.abspath(filename))
+    values = {}
+    for name, value in re.findall(r"^\s*(\w+)\s+[\"']([^\"']*)[\"']", knife, re.MULTILINE):
+        values[name] = os.path.expanduser(value.replace("#{current_dir}", current_dir))
+    for name in ("chef_server_url", "node_name", "client_key"):
+        if not values.has_key(name):
+            raise Exception("%s does not set %s" % (filename, name))
+    return values["chef_server_url"], values["node_name"], values["client_key"]
+
+
+class ChefRegistrar(object):
+    """Registers hosts in the Chef server (a node with the host's role
+    in its run list, and no client, so the host can register itself
+    with the validation key).
+    
+    Only the hosts that need it are touched: a host whose node already
+    has the right run list is skipped (unless 'force' is set, in which
+    case the node and client are deleted and the node is created again,
+    just like a new host)."""
+    
+    CREATED = "created"
+    UPDATED = "updated"
+    RECREATED = "re-created"
+    UNCHANGED = "unchanged"
+    
+    def __init__(self, client, nodes, force = False, concurrency = 4):
+        self.client = client
+        self.nodes = nodes
+        self.force = force
+        self.concurrency = concurrency
+
+    def run(self):
+        t_start = time.time()
+        sched = TaskScheduler({TaskScheduler.HTTP: self.concurrency})
+        tasks = [RegisterNodeTask("register-%s" % n.demogrid_host_id, self, n) for n in self.nodes]
+        for t in tasks:
+            sched.add_task(t)
+        sched.run()
+        
+        for t in tasks:
+            if t.error == None:
+                print "%s: %s" % (t.node.demogrid_host_id, t.action)
+            else:
+                print "%s: \033[1;31mFAILED\033[0m - %s" % (t.node.demogrid_host_id, t.error)
+        actions = [t.action for t in tasks if t.error == None]
+        counts = ["%i %s" % (actions.count(a), a) for a in (self.CREATED, self.UPDATED, self.RECREATED, self.UNCHANGED) if a in actions]
+        failed = len(tasks) - len(actions)
+        if failed > 0:
+            counts.append("%i failed" % failed)
+        print "Registered %i hosts in the Chef server in %.1fs (%s)" % (len(tasks), time.time() - t_start, ", ".join(counts))
+        if failed > 0:
+            exit(1)
+
+    def register(self, node):
+        """Makes sure the node is registered, and returns what had to be done"""
+        name = node.hostname
+        run_list = ["role[%s]" % node.role]
+        
+        chef_node = self.__get("/nodes/%s" % name)
+        if chef_node != None and not self.force:
+            if chef_node.get("run_list") == run_list:
+                return self.UNCHANGED
+            chef_node["run_list"] = run_list
+            self.client.put("/nodes/%s" % name, chef_node)
+            action = self.UPDATED
+        else:
+            if chef_node != None:
+                self.client.delete("/nodes/%s" % name)
+                action = self.RECREATED
+            else:
+                action = self.CREATED
+            self.client.post("/nodes", {"name": name,
+                                        "json_class": "Chef::Node",
+                                        "chef_type": "node",
+                                        "run_list": run_list,
+                                        "normal": {},
+                                        "default": {},
+                                        "override": {},
+                                        "automatic": {}})
+
+        # The host will create its client when it first runs chef-client
+        if self.__get("/clients/%s" % name) != None:
+            self.client.delete("/clients/%s" % name)
+        return action
+
+    def __get(self, path):
+        try:
+            return self.client.get(path)
+        except ChefAPIException, exc:
+            if exc.status == 404:
+                return None
+            raise
+
+
+class RegisterNodeTask(DemoGridTask):
+    def __init__(self, name, registrar, node, depends = []):
+        DemoGridTask.__init__(self, name, depends, resource = TaskScheduler.HTTP)
+        self.registrar = registrar
+        self.node = node
+        self.action = None
+        self.error = None
+
+    def run2(self):
+        try:
+            self.action = self.registrar.register(self.node)
+            log.info("Node %s." % self.action, self.node)
+        except Exception, exc:
+            # A failed host must not stop the other ones, so the
+            # error is recorded here instead of being raised.
+            self.error = exc
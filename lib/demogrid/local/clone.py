@@ -0,0 +1,214 @@
+'''
+Created on Feb 2, 2011
+
+@author: borja
+'''
+from demogrid.common.utils import DemoGridTask, TaskScheduler
+from demogrid.common import log
+from StringIO import StringIO
+import Queue
+import subprocess
+import tarfile
+import time
+import os
+
+VM_DIR = "/var/vm"
+
+# The first file in a seed image (so the VM can tell it apart from other disks)
+SEED_MARKER = "./demogrid-seed"
+SEED_NETMASK = "255.255.0.0"
+
+class NBDPool(object):
+    """The nbd devices that images can be connected to. Devices that
+    are already connected (by someone else) are left alone."""
+    
+    SYS_DIR = "/sys/block"
+    
+    def __init__(self):
+        self.free = Queue.Queue()
+        devices = [d for d in os.listdir(self.SYS_DIR) if d.startswith("nbd")]
+        devices.sort(key = lambda d: int(d[3:]))
+        for d in devices:
+            if not os.path.exists("%s/%s/pid" % (self.SYS_DIR, d)):
+                self.free.put("/dev/%s" % d)
+        self.size = self.free.qsize()
+
+    def acquire(self, check_continue = None):
+        # Wait with a timeout, so the main thread can still get signals
+        while True:
+            try:
+                return self.free.get(True, 1.0)
+            except Queue.Empty:
+                if check_continue != None:
+                    check_continue()
+
+    def release(self, device):
+        self.free.put(device)
+
+
+def get_seed_image(host_id):
+    return "%s/%s-seed.img" % (VM_DIR, host_id)
+
+def gen_seed_image(node, hosts):
+    """Returns a seed image for a node: a raw disk with a tar archive of
+    the files that are specific to the node. When the VM boots, the
+    demogrid-seed job (see lib/uvb) finds the disk, and extracts the
+    files into the root filesystem."""
+    subnet = ".".join(node.ip.split(".")[:2])
+    interfaces = """auto lo
+iface lo inet loopback
+
+auto eth0
+iface eth0 inet static
+    address %s
+    netmask %s
+    gateway %s.0.1
+    dns-nameservers %s.0.1
+""" % (node.ip, SEED_NETMASK, subnet, subnet)
+    
+    files = [(SEED_MARKER, "%s %s\n" % (node.demogrid_host_id, node.role)),
+             ("./etc/hosts", hosts),
+             ("./etc/hostname", "%s\n" % node.demogrid_host_id),
+             ("./etc/network/interfaces", interfaces)]
+    
+    seed = StringIO()
+    tar = tarfile.open(fileobj = seed, mode = "w", format = tarfile.USTAR_FORMAT)
+    for name, contents in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        info.mode = 0644
+        info.mtime = time.time()
+        tar.addfile(info, StringIO(contents))
+    tar.close()
+    
+    # The disk has to be a whole number of sectors
+    data = seed.getvalue()
+    return data + "\0" * (-len(data) % 512)
+
+
+class ImageCloner(object):
+    """Creates the VM images for several hosts at once.
+    
+    By default, each image is customized by mounting it through an nbd
+    device (so at most one image per free nbd device is created at a
+    time). With 'seed', the image is left as is, and the files for
+    the host are put in a seed image next to it, which the VM applies
+    when it boots. This needs no nbd devices or mounts, so all the
+    images can be created at the same time."""
+    
+    def __init__(self, demogrid_dir, generated_dir, nodes, flatten = False, concurrency = None, seed = False):
+        self.demogrid_dir = demogrid_dir
+        self.generated_dir = generated_dir
+        self.nodes = nodes
+        self.flatten = flatten
+        self.concurrency = concurrency
+        self.seed = seed
+        self.pool = None
+        self.hosts = None
+
+    def run(self):
+        if self.seed:
+            f = open("%s/hosts" % self.generated_dir, "r")
+            self.hosts = f.read()
+            f.close()
+            concurrency = self.concurrency or len(self.nodes)
+        else:
+            self.pool = NBDPool()
+            if self.pool.size == 0:
+                print "\033[1;31mERROR\033[0m - There are no free nbd devices (is the nbd module loaded?)"
+                exit(1)
+            concurrency = self.pool.size
+            if self.concurrency != None:
+                concurrency = min(concurrency, self.concurrency)
+
+        t_start = time.time()
+        print "Creating %i VM images (%i at a time)" % (len(self.nodes), concurrency)
+        sched = TaskScheduler({TaskScheduler.DISK: concurrency})
+        tasks = [CloneImageTask("clone-%s" % n.demogrid_host_id, self, n) for n in self.nodes]
+        for t in tasks:
+            sched.add_task(t)
+        sched.run()
+        
+        for t in tasks:
+            if t.error == None:
+                print "%s: created in %.1fs (%s)" % (t.node.demogrid_host_id, t.elapsed, t.image)
+            else:
+                print "%s: \033[1;31mFAILED\033[0m - %s" % (t.node.demogrid_host_id, t.error)
+        failed = len([t for t in tasks if t.error != None])
+        print "Created %i of %i VM images in %.1fs" % (len(tasks) - failed, len(tasks), time.time() - t_start)
+        if failed > 0:
+            exit(1)
+
+    def get_image(self, node):
+        return "%s/%s.qcow2" % (VM_DIR, node.demogrid_host_id)
+
+    def clone(self, node, device):
+        """Creates the image for a node, using the given nbd device"""
+        # A seed image left over from an earlier clone would
+        # be attached to the VM, and override these settings
+        seed_image = get_seed_image(node.demogrid_host_id)
+        if os.path.exists(seed_image):
+            os.remove(seed_image)
+        cmd = ["%s/lib/create_from_master_img.sh" % self.demogrid_dir,
+               self.get_master_image(), 
+               self.get_image(node), 
+               node.ip, 
+               node.demogrid_host_id,
+               "%s/hosts" % self.generated_dir,
+               self.flatten and "flatten" or "",
+               device]
+        self.__run(cmd)
+
+    def clone_seed(self, node):
+        """Creates the image and the seed image for a node"""
+        image = self.get_image(node)
+        self.__run(["qemu-img", "create", "-f", "qcow2", "-o", "backing_fmt=qcow2", 
+                    "-b", os.path.abspath(self.get_master_image()), image])
+        if self.flatten:
+            self.__run(["qemu-img", "rebase", "-b", "", image])
+        
+        f = open(get_seed_image(node.demogrid_host_id), "wb")
+        f.write(gen_seed_image(node, self.hosts))
+        f.close()
+
+    def get_master_image(self):
+        return "%s/ubuntu-vm-builder/master_img.qcow2" % self.generated_dir
+
+    def __run(self, cmd):
+        log.debug("Running %s" % " ".join(cmd))
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            raise Exception("%s returned %i: %s" % (os.path.basename(cmd[0]), p.returncode, output.strip()))
+
+
+class CloneImageTask(DemoGridTask):
+    def __init__(self, name, cloner, node, depends = []):
+        DemoGridTask.__init__(self, name, depends, resource = TaskScheduler.DISK)
+        self.cloner = cloner
+        self.node = node
+        self.image = cloner.get_image(node)
+        self.elapsed = None
+        self.error = None
+
+    def run2(self):
+        if self.cloner.seed:
+            device = None
+        else:
+            device = self.cloner.pool.acquire(self.check_continue)
+        t_start = time.time()
+        try:
+            if device != None:
+                log.debug("Creating image on %s" % device, self.node)
+                self.cloner.clone(self.node, device)
+            else:
+                self.cloner.clone_seed(self.node)
+            log.info("Image created.", self.node)
+        except Exception, exc:
+            # A failed image must not stop the other ones, so the
+            # error is recorded here instead of being raised.
+            self.error = exc
+        finally:
+            self.elapsed = time.time() - t_start
+            if device != None:
+                self.cloner.pool.release(device)
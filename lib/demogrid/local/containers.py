@@ -0,0 +1,540 @@
+'''
+Created on Feb 7, 2011
+
+@author: borja
+'''
+from cPickle import load
+from demogrid.common.utils import SSH, SSHCommandFailureException, dir_files
+from demogrid.common import log, trace
+from demogrid.ec2.journal import LaunchJournal
+from demogrid.ec2.launch import EC2Launcher
+import subprocess
+import shutil
+import time
+import sys
+import os
+
+def get_proc_stat(pid):
+    """Returns the fields of /proc/<pid>/stat after the command name
+    (so the process state is the first one), or None if there is no
+    such process"""
+    try:
+        f = open("/proc/%i/stat" % pid, "r")
+        stat = f.read()
+        f.close()
+    except IOError:
+        return None
+    # The command name (second field) can contain spaces
+    return stat.rsplit(")", 1)[1].split()
+
+
+class ContainerJournal(LaunchJournal):
+    """Launch journal of a container launch (kept in the
+    containers directory, instead of the generated directory)"""
+
+    FILENAME = "launch.journal"
+
+
+class Container(object):
+    """A DemoGrid node running in a container. Quacks enough like
+    a boto Instance to go through the EC2Launcher pipeline."""
+
+    # Position of the start time in get_proc_stat()
+    STAT_START_TIME = 19
+
+    def __init__(self, node, index, dir, pid = None, start_time = None):
+        self.node = node
+        self.index = index
+        self.dir = dir
+        self.root = "%s/root" % dir
+        self.pid = pid
+        self.start_time = start_time
+        self.id = "dg-%s" % node.demogrid_host_id
+
+    @property
+    def private_ip_address(self):
+        return self.node.ip
+
+    @property
+    def public_dns_name(self):
+        return self.node.ip
+
+    @property
+    def veth(self):
+        # Interface names can't be longer than 15 characters,
+        # so they can't include the host id
+        return "dg%i" % self.index
+
+    def is_running(self):
+        """Checks that the container's init is still running. The PID
+        alone isn't enough (after a reboot, it can belong to any other
+        process), so the process must also have been started when the
+        init was, and be chrooted into the container's root."""
+        if self.pid == None:
+            return False
+        stat = get_proc_stat(self.pid)
+        if stat == None:
+            return False
+        if self.start_time != None and stat[self.STAT_START_TIME] != self.start_time:
+            return False
+        try:
+            root = os.readlink("/proc/%i/root" % self.pid)
+        except OSError:
+            return False
+        return os.path.realpath(root) == os.path.realpath(self.root)
+
+
+class ContainerManager(object):
+    """Starts and stops DemoGrid nodes as containers.
+
+    Every container runs the init of a single, read-only, base root
+    filesystem (which must have Chef installed, and be able to boot
+    in a container, like the ones created by lxc-create), chrooted into
+    an overlay mount of that filesystem. Each container gets its own
+    overlay upper directory (so all the changes made to a node are in
+    <containers dir>/<host id>/upper) and its own mount, UTS, IPC, PID
+    and network namespaces. Containers are connected to a bridge on
+    this host, with the IP of their node in the topology (which is
+    also the IP of the master in the hosts file), and their traffic
+    to the outside world is masqueraded. The bridge and the masquerading
+    rule are removed by teardown_network(), once no container is using
+    them (IP forwarding is left enabled, since something else on this
+    host may need it)."""
+
+    BRIDGE = "demogrid0"
+
+    # Seconds to wait for a container's init to show up, or go away
+    START_TIMEOUT = 30
+    STOP_TIMEOUT = 30
+
+    def __init__(self, containers_dir, rootfs, subnet, init = "/sbin/init"):
+        self.containers_dir = containers_dir
+        self.rootfs = rootfs
+        self.subnet = subnet
+        self.init = init
+
+    def setup_network(self):
+        """Creates the bridge (if it doesn't exist yet), and lets the
+        containers reach the outside world through this host."""
+        if subprocess.call(["ip", "link", "show", self.BRIDGE], stdout=open("/dev/null", "w"), stderr=subprocess.STDOUT) != 0:
+            log.debug("Creating bridge %s" % self.BRIDGE)
+            self.__run(["ip", "link", "add", self.BRIDGE, "type", "bridge"])
+            self.__run(["ip", "addr", "add", "%s.0.1/16" % self.subnet, "dev", self.BRIDGE])
+            self.__run(["ip", "link", "set", self.BRIDGE, "up"])
+
+        self.__run(["sysctl", "-q", "-w", "net.ipv4.ip_forward=1"])
+        if subprocess.call(["iptables", "-t", "nat", "-C"] + self.__nat_rule(), stdout=open("/dev/null", "w"), stderr=subprocess.STDOUT) != 0:
+            self.__run(["iptables", "-t", "nat", "-A"] + self.__nat_rule())
+
+    def teardown_network(self):
+        """Removes the bridge and the masquerading rule, unless there
+        are containers still plugged into the bridge. Returns True if
+        they were removed."""
+        brif = "/sys/class/net/%s/brif" % self.BRIDGE
+        if os.path.exists(brif) and len(os.listdir(brif)) > 0:
+            return False
+        devnull = open("/dev/null", "w")
+        subprocess.call(["ip", "link", "del", self.BRIDGE], stdout=devnull, stderr=subprocess.STDOUT)
+        # (setup_network() only adds the rule if it isn't there yet)
+        subprocess.call(["iptables", "-t", "nat", "-D"] + self.__nat_rule(), stdout=devnull, stderr=subprocess.STDOUT)
+        devnull.close()
+        log.debug("Removed bridge %s" % self.BRIDGE)
+        return True
+
+    def start(self, node, index):
+        """Starts a container for the given node. Returns a Container"""
+        container = Container(node, index, "%s/%s" % (self.containers_dir, node.demogrid_host_id))
+        for d in ("upper", "work", "root"):
+            if not os.path.exists("%s/%s" % (container.dir, d)):
+                os.makedirs("%s/%s" % (container.dir, d))
+
+        try:
+            with trace.span("container-start", "container", track = node.demogrid_host_id):
+                self.__start(container)
+        except:
+            # Don't leave a half-started container behind
+            self.stop(container)
+            raise
+
+        log.debug("Container %s is running (pid %i)" % (container.id, container.pid), node)
+        return container
+
+    def __start(self, container):
+        node = container.node
+        self.__run(["mount", "-t", "overlay", "overlay", "-o",
+                    "lowerdir=%s,upperdir=%s/upper,workdir=%s/work" % (self.rootfs, container.dir, container.dir),
+                    container.root])
+
+        # The node's hostname has to be in place before init starts. The
+        # files are written from this host, so any (absolute) symlinks
+        # in their place have to go first.
+        for path in ("/etc/hostname", "/etc/resolv.conf"):
+            if os.path.islink(container.root + path):
+                os.remove(container.root + path)
+        self.__write(container, "/etc/hostname", "%s\n" % node.hostname)
+        shutil.copyfile("/etc/resolv.conf", "%s/etc/resolv.conf" % container.root)
+
+        devnull = open("/dev/null", "r+")
+        proc = subprocess.Popen(["unshare", "--mount", "--uts", "--ipc", "--net", "--pid", "--fork",
+                                 "chroot", container.root, self.init],
+                                stdin=devnull, stdout=devnull, stderr=devnull,
+                                close_fds=True, preexec_fn=os.setsid)
+        devnull.close()
+
+        # We want the init (which is a child of unshare), not unshare
+        # itself, and we want it once it's in the container's root
+        deadline = time.time() + self.START_TIMEOUT
+        while container.pid == None or not container.is_running():
+            if container.pid == None:
+                container.pid = self.__get_child(proc.pid)
+            if container.pid != None and container.start_time == None:
+                stat = get_proc_stat(container.pid)
+                if stat != None:
+                    container.start_time = stat[Container.STAT_START_TIME]
+            if not container.is_running():
+                if proc.poll() != None or time.time() > deadline:
+                    raise ContainerException(container, "The container's init did not start.")
+                time.sleep(0.1)
+        self.__write_file("%s/pid" % container.dir, "%i %s\n" % (container.pid, container.start_time))
+
+        self.__run(["nsenter", "-t", str(container.pid), "-u", "hostname", node.hostname])
+
+        # Plug the container into the bridge
+        peer = "%sp" % container.veth
+        self.__run(["ip", "link", "add", container.veth, "type", "veth", "peer", "name", peer])
+        self.__run(["ip", "link", "set", container.veth, "master", self.BRIDGE, "up"])
+        self.__run(["ip", "link", "set", peer, "netns", str(container.pid)])
+        netns = ["nsenter", "-t", str(container.pid), "-n", "ip"]
+        self.__run(netns + ["link", "set", "lo", "up"])
+        self.__run(netns + ["link", "set", peer, "name", "eth0"])
+        self.__run(netns + ["addr", "add", "%s/16" % node.ip, "dev", "eth0"])
+        self.__run(netns + ["link", "set", "eth0", "up"])
+        self.__run(netns + ["route", "add", "default", "via", "%s.0.1" % self.subnet])
+
+    def stop(self, container, keep = False):
+        """Stops a container (killing its init takes down its whole PID
+        namespace, and the network namespace with it) and unmounts its
+        root. Its directory is removed, unless 'keep' is true."""
+        if container.is_running():
+            os.kill(container.pid, 9)
+            deadline = time.time() + self.STOP_TIMEOUT
+            while container.is_running():
+                if time.time() > deadline:
+                    raise ContainerException(container, "The container's init did not go away.")
+                time.sleep(0.1)
+
+        # The host end of the veth pair goes away with the network
+        # namespace, unless we didn't get as far as moving the other
+        # end (so it's fine if it's already gone)
+        subprocess.call(["ip", "link", "del", container.veth], stdout=open("/dev/null", "w"), stderr=subprocess.STDOUT)
+        if os.path.ismount(container.root):
+            self.__run(["umount", "-l", container.root])
+        if not keep:
+            shutil.rmtree(container.dir)
+        log.debug("Container %s has been stopped" % container.id, container.node)
+
+    def get_containers(self, topology):
+        """Returns the containers of the nodes in the topology that
+        have a container directory (running or not)"""
+        containers = []
+        for index, node in enumerate(topology.get_nodes()):
+            dir = "%s/%s" % (self.containers_dir, node.demogrid_host_id)
+            if os.path.exists(dir):
+                pid = None
+                start_time = None
+                if os.path.exists("%s/pid" % dir):
+                    f = open("%s/pid" % dir, "r")
+                    fields = f.read().split()
+                    f.close()
+                    pid = int(fields[0])
+                    if len(fields) > 1:
+                        start_time = fields[1]
+                containers.append(Container(node, index, dir, pid, start_time))
+        return containers
+
+    def __get_child(self, pid):
+        for p in os.listdir("/proc"):
+            if p.isdigit():
+                stat = get_proc_stat(int(p))
+                # (the process may already be gone)
+                if stat != None and int(stat[1]) == pid:
+                    return int(p)
+        return None
+
+    def __nat_rule(self):
+        return ["POSTROUTING", "-s", "%s.0.0/16" % self.subnet, "!", "-d", "%s.0.0/16" % self.subnet, "-j", "MASQUERADE"]
+
+    def __write(self, container, path, data):
+        self.__write_file("%s%s" % (container.root, path), data)
+
+    def __write_file(self, filename, data):
+        f = open(filename, "w")
+        f.write(data)
+        f.close()
+
+    def __run(self, cmd):
+        log.debug("Running %s" % " ".join(cmd))
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            raise SSHCommandFailureException(None, " ".join(cmd), output)
+        return output
+
+
+class ContainerException(Exception):
+    def __init__(self, container, msg):
+        Exception.__init__(self, "%s: %s" % (container.id, msg))
+        self.container = container
+
+
+class ContainerFS(object):
+    """Stands in for an SFTP client, with the container's root filesystem
+    (as seen from this host) as the remote end. Errors are raised as
+    IOError, just like paramiko does."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def open(self, path, mode = "r"):
+        return open(self.__path(path), mode)
+
+    def put(self, localpath, remotepath):
+        self.__call(shutil.copyfile, localpath, self.__path(remotepath))
+
+    def stat(self, path):
+        return self.__call(os.stat, self.__path(path))
+
+    def mkdir(self, path):
+        self.__call(os.mkdir, self.__path(path))
+
+    def remove(self, path):
+        self.__call(os.remove, self.__path(path))
+
+    def __path(self, path):
+        return "%s/%s" % (self.root, path.lstrip("/"))
+
+    def __call(self, func, *args):
+        try:
+            return func(*args)
+        except OSError, e:
+            raise IOError(e.errno, e.strerror)
+
+
+class ContainerShell(SSH):
+    """Runs commands in a container (by entering its namespaces and
+    root with nsenter), with the same interface as SSH. Files are
+    copied straight into the container's root filesystem, so scp()
+    and sync() work just like they do over SSH."""
+
+    def __init__(self, container, default_outf = sys.stdout, default_errf = sys.stderr):
+        SSH.__init__(self, "root", container.id, None, default_outf, default_errf)
+        self.container = container
+
+    def open(self):
+        self.sftp = ContainerFS(self.container.root)
+
+    def close(self):
+        pass
+
+    def run(self, command, outf=None, errf=None, exception_on_error = True, expectnooutput=False):
+        close_outf = False
+        if expectnooutput:
+            outf = None
+        elif outf != None:
+            outf = open(outf, "w")
+            close_outf = True
+        else:
+            outf = self.default_outf
+
+        log.debug("%s - Running %s" % (self.hostname, command))
+        t_start = time.time()
+        rc, output = self.__exec(command, outf)
+        trace.add(command, self.__trace_category(command), t_start, time.time(), args = {"rc": rc})
+        log.debug("%s - Ran %s" % (self.hostname, command))
+        if close_outf:
+            outf.close()
+
+        if exception_on_error and rc != 0:
+            raise SSHCommandFailureException(self, command, output)
+        else:
+            return rc
+
+    def run_batch(self, commands, outf=None, expectnooutput=False):
+        """Runs a sequence of commands, stopping at the first command that
+        fails (in which case an SSHCommandFailureException is raised for
+        that command, with its output). Returns a list of (command, rc,
+        elapsed seconds) tuples, one per command."""
+        close_outf = False
+        if expectnooutput:
+            outf = None
+        elif outf != None:
+            outf = open(outf, "w")
+            close_outf = True
+        else:
+            outf = self.default_outf
+
+        log.debug("%s - Running batch: %s" % (self.hostname, "; ".join(commands)))
+        results = []
+        try:
+            for command in commands:
+                t_start = time.time()
+                rc, output = self.__exec(command, outf)
+                t_end = time.time()
+                results.append((command, rc, t_end - t_start))
+                trace.add(command, self.__trace_category(command), t_start, t_end, args = {"rc": rc})
+                log.debug("%s - Ran %s (rc=%s, %.3fs)" % (self.hostname, command, rc, t_end - t_start))
+                if rc != 0:
+                    raise SSHCommandFailureException(self, command, output)
+        finally:
+            if close_outf:
+                outf.close()
+        return results
+
+    def __exec(self, command, outf):
+        # Output goes to outf (if any) as it's produced, and is also
+        # kept, so it can be reported if the command fails
+        p = subprocess.Popen(["nsenter", "-t", str(self.container.pid), "-m", "-u", "-i", "-n", "-p", "-r", "-w",
+                              "/bin/bash", "-c", command],
+                             stdin=open("/dev/null", "r"), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             close_fds=True)
+        output = ""
+        while True:
+            data = p.stdout.read(4096)
+            if not data:
+                break
+            output += data
+            if outf != None:
+                outf.write(data)
+                outf.flush()
+        rc = p.wait()
+        return rc, output
+
+    def __trace_category(self, command):
+        if "chef-solo" in command:
+            return "chef"
+        else:
+            return "command"
+
+
+class ContainerLauncher(EC2Launcher):
+    """Launches a grid on this host, with every node running in a
+    container (see ContainerManager), and configures the nodes with
+    the same pipeline as EC2Launcher (the launcher's "instances" are
+    the containers, and commands are run through a ContainerShell
+    instead of SSH).
+
+    Since the containers use the addresses in the topology, the hosts
+    and topology files generated by demogrid-prepare are used as is."""
+
+    def __init__(self, demogrid_dir, config, generated_dir, loglevel, no_cleanup,
+                 rootfs, containers_dir = None, init = "/sbin/init",
+                 configure_concurrency = None, trace_file = None):
+        EC2Launcher.__init__(self, demogrid_dir, config, generated_dir, loglevel, no_cleanup,
+                             configure_concurrency = configure_concurrency, trace_file = trace_file)
+        if containers_dir == None:
+            containers_dir = "%s/containers" % generated_dir
+        self.containers_dir = containers_dir
+        self.manager = ContainerManager(containers_dir, rootfs, config.get_subnet(), init)
+        self.journal = ContainerJournal(containers_dir)
+        self.containers = {}
+
+    def launch(self):
+        t_start = time.time()
+        trace.reset()
+        trace.set_track("launcher")
+
+        log.init_logging(self.loglevel)
+
+        f = open ("%s/topology.dat" % self.generated_dir, "r")
+        topology = load(f)
+        f.close()
+        nodes = topology.get_nodes()
+
+        if len(self.manager.get_containers(topology)) > 0:
+            print "\033[1;31mERROR\033[0m - There are already containers in %s" % self.containers_dir
+            print "        Use demogrid-local-teardown to get rid of them."
+            exit(1)
+        if not os.path.exists(self.containers_dir):
+            os.makedirs(self.containers_dir)
+        self.journal.reset()
+
+        if self.loglevel == 0:
+            print "\033[1;37mStarting %i containers...\033[0m" % len(nodes),
+            sys.stdout.flush()
+        self.manager.setup_network()
+        # The index of each node is its position in the topology, so
+        # its container can be found again by ContainerManager
+        for index, node in enumerate(nodes):
+            container = self.manager.start(node, index)
+            self.containers[node] = container
+            self.journal.set_instance(node, container.id)
+        if self.loglevel == 0:
+            print "\033[1;32mdone!\033[0m"
+
+        if self.loglevel == 0:
+            print "\033[1;37mConfiguring DemoGrid nodes...\033[0m (this may take a few minutes)"
+        log.info("Setting up DemoGrid on containers")
+        node_container = self.configure_push(topology, nodes)
+
+        delta = time.time() - t_start
+        minutes = int(delta / 60)
+        seconds = int(delta - (minutes * 60))
+        print "You just went \033[1;34mfrom zero to grid\033[0m in \033[1;37m%i minutes and %s seconds\033[0m!" % (minutes, seconds)
+
+        print "Your login nodes are:"
+        for node, container in node_container.items():
+            if node.role == "org-login":
+                print "%s: %s" % (node.hostname.split(".")[0], container.public_dns_name)
+
+        self.save_trace()
+
+    def wait_instances(self, nodes, check_continue = None):
+        # Containers are running as soon as they've been started
+        return dict([(n, self.containers[n]) for n in nodes])
+
+    def wait_instance(self, node, check_continue = None):
+        return self.containers[node]
+
+    def open_shell(self, node, container, outf = None, errf = None):
+        shell = ContainerShell(container, outf, errf)
+        shell.open()
+        return shell
+
+    def gen_address_files(self, topology, nodes, node_container):
+        # The files generated by demogrid-prepare already have the
+        # right addresses, so there's nothing to generate.
+        self.addresses_ready.set()
+        log.info("Address map has been published.")
+
+    def get_node_files(self, node):
+        files = [("%s/hosts" % self.generated_dir, "/chef/cookbooks/demogrid/files/default/hosts"),
+                 ("%s/topology.rb" % self.generated_dir, "/chef/cookbooks/demogrid/attributes/topology.rb"),
+                 ("%s/lib/ec2/chef.conf" % self.demogrid_dir, "/chef/chef.conf")]
+        files += dir_files("%s/certs" % self.generated_dir, "/chef/cookbooks/demogrid/files/default/")
+
+        # The base root filesystem doesn't have the Chef files, so the
+        # whole tree is uploaded (but the files above take precedence)
+        generated = set([os.path.normpath(tofile) for fromfile, tofile in files])
+        chef_files = [(fromfile, tofile) for fromfile, tofile in dir_files("%s/chef" % self.demogrid_dir, "/chef")
+                      if not os.path.normpath(tofile) in generated]
+        return chef_files + files
+
+    def cleanup(self):
+        self.save_trace()
+        if self.no_cleanup:
+            print "--no-cleanup has been specified, so DemoGrid will not stop the containers."
+            print "Remember to stop them with demogrid-local-teardown"
+        elif len(self.containers) > 0:
+            print "DemoGrid is attempting to stop all the containers..."
+            errors = {}
+            for node, container in self.containers.items():
+                try:
+                    self.manager.stop(container)
+                except Exception, exc:
+                    errors[container.id] = exc
+            if len(errors) == 0:
+                self.manager.teardown_network()
+                print "DemoGrid has stopped all the containers."
+            else:
+                print "DemoGrid was unable to stop all the containers."
+                print "Please stop them with demogrid-local-teardown: %s" % " ".join(sorted(errors.keys()))
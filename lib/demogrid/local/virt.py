@@ -0,0 +1,200 @@
+'''
+Created on Feb 4, 2011
+
+@author: borja
+'''
+from demogrid.common.utils import DemoGridTask, TaskScheduler
+from demogrid.common import log
+from demogrid.local.clone import VM_DIR, get_seed_image
+import socket
+import time
+import os
+
+try:
+    import libvirt
+except Exception, e:
+    print "The libvirt bindings for Python are not installed."
+    print "'apt-get install python-libvirt' on most Debian/Ubuntu systems"
+    exit(1)
+
+class LibvirtRegistrar(object):
+    """Defines (and starts) the libvirt domains for several hosts at once,
+    over a single libvirt connection.
+    
+    Each domain gets the memory and vCPUs of its role's profile. Domains
+    are started in waves: a host is only started once the hosts it
+    depends on (e.g., its organization's server) are up (i.e., accepting
+    SSH connections), so they're there when it boots."""
+    
+    # Memory (MB) and vCPUs of each role. Roles not listed here
+    # get DEFAULT_PROFILE.
+    PROFILES = {"org-server": (1024, 1),
+                "org-gram": (1024, 2),
+                "org-gram-condor": (1024, 2),
+                "org-gram-pbs": (1024, 2),
+                "org-condor": (768, 1),
+                "org-pbs": (768, 1),
+                "org-clusternode-condor": (256, 1),
+                "org-clusternode-pbs": (256, 1)}
+    DEFAULT_PROFILE = (512, 1)
+    
+    DOMAIN_XML = """<domain type='kvm'>
+  <name>%(name)s</name>
+  <memory>%(memory)i</memory>
+  <vcpu>%(vcpus)i</vcpu>
+  <os>
+    <type>hvm</type>
+    <boot dev='hd'/>
+  </os>
+  <features>
+    <acpi/>
+  </features>
+  <devices>
+%(disks)s
+    <interface type='network'>
+      <source network='%(network)s'/>
+    </interface>
+    <graphics type='vnc' port='-1'/>
+  </devices>
+</domain>
+"""
+    DISK_XML = """    <disk type='file' device='disk'>
+      <driver name='qemu' type='%s'/>
+      <source file='%s'/>
+      <target dev='%s' bus='ide'/>
+    </disk>"""
+    
+    def __init__(self, nodes, uri = "qemu:///system", network = "default", profiles = {},
+                 waves = True, wave_timeout = 300, concurrency = 8):
+        self.nodes = nodes
+        self.uri = uri
+        self.network = network
+        self.profiles = dict(self.PROFILES)
+        self.profiles.update(profiles)
+        self.waves = waves
+        self.wave_timeout = wave_timeout
+        self.concurrency = concurrency
+        self.conn = None
+
+    def run(self):
+        t_start = time.time()
+        self.conn = libvirt.open(self.uri)
+        if self.conn == None:
+            print "\033[1;31mERROR\033[0m - Could not connect to %s" % self.uri
+            exit(1)
+
+        sched = TaskScheduler({TaskScheduler.CPU: self.concurrency})
+        tasks = dict([(n, RegisterDomainTask("register-%s" % n.demogrid_host_id, self, n)) for n in self.nodes])
+        for t in tasks.values():
+            sched.add_task(t)
+        sched.run()
+        
+        defined = [n for n in self.nodes if tasks[n].error == None]
+        for i, wave in enumerate(self.get_waves(defined)):
+            if self.waves:
+                print "Starting wave %i: %s" % (i + 1, " ".join([n.demogrid_host_id for n in wave]))
+            started = [n for n in wave if tasks[n].start()]
+            if self.waves:
+                self.wait_up(started)
+        
+        failed = [t for t in tasks.values() if t.error != None]
+        for t in failed:
+            print "%s: \033[1;31mFAILED\033[0m - %s" % (t.node.demogrid_host_id, t.error)
+        
+        registered = [n for n in self.nodes if tasks[n].error == None]
+        print "Registered %i of %i hosts in libvirt in %.1fs" % (len(registered), len(self.nodes), time.time() - t_start)
+        if len(failed) > 0:
+            exit(1)
+
+    def get_profile(self, node):
+        return self.profiles.get(node.role, self.DEFAULT_PROFILE)
+
+    def get_domain_xml(self, node):
+        disks = [self.DISK_XML % ("qcow2", "%s/%s.qcow2" % (VM_DIR, node.demogrid_host_id), "hda")]
+        seed = get_seed_image(node.demogrid_host_id)
+        if os.path.exists(seed):
+            # Created by demogrid-clone-image --seed
+            disks.append(self.DISK_XML % ("raw", seed, "hdb"))
+        memory, vcpus = self.get_profile(node)
+        return self.DOMAIN_XML % {"name": node.demogrid_host_id,
+                                  "memory": memory * 1024,
+                                  "vcpus": vcpus,
+                                  "disks": "\n".join(disks),
+                                  "network": self.network}
+
+    def get_waves(self, nodes):
+        """Groups the nodes in waves, so that the nodes each
+        node depends on are all in earlier waves."""
+        if not self.waves:
+            return [nodes]
+        wave = {}
+        def get_wave(n):
+            if not wave.has_key(n):
+                wave[n] = max([-1] + [get_wave(d) for d in n.get_depends()]) + 1
+            return wave[n]
+        waves = []
+        for n in nodes:
+            w = get_wave(n)
+            while len(waves) <= w:
+                waves.append([])
+            waves[w].append(n)
+        return [w for w in waves if len(w) > 0]
+
+    def wait_up(self, nodes):
+        """Waits for the nodes to accept SSH connections"""
+        deadline = time.time() + self.wave_timeout
+        pending = list(nodes)
+        while len(pending) > 0 and time.time() < deadline:
+            pending = [n for n in pending if not self.__is_up(n)]
+            if len(pending) > 0:
+                time.sleep(2)
+        for n in pending:
+            print "%s: still not up after %i seconds (starting the next wave anyway)" % (n.demogrid_host_id, self.wave_timeout)
+
+    def __is_up(self, node):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(1.0)
+        try:
+            s.connect((node.ip, 22))
+            return True
+        except socket.error, e:
+            return False
+        finally:
+            s.close()
+
+
+class RegisterDomainTask(DemoGridTask):
+    def __init__(self, name, registrar, node, depends = []):
+        DemoGridTask.__init__(self, name, depends, resource = TaskScheduler.CPU)
+        self.registrar = registrar
+        self.node = node
+        self.domain = None
+        self.error = None
+
+    def run2(self):
+        conn = self.registrar.conn
+        name = self.node.demogrid_host_id
+        try:
+            try:
+                self.domain = conn.lookupByName(name)
+                log.info("Domain is already defined.", self.node)
+            except libvirt.libvirtError, e:
+                self.domain = conn.defineXML(self.registrar.get_domain_xml(self.node))
+                log.info("Domain defined (%iMB, %i vCPUs)." % self.registrar.get_profile(self.node), self.node)
+        except Exception, exc:
+            # A failed host must not stop the other ones, so the
+            # error is recorded here instead of being raised.
+            self.error = exc
+
+    def start(self):
+        """Starts the domain (if it isn't running already). Returns
+        False if it couldn't be started (the error is recorded, just
+        like when the domain can't be defined)."""
+        try:
+            if not self.domain.isActive():
+                self.domain.create()
+                log.info("Domain started.", self.node)
+            return True
+        except Exception, exc:
+            self.error = exc
+            return False
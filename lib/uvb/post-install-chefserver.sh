@@ -5,3 +5,6 @@ chroot $1 wget -qO - http://apt.opscode.com/packages@opscode.com.gpg.key | chroo
 chroot $1 apt-get update
 echo "chef chef/chef_server_url string http://192.168.0.1:4000" | chroot $1 debconf-set-selections
 chroot $1 apt-get -q=2 install chef
+
+# Per-host files are applied at boot from the host's seed image (if any)
+cp `dirname $0`/demogrid-seed.conf $1/etc/init/demogrid-seed.conf
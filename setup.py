@@ -11,7 +11,8 @@ data_files += [('share/demogrid/etc/', ["etc/demogrid.conf.sample",
                ('share/demogrid/lib/', ["lib/chef-node.sh",
                                         "lib/create_from_master_img.sh"]),
                ('share/demogrid/lib/uvb', ["lib/uvb/files-chefserver.txt",
-                                           "lib/uvb/post-install-chefserver.sh"]),
+                                           "lib/uvb/post-install-chefserver.sh",
+                                           "lib/uvb/demogrid-seed.conf"]),
               ]
 
 setup(name='demogrid',
@@ -25,7 +26,9 @@ setup(name='demogrid',
       scripts=['bin/demogrid-clone-image', 
                'bin/demogrid-prepare', 
                'bin/demogrid-register-host-chef', 
-               'bin/demogrid-register-host-libvirt'],
+               'bin/demogrid-register-host-libvirt',
+               'bin/demogrid-local-launch',
+               'bin/demogrid-local-teardown'],
       data_files=data_files,
       classifiers=[
           'Development Status :: 3 - Alpha',
@@ -0,0 +1,146 @@
+'''
+Created on Feb 3, 2011
+
+@author: borja
+'''
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import binascii
+import hashlib
+import base64
+import threading
+import json
+
+# Local stand-in for a Chef server, so that ChefClient and ChefRegistrar
+# can be exercised without a real one. Only the /nodes and /clients
+# endpoints are supported. Every request must carry the authentication
+# headers, and if the server is given the client's public key (modulus
+# and public exponent), the signature is checked too.
+#
+# Requests and connections are counted, to check that the client
+# actually reuses its connections.
+
+class FakeChefServer(ThreadingMixIn, HTTPServer):
+    
+    daemon_threads = True
+    
+    def __init__(self, port = 0, keys = {}):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeChefHandler)
+        self.keys = dict(keys)
+        self.lock = threading.Lock()
+        self.objects = {"nodes": {}, "clients": {}}
+        self.requests = {}
+        self.connections = 0
+        
+    def get_url(self):
+        return "http://127.0.0.1:%i" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="fake-chef-server")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+
+
+class FakeChefHandler(BaseHTTPRequestHandler):
+    
+    # Keep connections open between requests
+    protocol_version = "HTTP/1.1"
+    
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        with self.server.lock:
+            self.server.requests[method] = self.server.requests.get(method, 0) + 1
+        
+        if not self.authenticate(method, body):
+            return self.respond(401, {"error": ["Failed to authenticate"]})
+        
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 0 or not self.server.objects.has_key(parts[0]) or len(parts) > 2:
+            return self.respond(404, {"error": ["Not found"]})
+        objects = self.server.objects[parts[0]]
+        
+        with self.server.lock:
+            if len(parts) == 1:
+                if method == "GET":
+                    return self.respond(200, dict([(name, "%s/%s" % (parts[0], name)) for name in objects]))
+                elif method == "POST":
+                    obj = json.loads(body)
+                    if objects.has_key(obj["name"]):
+                        return self.respond(409, {"error": ["Already exists"]})
+                    objects[obj["name"]] = obj
+                    return self.respond(201, {"uri": "%s/%s" % (parts[0], obj["name"])})
+            else:
+                name = parts[1]
+                if not objects.has_key(name):
+                    return self.respond(404, {"error": ["Cannot load %s" % name]})
+                if method == "GET":
+                    return self.respond(200, objects[name])
+                elif method == "PUT":
+                    objects[name] = json.loads(body)
+                    return self.respond(200, objects[name])
+                elif method == "DELETE":
+                    return self.respond(200, objects.pop(name))
+        self.respond(405, {"error": ["Method not allowed"]})
+
+    def authenticate(self, method, body):
+        user = self.headers.get("X-Ops-Userid")
+        timestamp = self.headers.get("X-Ops-Timestamp")
+        content_hash = self.headers.get("X-Ops-Content-Hash")
+        if user == None or timestamp == None or content_hash == None:
+            return False
+        if content_hash != base64.b64encode(hashlib.sha1(body).digest()):
+            return False
+        
+        signature = ""
+        i = 1
+        while self.headers.has_key("X-Ops-Authorization-%i" % i):
+            signature += self.headers["X-Ops-Authorization-%i" % i]
+            i += 1
+        if signature == "":
+            return False
+        
+        key = self.server.keys.get(user)
+        if key == None:
+            return True
+        n, e = key
+        canonical = "\n".join(["Method:%s" % method,
+                               "Hashed Path:%s" % base64.b64encode(hashlib.sha1(self.path).digest()),
+                               "X-Ops-Content-Hash:%s" % content_hash,
+                               "X-Ops-Timestamp:%s" % timestamp,
+                               "X-Ops-UserId:%s" % user])
+        k = (len("%x" % n) + 1) / 2
+        m = pow(long(binascii.hexlify(base64.b64decode(signature)), 16), e, n)
+        padded = binascii.unhexlify("%0*x" % (k * 2, m))
+        return padded == "\x00\x01" + "\xff" * (k - 3 - len(canonical)) + "\x00" + canonical
+
+    def respond(self, status, obj):
+        data = json.dumps(obj)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,363 @@
+'''
+Created on Jan 26, 2011
+
+@author: borja
+'''
+from boto.exception import EC2ResponseError
+import threading
+import random
+import re
+import time
+
+# In-process stand-in for boto's EC2Connection, so the EC2 code can be
+# exercised (launches, teardowns, throttling) without touching EC2.
+# Wrap it in an EC2Gateway to use it wherever a connection is used.
+#
+# Only the calls DemoGrid uses are supported. Objects move through their
+# states after DELAY seconds, and any call can fail with RequestLimitExceeded
+# with probability THROTTLE, to check that callers can cope with it.
+
+def _error(code, message, status = 400):
+    body = "<Response><Errors><Error><Code>%s</Code><Message>%s</Message></Error></Errors></Response>" % (code, message)
+    exc = EC2ResponseError(status, code, body)
+    exc.error_code = code
+    return exc
+
+
+class FakeReservation(object):
+    def __init__(self, id, instances):
+        self.id = id
+        self.instances = instances
+
+
+class FakeInstance(object):
+    def __init__(self, connection, record):
+        self.connection = connection
+        self.id = record["id"]
+        self.image_id = record["image_id"]
+        self.instance_type = record["instance_type"]
+        self.placement = record["placement"]
+        self.key_name = record["key_name"]
+        self.state = record["state"]
+        if self.state == "running":
+            self.private_ip_address = record["private_ip"]
+            self.public_dns_name = "ec2-%s.compute-1.amazonaws.com" % record["public_ip"].replace(".", "-")
+        else:
+            self.private_ip_address = None
+            self.public_dns_name = ""
+
+    def update(self):
+        rs = self.connection.get_all_instances([self.id])
+        self.__dict__.update(rs[0].instances[0].__dict__)
+        return self.state
+
+
+class FakeAttachment(object):
+    def __init__(self, instance_id = None, device = None, status = None):
+        self.instance_id = instance_id
+        self.device = device
+        self.status = status
+
+
+class FakeVolume(object):
+    def __init__(self, connection, record):
+        self.connection = connection
+        self.id = record["id"]
+        self.size = record["size"]
+        self.zone = record["zone"]
+        self.snapshot_id = record["snapshot_id"]
+        self.status = record["status"]
+        self.attach_data = FakeAttachment(record["instance_id"], record["device"], record["attach_status"])
+
+    def attachment_state(self):
+        return self.attach_data.status
+
+    def update(self):
+        vols = self.connection.get_all_volumes([self.id])
+        self.__dict__.update(vols[0].__dict__)
+        return self.status
+
+    def attach(self, instance_id, device):
+        return self.connection.attach_volume(self.id, instance_id, device)
+
+    def detach(self, force = False):
+        return self.connection.detach_volume(self.id, force = force)
+
+    def delete(self):
+        return self.connection.delete_volume(self.id)
+
+    def create_snapshot(self, description = None):
+        return self.connection.create_snapshot(self.id, description)
+
+
+class FakeSnapshot(object):
+    def __init__(self, connection, record):
+        self.connection = connection
+        self.id = record["id"]
+        self.volume_id = record["volume_id"]
+        self.description = record["description"]
+        self.status = "completed"
+
+    def share(self, user_ids = None, groups = None):
+        return self.connection.modify_snapshot_attribute(self.id, groups = groups)
+
+
+class FakeImage(object):
+    def __init__(self, connection, record):
+        self.connection = connection
+        self.id = record["id"]
+        self.name = record["name"]
+        self.description = record["description"]
+        self.state = record["state"]
+
+
+class FakeEC2Connection(object):
+
+    DELAY = 1.0
+    THROTTLE = 0.0
+
+    def __init__(self, delay = None, throttle = None):
+        if delay != None:
+            self.DELAY = delay
+        if throttle != None:
+            self.THROTTLE = throttle
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.reservations = {}
+        self.instances = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.images = {}
+        # Number of calls made to each action
+        self.calls = {}
+
+    # Instances
+
+    def run_instances(self, image_id, min_count = 1, max_count = 1, key_name = None,
+                      security_groups = None, user_data = None, instance_type = "m1.small",
+                      placement = None, **kwargs):
+        self.__call("run_instances")
+        with self.lock:
+            reservation_id = self.__new_id("r")
+            instance_ids = []
+            for i in range(max_count):
+                instance_id = self.__new_id("i")
+                n = self.counter
+                self.instances[instance_id] = {"id": instance_id,
+                                               "reservation": reservation_id,
+                                               "image_id": image_id,
+                                               "instance_type": instance_type,
+                                               "placement": placement or "us-east-1a",
+                                               "key_name": key_name,
+                                               "private_ip": "10.%i.%i.%i" % (n / 65536 % 256, n / 256 % 256, n % 256),
+                                               "public_ip": "184.%i.%i.%i" % (n / 65536 % 256, n / 256 % 256, n % 256),
+                                               "transitions": self.__transitions(["pending", "running"])}
+                instance_ids.append(instance_id)
+            self.reservations[reservation_id] = instance_ids
+            return FakeReservation(reservation_id, [FakeInstance(self, self.__instance(i)) for i in instance_ids])
+
+    def get_all_instances(self, instance_ids = None):
+        self.__call("get_all_instances")
+        with self.lock:
+            if instance_ids == None:
+                instance_ids = self.instances.keys()
+            for instance_id in instance_ids:
+                if not self.instances.has_key(instance_id):
+                    raise _error("InvalidInstanceID.NotFound", "The instance ID '%s' does not exist" % instance_id)
+            reservations = []
+            for reservation_id, ids in self.reservations.items():
+                instances = [FakeInstance(self, self.__instance(i)) for i in ids if i in instance_ids]
+                if len(instances) > 0:
+                    reservations.append(FakeReservation(reservation_id, instances))
+            return reservations
+
+    def terminate_instances(self, instance_ids = None):
+        self.__call("terminate_instances")
+        return self.__change_instances(instance_ids, ["shutting-down", "terminated"])
+
+    def stop_instances(self, instance_ids = None):
+        self.__call("stop_instances")
+        return self.__change_instances(instance_ids, ["stopping", "stopped"])
+
+    def start_instances(self, instance_ids = None):
+        self.__call("start_instances")
+        return self.__change_instances(instance_ids, ["pending", "running"])
+
+    # Volumes
+
+    def create_volume(self, size, zone, snapshot = None):
+        self.__call("create_volume")
+        with self.lock:
+            volume_id = self.__new_id("vol")
+            self.volumes[volume_id] = {"id": volume_id,
+                                       "size": size,
+                                       "zone": zone,
+                                       "snapshot_id": snapshot,
+                                       "instance_id": None,
+                                       "device": None,
+                                       "transitions": self.__transitions(["creating", "available"])}
+            return FakeVolume(self, self.__volume(volume_id))
+
+    def get_all_volumes(self, volume_ids = None):
+        self.__call("get_all_volumes")
+        with self.lock:
+            if volume_ids == None:
+                volume_ids = self.volumes.keys()
+            for volume_id in volume_ids:
+                if not self.volumes.has_key(volume_id):
+                    raise _error("InvalidVolume.NotFound", "The volume '%s' does not exist." % volume_id)
+            return [FakeVolume(self, self.__volume(v)) for v in volume_ids]
+
+    def attach_volume(self, volume_id, instance_id, device):
+        self.__call("attach_volume")
+        with self.lock:
+            volume = self.__get_volume(volume_id)
+            if self.__volume(volume_id)["status"] != "available":
+                raise _error("IncorrectState", "Volume '%s' is not 'available'." % volume_id)
+            if self.__state(self.__get_instance(instance_id)) != "running":
+                raise _error("IncorrectInstanceState", "Instance '%s' is not 'running'." % instance_id)
+            volume["instance_id"] = instance_id
+            volume["device"] = device
+            volume["transitions"] = self.__transitions(["in-use"])
+            return True
+
+    def detach_volume(self, volume_id, instance_id = None, device = None, force = False):
+        self.__call("detach_volume")
+        with self.lock:
+            volume = self.__get_volume(volume_id)
+            if self.__volume(volume_id)["status"] != "in-use":
+                raise _error("IncorrectState", "Volume '%s' is not 'in-use'." % volume_id)
+            volume["transitions"] = self.__transitions(["in-use", "available"], detaching = True)
+            return True
+
+    def delete_volume(self, volume_id):
+        self.__call("delete_volume")
+        with self.lock:
+            self.__get_volume(volume_id)
+            if self.__volume(volume_id)["status"] != "available":
+                raise _error("VolumeInUse", "Volume '%s' is currently attached." % volume_id)
+            del self.volumes[volume_id]
+            return True
+
+    # Snapshots and images
+
+    def create_snapshot(self, volume_id, description = None):
+        self.__call("create_snapshot")
+        with self.lock:
+            self.__get_volume(volume_id)
+            snapshot_id = self.__new_id("snap")
+            self.snapshots[snapshot_id] = {"id": snapshot_id,
+                                           "volume_id": volume_id,
+                                           "description": description}
+            return FakeSnapshot(self, self.snapshots[snapshot_id])
+
+    def get_all_snapshots(self, snapshot_ids = None, owner = None):
+        self.__call("get_all_snapshots")
+        with self.lock:
+            if snapshot_ids == None:
+                snapshot_ids = self.snapshots.keys()
+            return [FakeSnapshot(self, self.snapshots[s]) for s in snapshot_ids if self.snapshots.has_key(s)]
+
+    def modify_snapshot_attribute(self, snapshot_id, attribute = "createVolumePermission",
+                                  operation = "add", user_ids = None, groups = None):
+        self.__call("modify_snapshot_attribute")
+        return True
+
+    def create_image(self, instance_id, name, description = None, no_reboot = False):
+        self.__call("create_image")
+        if re.match(r"^[\w().\-/]{3,128}$", name) == None:
+            raise _error("InvalidAMIName.Malformed", "AMI names must be between 3 and 128 characters long, and may contain letters, numbers, '(', ')', '.', '-', '/' and '_'")
+        with self.lock:
+            self.__get_instance(instance_id)
+            image_id = self.__new_id("ami")
+            self.images[image_id] = {"id": image_id,
+                                     "name": name,
+                                     "description": description,
+                                     "transitions": self.__transitions(["pending", "available"])}
+            return image_id
+
+    def get_all_images(self, image_ids = None, owners = None):
+        self.__call("get_all_images")
+        with self.lock:
+            if image_ids == None:
+                image_ids = self.images.keys()
+            return [FakeImage(self, self.__image(i)) for i in image_ids if self.images.has_key(i)]
+
+    def get_image(self, image_id):
+        images = self.get_all_images([image_id])
+        if len(images) == 0:
+            raise _error("InvalidAMIID.NotFound", "The AMI ID '%s' does not exist" % image_id)
+        return images[0]
+
+    # Internals. Must be called with the lock held, unless noted.
+
+    def __call(self, action):
+        # Called without the lock held
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+        if self.THROTTLE > 0 and random.random() < self.THROTTLE:
+            raise _error("RequestLimitExceeded", "Request limit exceeded.", 503)
+
+    def __new_id(self, prefix):
+        self.counter += 1
+        return "%s-%08x" % (prefix, self.counter)
+
+    def __transitions(self, states, detaching = False):
+        # Each state is reached DELAY seconds after the previous one
+        now = time.time()
+        return [(now + i * self.DELAY, s, detaching and i == 0) for i, s in enumerate(states)]
+
+    def __state(self, record):
+        now = time.time()
+        current = record["transitions"][0]
+        for transition in record["transitions"]:
+            if transition[0] <= now:
+                current = transition
+        return current[1]
+
+    def __instance(self, instance_id):
+        record = dict(self.instances[instance_id])
+        record["state"] = self.__state(record)
+        return record
+
+    def __image(self, image_id):
+        record = dict(self.images[image_id])
+        record["state"] = self.__state(record)
+        return record
+
+    def __volume(self, volume_id):
+        record = dict(self.volumes[volume_id])
+        record["status"] = self.__state(record)
+        if record["status"] == "in-use" and self.__state(self.instances[record["instance_id"]]) == "terminated":
+            # Volumes are detached when their instance goes away
+            record["status"] = "available"
+        if record["status"] == "in-use":
+            detaching = [t for t in record["transitions"] if t[1] == "in-use" and t[2]]
+            if len(detaching) > 0:
+                record["attach_status"] = "detaching"
+            else:
+                record["attach_status"] = "attached"
+        else:
+            record["instance_id"] = None
+            record["device"] = None
+            record["attach_status"] = None
+        return record
+
+    def __get_instance(self, instance_id):
+        if not self.instances.has_key(instance_id):
+            raise _error("InvalidInstanceID.NotFound", "The instance ID '%s' does not exist" % instance_id)
+        return self.instances[instance_id]
+
+    def __get_volume(self, volume_id):
+        if not self.volumes.has_key(volume_id):
+            raise _error("InvalidVolume.NotFound", "The volume '%s' does not exist." % volume_id)
+        return self.volumes[volume_id]
+
+    def __change_instances(self, instance_ids, states):
+        with self.lock:
+            instances = []
+            for instance_id in instance_ids:
+                instance = self.__get_instance(instance_id)
+                instance["transitions"] = self.__transitions(states)
+                instances.append(FakeInstance(self, self.__instance(instance_id)))
+            return instances
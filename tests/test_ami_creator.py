@@ -0,0 +1,109 @@
+'''
+Created on Feb 9, 2011
+
+@author: borja
+'''
+from demogrid.ec2 import images
+from demogrid.ec2.images import EC2AMICreator, AMIBuildTask
+from demogrid.ec2.gateway import EC2Gateway
+from demogrid.ec2.poller import EC2Poller
+from fakeec2 import FakeEC2Connection
+from StringIO import StringIO
+import unittest
+import tempfile
+import logging
+import shutil
+import json
+import sys
+import os
+
+DEMOGRID_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+class EC2AMICreatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeEC2Connection(delay = 0.1)
+        self.conn = EC2Gateway(self.fake)
+        self.output_dir = tempfile.mkdtemp()
+        logging.disable(logging.INFO)
+
+        # Poll faster than EC2 would let us
+        self.orig_poller = images.EC2Poller
+        images.EC2Poller = lambda conn: EC2Poller(conn, interval = 0.1, timeout = 30)
+
+        # Don't SSH to the instances, just record what would be installed
+        self.orig_configure = AMIBuildTask.configure
+        self.run_lists = {}
+        self.fail_roles = []
+        def configure(task, instance):
+            self.run_lists[task.variant.name] = task.run_list
+            if task.variant.roles == self.fail_roles:
+                raise Exception("chef-solo failed")
+        AMIBuildTask.configure = configure
+
+    def tearDown(self):
+        images.EC2Poller = self.orig_poller
+        AMIBuildTask.configure = self.orig_configure
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.output_dir)
+
+    def build(self, role_sets):
+        creator = EC2AMICreator(DEMOGRID_DIR, ["ami-base"], "demogrid", "snap-chef", "keypair", "keyfile",
+                                instance_types = ["c1.medium", "m1.small"], role_sets = role_sets,
+                                output_dir = self.output_dir, concurrency = 4, conn = self.conn)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            creator.run()
+            rc = 0
+        except SystemExit, exc:
+            rc = exc.code
+        finally:
+            sys.stdout = stdout
+        f = open("%s/%s" % (self.output_dir, EC2AMICreator.MANIFEST_FILE))
+        manifest = json.load(f)
+        f.close()
+        return rc, manifest
+
+    def assertReleased(self):
+        # Every build instance is terminated, and every Chef volume deleted
+        for instance_id in self.fake.instances.keys():
+            self.assertTrue(self.fake.get_all_instances([instance_id])[0].instances[0].state in ("shutting-down", "terminated"))
+        self.assertEqual(self.fake.volumes, {})
+
+    def test_matrix(self):
+        rc, manifest = self.build([None, ["org-server"], ["org-login", "org-gridftp"]])
+        self.assertEqual(rc, 0)
+        self.assertEqual(sorted(manifest.keys()), ["demogrid-c1.medium",
+                                                   "demogrid-c1.medium-org-login+org-gridftp",
+                                                   "demogrid-c1.medium-org-server",
+                                                   "demogrid-m1.small",
+                                                   "demogrid-m1.small-org-login+org-gridftp",
+                                                   "demogrid-m1.small-org-server"])
+        entry = manifest["demogrid-m1.small-org-login+org-gridftp"]
+        self.assertEqual(entry["instance_type"], "m1.small")
+        self.assertEqual(entry["roles"], ["org-login", "org-gridftp"])
+
+        # AMI names can't have a "+"
+        amis = dict([(i["id"], i["name"]) for i in self.fake.images.values()])
+        self.assertEqual(amis[entry["ami"]], "demogrid-m1.small-org-login_org-gridftp")
+        self.assertEqual(len(amis), 6)
+
+        self.assertEqual(self.run_lists["demogrid-c1.medium"], ["recipe[demogrid::ec2]"])
+        self.assertEqual(self.run_lists["demogrid-c1.medium-org-server"][0], "recipe[demogrid::ec2_base]")
+        self.assertReleased()
+
+    def test_failed_build(self):
+        self.fail_roles = ["org-server"]
+        rc, manifest = self.build([None, ["org-server"]])
+        self.assertEqual(rc, 1)
+        self.assertEqual(manifest["demogrid-c1.medium-org-server"]["ami"], None)
+        self.assertEqual(manifest["demogrid-c1.medium-org-server"]["error"], "chef-solo failed")
+        self.assertTrue(manifest["demogrid-c1.medium"]["ami"] != None)
+        self.assertEqual(len(self.fake.images), 2)
+        # The failed builds' instances and volumes are released too
+        self.assertReleased()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+Created on Feb 9, 2011
+
+@author: borja
+'''
+from demogrid.ec2.bootstrap import ArtifactServer, BootstrapFailureException, BootstrapTimeoutException
+from demogrid.common.topology import DGNode
+from demogrid.common.utils import file_hash
+import unittest
+import tempfile
+import urllib2
+import threading
+import os
+
+class ArtifactServerTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.hosts_file = tempfile.mkstemp()
+        os.write(fd, "192.168.1.1 server\n")
+        os.close(fd)
+        self.server = ArtifactServer(0)
+        self.server.start()
+        self.url = "http://127.0.0.1:%i" % self.server.httpd.server_address[1]
+        self.server.add_file("hosts", self.hosts_file)
+        self.org_server = DGNode("org-server", "192.168.1.1", "server.grid")
+        self.org_login = DGNode("org-login", "192.168.1.2", "login.grid")
+
+    def tearDown(self):
+        self.server.stop()
+        os.remove(self.hosts_file)
+
+    def publish(self):
+        files = [("hosts", "/chef/cookbooks/demogrid/files/default/hosts")]
+        self.server.publish("i-1", self.org_server, files, True)
+        self.server.publish("i-2", self.org_login, files, True, self.org_server)
+
+    def get(self, node, instance_id, what, token = None):
+        """Does what the bootstrap script on the node's instance would.
+        Returns the HTTP status and the response."""
+        if token == None:
+            token = self.server.get_token(node.role)
+        try:
+            r = urllib2.urlopen("%s/%s/%s/%s" % (self.url, token, instance_id, what))
+            return r.getcode(), r.read()
+        except urllib2.HTTPError, exc:
+            return exc.code, None
+
+    def report(self, node, instance_id, rc, output = ""):
+        r = urllib2.urlopen("%s/%s/%s/report/%i" % (self.url, self.server.get_token(node.role), instance_id, rc), output)
+        return r.getcode()
+
+    def test_manifest(self):
+        self.publish()
+        status, manifest = self.get(self.org_server, "i-1", "manifest")
+        self.assertEqual(status, 200)
+        self.assertEqual(manifest.split("\n"), ["hostname server.grid",
+                                                "role org-server",
+                                                "mount yes",
+                                                "file %s /chef/cookbooks/demogrid/files/default/hosts hosts" % file_hash(self.hosts_file),
+                                                ""])
+        self.assertEqual(self.get(self.org_server, "i-1", "files/hosts"), (200, "192.168.1.1 server\n"))
+        self.assertEqual(self.get(self.org_server, "i-1", "files/other")[0], 404)
+
+    def test_authentication(self):
+        self.publish()
+        # Tokens are specific to each role
+        self.assertEqual(self.get(self.org_server, "i-1", "manifest", token = "0" * 40)[0], 403)
+        self.assertEqual(self.get(self.org_login, "i-1", "manifest")[0], 403)
+        self.assertEqual(self.get(self.org_server, "i-3", "manifest")[0], 403)
+
+    def test_dependencies(self):
+        self.publish()
+        # Not published yet
+        self.assertEqual(self.get(self.org_server, "i-3", "manifest")[0], 403)
+        # The login node has to wait for the org server
+        self.assertEqual(self.get(self.org_login, "i-2", "manifest")[0], 503)
+        self.assertEqual(self.report(self.org_server, "i-1", 0), 200)
+        self.assertEqual(self.get(self.org_login, "i-2", "manifest")[0], 200)
+        self.assertEqual(self.report(self.org_login, "i-2", 0), 200)
+        self.assertEqual(self.server.wait(), {})
+
+    def test_failure(self):
+        self.publish()
+        self.assertEqual(self.report(self.org_server, "i-1", 1, "chef-solo failed"), 200)
+        # Nodes that depend on a failed node never get their manifest
+        self.assertEqual(self.get(self.org_login, "i-2", "manifest")[0], 503)
+        failures = self.server.wait()
+        self.assertEqual(failures.keys(), [self.org_server])
+        self.assertTrue(isinstance(failures[self.org_server], BootstrapFailureException))
+        self.assertEqual(failures[self.org_server].output, "chef-solo failed")
+
+    def test_timeout(self):
+        self.server.timeout = 1
+        self.publish()
+        # The org server gets its manifest and then dies, and the
+        # login node keeps asking for its manifest in the meantime
+        self.assertEqual(self.get(self.org_server, "i-1", "manifest")[0], 200)
+        stop = threading.Event()
+        def poll():
+            while not stop.wait(0.2):
+                self.get(self.org_login, "i-2", "manifest")
+        poller = threading.Thread(target=poll)
+        poller.start()
+        try:
+            failures = self.server.wait()
+        finally:
+            stop.set()
+            poller.join()
+        self.assertEqual(failures.keys(), [self.org_server])
+        self.assertTrue(isinstance(failures[self.org_server], BootstrapTimeoutException))
+
+
+if __name__ == "__main__":
+    unittest.main()
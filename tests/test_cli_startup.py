@@ -0,0 +1,41 @@
+'''
+Created on Feb 9, 2011
+
+@author: borja
+'''
+import unittest
+import subprocess
+import sys
+import os
+
+# Modules that are slow to import, and that the commands
+# that don't talk to EC2 (or SSH) must not load on startup
+HEAVY_MODULES = ("boto", "paramiko", "OpenSSL", "mako")
+
+# Seconds the imports may take (they take well under a tenth of a
+# second without the heavy modules)
+IMPORT_BUDGET = 1.0
+
+CHECK = """
+import sys, time
+t_start = time.time()
+import demogrid.cli, demogrid.local.clone, demogrid.local.chef
+elapsed = time.time() - t_start
+print " ".join([m for m in %r if sys.modules.has_key(m)])
+print "%%.3f" %% elapsed
+""" % (HEAVY_MODULES,)
+
+class CLIStartupTest(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        # A fresh interpreter, so modules imported by other tests don't count
+        p = subprocess.Popen([sys.executable, "-c", CHECK], stdout=subprocess.PIPE, env=os.environ)
+        out = p.communicate()[0]
+        self.assertEqual(p.returncode, 0)
+        loaded, elapsed = out.split("\n")[:2]
+        self.assertEqual(loaded, "")
+        self.assertTrue(float(elapsed) < IMPORT_BUDGET, "The imports took %ss" % elapsed)
+
+
+if __name__ == "__main__":
+    unittest.main()
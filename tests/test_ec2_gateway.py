@@ -0,0 +1,139 @@
+'''
+Created on Feb 9, 2011
+
+@author: borja
+'''
+from demogrid.ec2.gateway import EC2Gateway
+from demogrid.ec2.poller import EC2Poller, EC2StateException, EC2TimeoutException
+from fakeec2 import FakeEC2Connection, _error
+from boto.exception import EC2ResponseError
+import unittest
+import random
+import threading
+
+class EC2GatewayTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.fake = FakeEC2Connection(delay = 0.1)
+        self.conn = EC2Gateway(self.fake)
+        self.conn.BACKOFF_BASE = 0.01
+
+    def test_throttled_calls_are_retried(self):
+        self.fake.THROTTLE = 0.5
+        for i in range(10):
+            self.conn.create_volume(1, "us-east-1a")
+        self.assertEqual(len(self.fake.volumes), 10)
+        self.assertTrue(self.fake.calls["create_volume"] > 10)
+
+    def test_server_errors_are_only_retried_for_describes(self):
+        failures = {"create_volume": 1, "get_all_volumes": 1}
+        def failing(action):
+            call = getattr(self.fake, action)
+            def f(*args, **kwargs):
+                if failures[action] > 0:
+                    failures[action] -= 1
+                    call(*args, **kwargs)
+                    raise _error("InternalError", "An internal error has occurred", 500)
+                return call(*args, **kwargs)
+            return f
+        self.fake.create_volume = failing("create_volume")
+        self.fake.get_all_volumes = failing("get_all_volumes")
+
+        # The volume was created, so it must not be created again
+        self.assertRaises(EC2ResponseError, self.conn.create_volume, 1, "us-east-1a")
+        self.assertEqual(len(self.fake.volumes), 1)
+        self.assertEqual(len(self.conn.get_all_volumes()), 1)
+        self.assertEqual(self.fake.calls["get_all_volumes"], 2)
+
+    def test_concurrent_describes_are_coalesced(self):
+        self.conn.run_instances("ami-1", 5, 5)
+        self.fake.calls.clear()
+        threads = [threading.Thread(target=self.conn.get_all_instances) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.fake.calls["get_all_instances"], 1)
+
+        # Any other call invalidates the cache
+        self.conn.create_volume(1, "us-east-1a")
+        self.conn.get_all_instances()
+        self.assertEqual(self.fake.calls["get_all_instances"], 2)
+
+    def test_run_instances_concurrently(self):
+        instances, errors = self.conn.run_instances_concurrently([("a", "ami-1", 45, {}), ("b", "ami-2", 3, {})])
+        self.assertEqual(errors, {})
+        self.assertEqual(len(instances["a"]), 45)
+        self.assertEqual(len(instances["b"]), 3)
+        self.assertEqual(self.fake.calls["run_instances"], 4)
+        # Returned objects go through the gateway
+        self.assertTrue(instances["a"][0].connection is self.conn)
+
+
+class EC2PollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeEC2Connection(delay = 0.1)
+        self.conn = EC2Gateway(self.fake, cache_ttl = 0)
+        self.poller = EC2Poller(self.conn, interval = 0.1, timeout = 10)
+        self.poller.NOT_FOUND_GRACE = 0.3
+        self.poller.start()
+
+    def tearDown(self):
+        self.poller.stop()
+
+    def test_wait_all(self):
+        r = self.conn.run_instances("ami-1", 3, 3)
+        ids = [i.id for i in r.instances]
+        instances = self.poller.wait_all(ids, "running")
+        self.assertEqual(sorted(instances.keys()), sorted(ids))
+        self.assertTrue(all([i.state == "running" for i in instances.values()]))
+        self.assertTrue(all([i.private_ip_address != None for i in instances.values()]))
+
+    def test_missing_ids_fail_only_their_waiters(self):
+        r = self.conn.run_instances("ami-1", 2, 2)
+        vol = self.conn.create_volume(1, "us-east-1a")
+        waiters = [self.poller.watch(i.id, "running") for i in r.instances]
+        gone_instance = self.poller.watch("i-deadbeef", "running")
+        gone_volume = self.poller.watch("vol-deadbeef", "available")
+        vol_waiter = self.poller.watch(vol.id, "available")
+
+        for w in waiters:
+            self.assertEqual(w.wait().state, "running")
+        self.assertEqual(vol_waiter.wait().status, "available")
+        self.assertRaises(EC2StateException, gone_instance.wait)
+        self.assertRaises(EC2StateException, gone_volume.wait)
+
+    def test_deleted_volume(self):
+        vol = self.conn.create_volume(1, "us-east-1a")
+        self.poller.wait(vol.id, "available")
+        self.conn.delete_volume(vol.id)
+        self.assertRaises(EC2StateException, self.poller.wait, vol.id, "in-use")
+
+    def test_final_state(self):
+        r = self.conn.run_instances("ami-1")
+        instance_id = r.instances[0].id
+        self.poller.wait(instance_id, "running")
+        self.conn.terminate_instances([instance_id])
+        self.assertRaises(EC2StateException, self.poller.wait, instance_id, "stopped")
+
+    def test_timeout(self):
+        self.poller.timeout = 1
+        r = self.conn.run_instances("ami-1")
+        instance_id = r.instances[0].id
+        self.assertRaises(EC2TimeoutException, self.poller.wait, instance_id, "stopped")
+        self.assertFalse(self.poller.waiters.has_key(instance_id))
+
+    def test_errors_dont_stop_the_poller(self):
+        vol = self.conn.create_volume(1, "us-east-1a")
+        self.fake.THROTTLE = 1.0
+        self.conn.MAX_RETRIES = 0
+        waiter = self.poller.watch(vol.id, "available")
+        self.assertFalse(waiter.event.wait(0.5))
+        self.fake.THROTTLE = 0.0
+        self.assertEqual(waiter.wait().status, "available")
+
+
+if __name__ == "__main__":
+    unittest.main()